@@ -2,9 +2,9 @@ import argparse
 import os
 
 from preprocessing.extract_trajectories import extract_ego_every_nth_timestep
-from preprocessing.layermodel import extract_important_information, assign_layers
+from preprocessing.layermodel import assign_layers
+from preprocessing.scenario_model import ScenarioModel
 from preprocessing.plot import lanelets_to_polygons, visualize_and_save_ego_trajectory_with_lanelets
-from preprocessing.xml2json import convert_single_xml_to_json
 
 
 def main():
@@ -13,14 +13,19 @@ def main():
                        help='Scenario name (e.g. BEL_Antwerp-1_14_T-1)')
     
     args = parser.parse_args()
-    scenario_name = args.scenario
+    generate_ego_trajectory(args.scenario)
+
+def generate_ego_trajectory(scenario_name: str) -> str:
+    """
+    Build the ego trajectory CSV used by main.py from the Frenetix logs of a scenario.
+    Paths are relative to the project root. Returns the path of the ego trajectory file.
+    """
     scenario_filepath = f'data/scenarios/{scenario_name}.xml'
     input_csv_path = f'data/logs/{scenario_name}/logs.csv'
 
     # Ensure the output directory exists
     scenario_output_dir = f'data/ego_trajectories/{scenario_name}'
-    convert_single_xml_to_json(scenario_filepath, 'data/json_scenarios')
-    information_dict = extract_important_information(f'data/json_scenarios/{scenario_name}.json')
+    information_dict = ScenarioModel.from_xml(scenario_filepath)
 
     layers = assign_layers(information_dict)
 
@@ -37,6 +42,7 @@ def main():
 
     ego_path = f'data/ego_trajectories/ego_trajectory_{scenario_name}.csv'
     extract_ego_every_nth_timestep(output_csv_path, ego_path,n=1)
+    return ego_path
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
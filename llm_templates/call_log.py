@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+# Columns of every recorded LLM call, further context fields are kept in "context"
+CALL_FIELDS = (
+    "time", "scenario", "step", "provider", "model",
+    "prompt_tokens", "completion_tokens", "thinking_tokens",
+    "time_to_first_token", "latency", "cache_hit", "error", "pid",
+)
+NUMERIC_FIELDS = ("prompt_tokens", "completion_tokens", "thinking_tokens", "time_to_first_token", "latency")
+
+# Fields (e.g. scenario, step) attributed to the LLM calls made inside call_context(), also in asyncio tasks started there
+_call_context = contextvars.ContextVar("llm_call_context", default={})
+
+@contextlib.contextmanager
+def call_context(**fields):
+    """
+    Attribute all LLM calls inside the with block to fields, e.g. with call_context(step="critical_interval"): ...
+    Nested contexts add to (and override) the fields of the enclosing one.
+    """
+    token = _call_context.set({**_call_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _call_context.reset(token)
+
+def current_call_context() -> dict:
+    return dict(_call_context.get())
+
+class CallLog:
+    """
+    Log of every LLM call with its tokens, latency and cache hit, attributed to the fields of call_context().
+    Files ending in .sqlite/.db are written to a SQLite table, anything else as JSONL. Both are safe
+    for concurrent writers: a JSONL record is appended with a single write, SQLite serializes the inserts.
+    """
+    def __init__(self, path: str = 'data/llm_calls.jsonl'):
+        self.path = path
+        self.sqlite = path.endswith((".sqlite", ".db"))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Call log at LLM_CALL_LOG, or None if it is not set
+        """
+        path = os.environ.get("LLM_CALL_LOG")
+        return cls(path) if path else None
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can neither be shared between threads nor survive a fork
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS calls ("
+                "time REAL, scenario TEXT, step TEXT, provider TEXT, model TEXT, "
+                "prompt_tokens INTEGER, completion_tokens INTEGER, thinking_tokens INTEGER, "
+                "time_to_first_token REAL, latency REAL, cache_hit INTEGER, error TEXT, pid INTEGER, context TEXT)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def record(self, **call):
+        """
+        Record one call (see CALL_FIELDS), together with the fields of the current call_context()
+        """
+        context = current_call_context()
+        record = {field: call.pop(field, context.pop(field, None)) for field in CALL_FIELDS}
+        record["time"] = record["time"] or time.time()
+        record["pid"] = os.getpid()
+        record["context"] = {**context, **call}
+        if self.sqlite:
+            self._connection().execute(
+                f"INSERT INTO calls ({', '.join(CALL_FIELDS)}, context) VALUES ({', '.join('?' * (len(CALL_FIELDS) + 1))})",
+                [record[field] for field in CALL_FIELDS] + [json.dumps(record["context"], default=str)])
+            return
+        line = (json.dumps(record, default=str) + "\n").encode("utf-8")
+        # O_APPEND makes a single write land as one whole line, also with other processes appending
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+def read_calls(path: str) -> list[dict]:
+    """
+    All calls recorded in a JSONL or SQLite call log
+    """
+    if path.endswith((".sqlite", ".db")):
+        connection = sqlite3.connect(path)
+        connection.row_factory = sqlite3.Row
+        calls = [dict(row) for row in connection.execute("SELECT * FROM calls ORDER BY time")]
+        connection.close()
+        for call in calls:
+            call["context"] = json.loads(call["context"] or "{}")
+            call["cache_hit"] = bool(call["cache_hit"])
+        return calls
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize_calls(calls: list[dict], by: list[str] = ("step",)) -> list[dict]:
+    """
+    Number of calls, cache hits and errors, total and mean tokens, and median / p90 latency per group of `by` fields.
+    Context fields (e.g. iteration) can be grouped by as well. Groups with the most prompt tokens come first.
+    """
+    groups = {}
+    for call in calls:
+        key = tuple(call.get(field, call.get("context", {}).get(field)) for field in by)
+        groups.setdefault(key, []).append(call)
+
+    summary = []
+    for key, group in groups.items():
+        row = dict(zip(by, key))
+        row["calls"] = len(group)
+        row["cache_hits"] = sum(bool(call.get("cache_hit")) for call in group)
+        row["errors"] = sum(call.get("error") is not None for call in group)
+        for field in NUMERIC_FIELDS:
+            values = np.array([call[field] for call in group if call.get(field) is not None], dtype=np.float64)
+            if field.endswith("tokens"):
+                row[f"{field}_total"] = int(values.sum())
+                row[f"{field}_mean"] = float(values.mean()) if len(values) else None
+            else:
+                row[f"{field}_median"] = float(np.median(values)) if len(values) else None
+                row[f"{field}_p90"] = float(np.percentile(values, 90)) if len(values) else None
+        summary.append(row)
+    summary.sort(key=lambda row: -row["prompt_tokens_total"])
+    return summary
+
+def _format(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.3f}" if value < 100 else f"{value:.0f}"
+    return str(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the LLM calls of a call log (JSONL or SQLite)')
+    parser.add_argument('path', type=str,
+                        help='REQUIRED: Call log, e.g. data/llm_calls.jsonl')
+    parser.add_argument('-b', '--by', nargs='+', default=['step'],
+                        help='OPTIONAL: Fields to group by, e.g. step model scenario (default: step)')
+    parser.add_argument('--json', action='store_true',
+                        help='OPTIONAL: Print the summary as JSON instead of a table')
+    args = parser.parse_args()
+
+    summary = summarize_calls(read_calls(args.path), args.by)
+    if args.json:
+        print(json.dumps(summary, indent=4))
+        return
+    if not summary:
+        print("No calls recorded")
+        return
+    columns = list(summary[0].keys())
+    widths = [max(len(column), *(len(_format(row[column])) for row in summary)) for column in columns]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in summary:
+        print("  ".join(_format(row[column]).rjust(width) for column, width in zip(columns, widths)))
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,18 @@
 import json
+from typing import Callable
+import numpy as np
+from llm_templates.call_log import call_context
 from llm_templates.llm_utils import get_consistency_params, send_gemini_request, send_openai_request
 from generation_types.generation import StepTwoGenerationResult, TimeInterval
+from mtl_converter.L4_safety_metrics import RelativeMetricsTable
+from mtl_converter.occupancy_timeline import OccupancyTimeline, obstacle_timeline
+from mtl_converter.utils import LaneletIndex
+
+# Both TTCs at or below count as a collision, like "close to 0.0 (i.e. 0.07)" in the prompt
+COLLISION_TTC = 0.1  # s
+# Both TTCs below make a timestep critical, same horizon as the TTC intervals of convert_l4_to_mtl
+CRITICAL_TTC = 10.0  # s
+INTERVAL_DETECTORS = ("llm", "local", "local+llm")
 
 
 def find_critical_interval(L7_mtl, L4_mtl, L1_mtl):
@@ -57,7 +69,8 @@ This is very important: Start answering with ```json
 {{
     "critical_obstacle_id":
 """
-    response = send_openai_request(system_prompt, user_prompt, **get_consistency_params())
+    with call_context(step="critical_interval"):
+        response = send_openai_request(system_prompt, user_prompt, **get_consistency_params())
     return response
 
 def parse_critical_interval_output(output: str) -> StepTwoGenerationResult:
@@ -76,4 +89,89 @@ def parse_critical_interval_output(output: str) -> StepTwoGenerationResult:
         critical_interval=time_interval,
         critical_lanelet_id=output_dict["critical_lanelet_id"],
         has_collision=output_dict["has_collision"]
-    )
\ No newline at end of file
+    )
+
+def find_critical_interval_local(critical_obstacle_ids: list[str],
+                                 relative_metrics: RelativeMetricsTable,
+                                 L4: dict,
+                                 lanelet_index: LaneletIndex,
+                                 timelines: dict = None,
+                                 ego_timeline: OccupancyTimeline = None,
+                                 critical_ttc: float = CRITICAL_TTC,
+                                 collision_ttc: float = COLLISION_TTC,
+                                 tie_breaker: Callable[[], StepTwoGenerationResult] = None) -> StepTwoGenerationResult:
+    """
+    Step 2 without an LLM call, computed from the relative metrics (relevant TTCs as in RelativeMetricsTable)
+    of the critical obstacles (all obstacles if none of them has metrics).
+    The candidate timesteps are those where both TTCs are at most collision_ttc (then has_collision is set),
+    else those where both are below critical_ttc, else all timesteps. Consecutive candidate timesteps of one
+    obstacle form a window; the window with the smallest distance to the ego vehicle (then the smallest TTC) is
+    critical. Its interval is cut to the obstacle's lanelet at the closest timestep, which is the critical lanelet.
+    If several windows are equally critical and a tie_breaker (e.g. the LLM's step 2 result) is given, the window
+    of the obstacle it names is chosen, otherwise the first one in L4 order.
+    """
+    critical = {str(obstacle_id) for obstacle_id in critical_obstacle_ids}
+    obstacles = [obstacle for obstacle in L4.get('dynamicObstacle', []) if obstacle['id'] in critical]
+    metrics = [relative_metrics.obstacle_metrics(float(obstacle['id'])) for obstacle in obstacles]
+    if not any(len(timesteps) for timesteps, *_ in metrics):
+        obstacles = L4.get('dynamicObstacle', [])
+        metrics = [relative_metrics.obstacle_metrics(float(obstacle['id'])) for obstacle in obstacles]
+    if not any(len(timesteps) for timesteps, *_ in metrics):
+        raise ValueError("No relative metrics for the critical obstacles")
+
+    # Rows of each obstacle in time order, obstacles in L4 order
+    position = np.repeat(np.arange(len(obstacles)), [len(timesteps) for timesteps, *_ in metrics])
+    timestep, ttc_long, ttc_lat, distance = (np.concatenate(arrays) for arrays in zip(*metrics))
+    # An obstacle only closes in if both TTCs are small
+    ttc = np.maximum(ttc_long, ttc_lat)
+
+    has_collision = bool((ttc <= collision_ttc).any())
+    candidate = ttc <= collision_ttc if has_collision else ttc < critical_ttc
+    if not candidate.any():
+        candidate = np.ones(len(ttc), dtype=bool)
+
+    # Windows of consecutive candidate timesteps of one obstacle, and their minima
+    rows = np.flatnonzero(candidate)
+    window_start = np.ones(len(rows), dtype=bool)
+    window_start[1:] = (position[rows[1:]] != position[rows[:-1]]) | (timestep[rows[1:]] - timestep[rows[:-1]] > 1)
+    starts = np.flatnonzero(window_start)
+    ends = np.append(starts[1:], len(rows)) - 1
+    min_distance = np.minimum.reduceat(distance[rows], starts)
+    min_ttc = np.minimum.reduceat(ttc[rows], starts)
+
+    best = np.lexsort((min_ttc, min_distance))[0]
+    tied = np.flatnonzero(np.isclose(min_distance, min_distance[best]) & np.isclose(min_ttc, min_ttc[best]))
+    best = tied[0]
+    if len(tied) > 1 and tie_breaker is not None:
+        window_obstacles = [obstacles[position[rows[starts[window]]]]['id'] for window in tied]
+        try:
+            preferred = str(tie_breaker().critical_obstacle_id)
+            if preferred in window_obstacles:
+                best = tied[window_obstacles.index(preferred)]
+        except Exception as e:
+            print(f"Tie breaker failed - Using the first window: {e}")
+
+    window = rows[starts[best]:ends[best] + 1]
+    closest = window[np.argmin(distance[window])]
+    obstacle = obstacles[position[closest]]
+
+    # Cut the window to the lanelet the obstacle occupies at its closest timestep
+    timeline = obstacle_timeline(obstacle, lanelet_index, timelines)
+    start_time, end_time = timestep[window[0]], timestep[window[-1]]
+    lanelet = None
+    states = np.flatnonzero(timeline.times == timestep[closest])
+    if len(states):
+        segment = [segment for segment in timeline.segments if segment.start_state <= states[0]][-1]
+        lanelet = segment.lanelet
+        start_time = max(start_time, timeline.times[segment.start_state])
+        end_time = min(end_time, timeline.times[segment.end_state])
+    if lanelet is None and ego_timeline is not None:
+        lanelets = ego_timeline.lanelets_between(timestep[closest], timestep[closest])
+        lanelet = min(lanelets) if lanelets else None
+
+    return StepTwoGenerationResult(
+        critical_obstacle_id=str(obstacle['id']),
+        critical_interval=TimeInterval(start_time=int(start_time), end_time=int(end_time)),
+        critical_lanelet_id=str(lanelet) if lanelet is not None else "",
+        has_collision=has_collision
+    )
@@ -1,6 +1,11 @@
 import json
+from abc import ABC, abstractmethod
+from typing import Callable
+import numpy as np
+from llm_templates.call_log import call_context
 from llm_templates.llm_utils import send_gemini_request, send_openai_request, get_consistency_params
 from generation_types.generation import StepOneGenerationResult
+from mtl_converter.obstacle_screening import ObstacleScreening
 
 def find_critical_obstacles(L4_mtl, L7_mtl) -> str:
     """
@@ -56,7 +61,8 @@ This is important: Start your response with ```json
 
 """
 
-    response = send_openai_request(system_prompt, user_prompt, **get_consistency_params())
+    with call_context(step="critical_obstacles"):
+        response = send_openai_request(system_prompt, user_prompt, **get_consistency_params())
 
     return response
 
@@ -67,4 +73,86 @@ def parse_critical_obstacles_output(output: str) -> StepOneGenerationResult:
     output = output.replace("```json", "").replace("```", "")
     output = output.strip()
     output_dict = json.loads(output)
-    return StepOneGenerationResult(critical_obstacle_ids=output_dict["critical_obstacle_ids"])
\ No newline at end of file
+    return StepOneGenerationResult(critical_obstacle_ids=output_dict["critical_obstacle_ids"])
+
+
+# ==== rankers ====
+class CriticalityRanker(ABC):
+    """
+    Step 1: choose the critical obstacles of a scenario.
+    rank() gets the simplified L4 and L7 MTL and, for rankers with uses_screenings, the screening of every obstacle
+    and describe_obstacles(obstacle_ids) returning the simplified L4 MTL of only these obstacles.
+    """
+    uses_screenings = False
+
+    @abstractmethod
+    def rank(self, L4_mtl: str, L7_mtl: str, screenings: list[ObstacleScreening] = None, describe_obstacles: Callable[[list[str]], str] = None) -> StepOneGenerationResult:
+        ...
+
+class LLMRanker(CriticalityRanker):
+    """
+    Ranking by the LLM (find_critical_obstacles), as in the original pipeline
+    """
+    def rank(self, L4_mtl: str, L7_mtl: str, screenings: list[ObstacleScreening] = None, describe_obstacles: Callable[[list[str]], str] = None) -> StepOneGenerationResult:
+        return parse_critical_obstacles_output(find_critical_obstacles(L4_mtl, L7_mtl))
+
+class LocalRanker(CriticalityRanker):
+    """
+    Deterministic ranking from the obstacle screening, without an LLM call.
+    The score of an obstacle is
+        ttc_weight / (1 + min TTC) + distance_weight / (1 + min distance) + shared_weight * shared timesteps / most shared timesteps
+    and the num_obstacles highest scores are critical, on equal scores in L4 order.
+    With a reranker (e.g. LLMRanker), the candidates best local scores are described to it and it picks among them;
+    ids it returns that are no candidates are dropped and missing ones are filled up in local order.
+    """
+    uses_screenings = True
+
+    def __init__(self, num_obstacles: int = 5, ttc_weight: float = 1.0, distance_weight: float = 1.0, shared_weight: float = 0.5, reranker: CriticalityRanker = None, candidates: int = 10):
+        self.num_obstacles = num_obstacles
+        self.ttc_weight = ttc_weight
+        self.distance_weight = distance_weight
+        self.shared_weight = shared_weight
+        self.reranker = reranker
+        self.candidates = candidates
+
+    def scores(self, screenings: list[ObstacleScreening]) -> np.ndarray:
+        min_ttc = np.array([screening.min_ttc for screening in screenings], dtype=np.float64)
+        min_distance = np.array([screening.min_distance for screening in screenings], dtype=np.float64)
+        shared = np.array([screening.shared_timesteps for screening in screenings], dtype=np.float64)
+        return (
+            self.ttc_weight / (1 + min_ttc)
+            + self.distance_weight / (1 + min_distance)
+            + self.shared_weight * shared / max(shared.max(initial=0), 1)
+        )
+
+    def ranked_ids(self, screenings: list[ObstacleScreening]) -> list[str]:
+        order = np.argsort(-self.scores(screenings), kind='stable')
+        return [screenings[position].obstacle_id for position in order]
+
+    def rank(self, L4_mtl: str, L7_mtl: str, screenings: list[ObstacleScreening] = None, describe_obstacles: Callable[[list[str]], str] = None) -> StepOneGenerationResult:
+        if screenings is None:
+            raise ValueError("LocalRanker needs the obstacle screenings")
+        ranked = self.ranked_ids(screenings)
+        if self.reranker is None:
+            return StepOneGenerationResult(critical_obstacle_ids=ranked[:self.num_obstacles])
+
+        candidates = ranked[:self.candidates]
+        candidates_mtl = describe_obstacles(candidates) if describe_obstacles else L4_mtl
+        reranked = self.reranker.rank(candidates_mtl, L7_mtl, screenings, describe_obstacles).critical_obstacle_ids
+        chosen = [obstacle_id for obstacle_id in dict.fromkeys(str(obstacle_id) for obstacle_id in reranked) if obstacle_id in candidates]
+        chosen += [obstacle_id for obstacle_id in candidates if obstacle_id not in chosen]
+        return StepOneGenerationResult(critical_obstacle_ids=chosen[:self.num_obstacles])
+
+RANKERS = ("llm", "local", "local+llm")
+
+def get_ranker(name: str = "llm") -> CriticalityRanker:
+    """
+    Ranker by name: "llm" (default), "local" or "local+llm" (local candidates reranked by the LLM)
+    """
+    if name == "llm":
+        return LLMRanker()
+    if name == "local":
+        return LocalRanker()
+    if name == "local+llm":
+        return LocalRanker(reranker=LLMRanker())
+    raise ValueError(f"Unknown criticality ranker: {name}")
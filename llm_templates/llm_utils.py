@@ -1,71 +1,320 @@
-import json
+import asyncio
+import threading
+import time
+import weakref
 import dotenv
+import httpx
 import requests
 import os
 # from google.generativeai.types import GenerationConfig
 from google import genai
 from google.genai import types
 import openai
+from llm_templates.call_log import CallLog
+from llm_templates.response_cache import ResponseCache
 OLLAMA_BASE_URL = "http://localhost:11434"
 
-def send_local_llama_request(system_prompt, user_prompt, debug=True, **kwargs):
-    url = f"{OLLAMA_BASE_URL}/api/chat"
-    headers = {"Content-Type": "application/json"}
-    data = {
-        "model": "llama3.2:latest",
-        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-        "stream": False,
-        **kwargs
-    }
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-    if debug:
-        print(f"Processed tokens: {response.json()['prompt_eval_count']}")
-    return response.json()['message']['content']
+# Read the .env once per process instead of on every request
+dotenv.load_dotenv()
 
-def send_local_deepseek_request(system_prompt, user_prompt, **kwargs):
-    url = f"{OLLAMA_BASE_URL}/api/chat"
-    headers = {"Content-Type": "application/json"}
-    data = {
-        "model": "deepseek-r1:latest",
-        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-        "stream": False,
-        **kwargs
+class RateLimiter:
+    """
+    Spaces out request starts to at most `requests_per_minute`, shared by all threads and event loops.
+    """
+    def __init__(self, requests_per_minute: float = None):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # Reserve the next free slot and return how long to wait for it
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+            return slot - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def await_slot(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class LLMClient:
+    """
+    Client for one model provider ("openai", "gemini" or an Ollama model such as "llama"/"deepseek").
+    The provider SDK clients and HTTP connection pools are created once and reused for every request.
+    complete() blocks, acomplete() can be awaited so several prompts are in flight at once.
+    Both respect the same `max_concurrency` and `requests_per_minute` limits.
+    With a ResponseCache, identical requests are answered from disk without contacting the provider.
+    With a CallLog, every request is recorded with its tokens, latency and cache hit.
+    """
+    DEFAULT_MODELS = {
+        "openai": "gpt-4o",
+        "gemini": "gemini-2.5-flash-preview-04-17",
+        "llama": "llama3.2:latest",
+        "deepseek": "deepseek-r1:latest",
     }
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-    return response.json()['message']['content']
 
-def send_gemini_request(system_prompt, user_prompt, **kwargs) -> str:
-    dotenv.load_dotenv()
+    def __init__(self, provider: str = "openai", model: str = None, max_concurrency: int = 8, requests_per_minute: float = None, token_file: str = 'tokens', debug: bool = False, cache: ResponseCache = None, call_log: CallLog = None):
+        if provider not in self.DEFAULT_MODELS:
+            raise ValueError(f"Unknown LLM provider: {provider}")
+        self.provider = provider
+        self.model = model or self.DEFAULT_MODELS[provider]
+        self.max_concurrency = max_concurrency
+        self.token_file = token_file
+        self.debug = debug
+        self.cache = cache
+        self.call_log = call_log
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._sync_client = None
+        # Async clients and semaphores are bound to the event loop they were created in
+        self._loop_state = weakref.WeakKeyDictionary()
+
+    # ==== clients ====
+    def _get_sync_client(self):
+        with self._lock:
+            if self._sync_client is None:
+                if self.provider == "openai":
+                    self._sync_client = openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+                elif self.provider == "gemini":
+                    self._sync_client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+                else:
+                    self._sync_client = requests.Session()
+            return self._sync_client
 
-    client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+    def _get_async_state(self) -> dict:
+        loop = asyncio.get_running_loop()
+        state = self._loop_state.get(loop)
+        if state is None:
+            if self.provider == "openai":
+                client = openai.AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"])
+            elif self.provider == "gemini":
+                client = self._get_sync_client().aio
+            else:
+                client = httpx.AsyncClient(timeout=None)
+            state = {"client": client, "semaphore": asyncio.Semaphore(self.max_concurrency)}
+            self._loop_state[loop] = state
+        return state
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash-preview-04-17",
-        contents=user_prompt,
-        config=types.GenerateContentConfig(
-            thinking_config=types.ThinkingConfig(thinking_budget=256),
-            system_instruction=system_prompt,
+    async def aclose(self):
+        """
+        Close the async client of the running event loop. Call it before the loop ends (e.g. at the end of
+        the coroutine passed to asyncio.run), otherwise its connection pool is only cleaned up after the loop is closed.
+        """
+        state = self._loop_state.pop(asyncio.get_running_loop(), None)
+        # The Gemini async client belongs to the sync client, which is kept for the whole process
+        if state is not None and self.provider != "gemini":
+            if self.provider == "openai":
+                await state["client"].close()
+            else:
+                await state["client"].aclose()
+
+    # ==== requests ====
+    def _ollama_payload(self, system_prompt, user_prompt, **kwargs) -> dict:
+        return {
+            "model": self.model,
+            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
+            "stream": False,
+            **kwargs
+        }
+
+    def _openai_arguments(self, system_prompt, user_prompt, **kwargs) -> dict:
+        return {
+            "model": self.model,
+            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
             **kwargs
-        ),
-    )
-    output_tokens = response.usage_metadata.candidates_token_count + response.usage_metadata.thoughts_token_count
-    with open('tokens', 'a') as f:
-        f.write(f"{output_tokens}\n")
-    return response.text
+        }
+
+    def _gemini_arguments(self, system_prompt, user_prompt, **kwargs) -> dict:
+        return {
+            "model": self.model,
+            "contents": user_prompt,
+            "config": types.GenerateContentConfig(
+                thinking_config=types.ThinkingConfig(thinking_budget=256),
+                system_instruction=system_prompt,
+                **kwargs
+            ),
+        }
+
+    def _handle_response(self, response, debug: bool = None) -> str:
+        if self.provider == "openai":
+            self._record_tokens(response.usage.completion_tokens)
+            return response.choices[0].message.content
+        if self.provider == "gemini":
+            usage = response.usage_metadata
+            self._record_tokens((usage.candidates_token_count or 0) + (usage.thoughts_token_count or 0))
+            return response.text
+        response_json = response.json()
+        if self.debug if debug is None else debug:
+            print(f"Processed tokens: {response_json['prompt_eval_count']}")
+        return response_json['message']['content']
+
+    def _usage(self, response) -> dict:
+        # Tokens of a response, and the time to the first token where the provider reports it
+        if self.provider == "openai":
+            usage = response.usage
+            details = getattr(usage, "completion_tokens_details", None)
+            return {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "thinking_tokens": getattr(details, "reasoning_tokens", None),
+            }
+        if self.provider == "gemini":
+            usage = response.usage_metadata
+            return {
+                "prompt_tokens": usage.prompt_token_count,
+                "completion_tokens": usage.candidates_token_count,
+                "thinking_tokens": usage.thoughts_token_count,
+            }
+        response_json = response.json()
+        # Ollama reports the durations in nanoseconds, the first token follows loading and the prompt evaluation
+        first_token = response_json.get('load_duration', 0) + response_json.get('prompt_eval_duration', 0)
+        return {
+            "prompt_tokens": response_json.get('prompt_eval_count'),
+            "completion_tokens": response_json.get('eval_count'),
+            "time_to_first_token": first_token / 1e9 if first_token else None,
+        }
+
+    def _log_call(self, started: float, response=None, cache_hit: bool = False, error: Exception = None):
+        if self.call_log is None:
+            return
+        usage = self._usage(response) if response is not None else {}
+        self.call_log.record(
+            provider=self.provider,
+            model=self.model,
+            latency=time.perf_counter() - started,
+            cache_hit=cache_hit,
+            error=repr(error) if error is not None else None,
+            **usage)
+
+    def _record_tokens(self, output_tokens: int):
+        if self.token_file:
+            with open(self.token_file, 'a') as f:
+                f.write(f"{output_tokens}\n")
+
+    def _cache_key(self, system_prompt, user_prompt, kwargs):
+        if self.cache is None:
+            return None
+        return ResponseCache.make_key(self.provider, self.model, system_prompt, user_prompt, kwargs)
+
+    def complete(self, system_prompt: str, user_prompt: str, debug: bool = None, **kwargs) -> str:
+        started = time.perf_counter()
+        key = self._cache_key(system_prompt, user_prompt, kwargs)
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            self._log_call(started, cache_hit=True)
+            return cached
+        client = self._get_sync_client()
+        try:
+            with self._semaphore:
+                self.rate_limiter.wait()
+                if self.provider == "openai":
+                    response = client.chat.completions.create(**self._openai_arguments(system_prompt, user_prompt, **kwargs))
+                elif self.provider == "gemini":
+                    response = client.models.generate_content(**self._gemini_arguments(system_prompt, user_prompt, **kwargs))
+                else:
+                    response = client.post(f"{OLLAMA_BASE_URL}/api/chat", json=self._ollama_payload(system_prompt, user_prompt, **kwargs))
+        except Exception as e:
+            self._log_call(started, error=e)
+            raise
+        self._log_call(started, response)
+        return self._store(key, self._handle_response(response, debug))
+
+    async def acomplete(self, system_prompt: str, user_prompt: str, debug: bool = None, **kwargs) -> str:
+        started = time.perf_counter()
+        key = self._cache_key(system_prompt, user_prompt, kwargs)
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            self._log_call(started, cache_hit=True)
+            return cached
+        state = self._get_async_state()
+        client = state["client"]
+        try:
+            async with state["semaphore"]:
+                await self.rate_limiter.await_slot()
+                if self.provider == "openai":
+                    response = await client.chat.completions.create(**self._openai_arguments(system_prompt, user_prompt, **kwargs))
+                elif self.provider == "gemini":
+                    response = await client.models.generate_content(**self._gemini_arguments(system_prompt, user_prompt, **kwargs))
+                else:
+                    response = await client.post(f"{OLLAMA_BASE_URL}/api/chat", json=self._ollama_payload(system_prompt, user_prompt, **kwargs))
+        except Exception as e:
+            self._log_call(started, error=e)
+            raise
+        self._log_call(started, response)
+        return self._store(key, self._handle_response(response, debug))
+
+    def _store(self, key, response: str) -> str:
+        if key and response is not None:
+            self.cache.put(key, response)
+        return response
+
+    async def acomplete_all(self, prompts: list[tuple[str, str]], **kwargs) -> list[str]:
+        """
+        Send several (system_prompt, user_prompt) pairs concurrently, results are in input order.
+        """
+        return await asyncio.gather(*(self.acomplete(system_prompt, user_prompt, **kwargs) for system_prompt, user_prompt in prompts))
+
+_clients = {}
+_clients_lock = threading.Lock()
+# Response cache of the shared clients, configured through the LLM_CACHE_* environment variables
+_response_cache = ResponseCache.from_env()
+# Call log of the shared clients, configured through LLM_CALL_LOG
+_call_log = CallLog.from_env()
+
+def get_llm_client(provider: str = "openai", **kwargs) -> LLMClient:
+    """
+    Shared client per provider, created on first use. Keyword arguments only apply on creation.
+    """
+    with _clients_lock:
+        if provider not in _clients:
+            kwargs.setdefault("cache", _response_cache)
+            kwargs.setdefault("call_log", _call_log)
+            _clients[provider] = LLMClient(provider, **kwargs)
+        return _clients[provider]
+
+def set_response_cache(cache: ResponseCache):
+    """
+    Use cache (or no cache if None) for all shared clients
+    """
+    global _response_cache
+    with _clients_lock:
+        _response_cache = cache
+        for client in _clients.values():
+            client.cache = cache
+
+def set_call_log(call_log: CallLog):
+    """
+    Record the calls of all shared clients in call_log (or nowhere if None)
+    """
+    global _call_log
+    with _clients_lock:
+        _call_log = call_log
+        for client in _clients.values():
+            client.call_log = call_log
+
+def send_local_llama_request(system_prompt, user_prompt, debug=True, **kwargs):
+    return get_llm_client("llama").complete(system_prompt, user_prompt, debug=debug, **kwargs)
+
+def send_local_deepseek_request(system_prompt, user_prompt, **kwargs):
+    return get_llm_client("deepseek").complete(system_prompt, user_prompt, **kwargs)
+
+def send_gemini_request(system_prompt, user_prompt, **kwargs) -> str:
+    return get_llm_client("gemini").complete(system_prompt, user_prompt, **kwargs)
 
 def send_openai_request(system_prompt, user_prompt, **kwargs) -> str:
-    dotenv.load_dotenv()
-    openai.api_key = os.environ["OPENAI_API_KEY"]
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-        **kwargs
-    )
-    completion_tokens = response.usage.completion_tokens
-    with open('tokens', 'a') as f:
-        f.write(f"{completion_tokens}\n")
-    print(f"OpenAI response: {response.choices[0].message.content}")
-    return response.choices[0].message.content
+    response = get_llm_client("openai").complete(system_prompt, user_prompt, **kwargs)
+    print(f"OpenAI response: {response}")
+    return response
 
 def get_consistency_params() -> dict:
     return {
@@ -75,3 +324,13 @@ def get_consistency_params() -> dict:
         "stop": ["\n```"]
         #"stop_sequences": ["\n```"]
     }
+
+def get_candidate_params(index: int) -> dict:
+    """
+    Parameters of the index-th of several candidates requested for the same prompt.
+    The first candidate uses get_consistency_params(), the others are sampled with their own seed.
+    """
+    params = get_consistency_params()
+    if index:
+        params.update(temperature=0.7, top_p=1.0, seed=params["seed"] + index)
+    return params
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class ResponseCache:
+    """
+    Disk-backed cache of LLM responses in a SQLite file, shared by all processes using the same path.
+    Entries are keyed by a hash of (provider, model, system prompt, user prompt, params).
+    - ttl: seconds after which an entry is no longer served (None = never expires)
+    - max_entries / max_bytes: least recently used entries are evicted beyond these limits
+    - bypass: never serve cached responses, but still store fresh ones
+    """
+    def __init__(self, path: str = 'data/llm_cache.sqlite', ttl: float = None, max_entries: int = None, max_bytes: int = None, bypass: bool = False):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Cache configured by LLM_CACHE_PATH (required), LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES,
+        LLM_CACHE_MAX_BYTES and LLM_CACHE_BYPASS, or None if no cache path is set.
+        """
+        path = os.environ.get("LLM_CACHE_PATH")
+        if not path:
+            return None
+        ttl = os.environ.get("LLM_CACHE_TTL")
+        max_entries = os.environ.get("LLM_CACHE_MAX_ENTRIES")
+        max_bytes = os.environ.get("LLM_CACHE_MAX_BYTES")
+        return cls(
+            path,
+            ttl=float(ttl) if ttl else None,
+            max_entries=int(max_entries) if max_entries else None,
+            max_bytes=int(max_bytes) if max_bytes else None,
+            bypass=os.environ.get("LLM_CACHE_BYPASS", "").lower() in ("1", "true", "yes"))
+
+    @staticmethod
+    def make_key(provider: str, model: str, system_prompt: str, user_prompt: str, params: dict) -> str:
+        payload = json.dumps([provider, model, system_prompt, user_prompt, params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can neither be shared between threads nor survive a fork
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_access REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _count(self, hit: bool):
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str):
+        """
+        Cached response for key, or None on a miss
+        """
+        if self.bypass:
+            self._count(False)
+            return None
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+            self._count(False)
+            return None
+        connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self._count(True)
+        return row[0]
+
+    def put(self, key: str, response: str):
+        connection = self._connection()
+        now = time.time()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, response, len(response.encode("utf-8")), now, now))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove expired entries and the least recently used ones beyond max_entries / max_bytes
+        """
+        connection = self._connection()
+        if self.ttl is not None:
+            connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+        if self.max_bytes is not None:
+            # keep the most recently used entries whose cumulative size fits into max_bytes
+            connection.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_access DESC, key) AS total FROM responses) "
+                "WHERE total > ?)",
+                (self.max_bytes,))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        entries, size = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
@@ -1,19 +1,24 @@
 import argparse
 import json
+import os
 import time
-from llm_templates.critical_interval import find_critical_interval, parse_critical_interval_output
-from llm_templates.critical_obstacles import find_critical_obstacles, parse_critical_obstacles_output
+from llm_templates.critical_interval import INTERVAL_DETECTORS, find_critical_interval, find_critical_interval_local, parse_critical_interval_output
+from llm_templates.call_log import CallLog, call_context
+from llm_templates.llm_utils import set_call_log, set_response_cache
+from llm_templates.response_cache import ResponseCache
+from llm_templates.critical_obstacles import RANKERS, get_ranker
 from mtl_converter.L1_converter import convert_l1_to_mtl
 from mtl_converter.L4_converter import convert_l4_to_mtl_simplified, convert_l4_to_mtl, get_lanelets_for_obstacle
-from mtl_converter.L7_converter import convert_l7_to_mtl_simplified, convert_l7_to_mtl, extract_ego_positions, get_ego_lanelets_in_interval
-from mtl_converter.safety_metrics import process_single_scenario
-from preprocessing.extract_trajectories import dynamic_obstacles_with_lanelets, extract_ego_trajectory, extract_every_nth_timestep
-from preprocessing.layermodel import extract_important_information, assign_layers
-from preprocessing.plot import lanelets_to_polygons
-from preprocessing.xml2json import convert_single_xml_to_json
-from scenario_modification.modify_scenario import modify_scenario
+from mtl_converter.obstacle_screening import screen_obstacles, select_obstacles
+from mtl_converter.L7_converter import extract_ego_positions, get_ego_lanelets_in_interval
+from preprocessing.layermodel import assign_layers
+from preprocessing.scenario_analysis import ScenarioAnalysis
+from preprocessing.scenario_model import ScenarioModel
+from scenario_modification.modify_scenario import modify_scenario, modify_scenario_candidates
+from scenario_modification.select_candidate import apply_best_candidate
 from scenario_modification.update_xml import parse_obstacle_data, update_xml_scenario
 from output_analysis import visualize_dynamic_obstacles_with_time
+from tracing import Tracer, PROFILERS, set_tracer, span, start_span
 from pathlib import Path
 
 def main():
@@ -24,21 +29,62 @@ def main():
                        help='OPTIONAL: Maximum number of iterations (default: 3)')
     parser.add_argument('-v', '--visualize', type=bool, required=False, default=False,
                        help='OPTIONAL: Visualize the dynamic obstacle trajectories before and after modification (default: False)')
+    parser.add_argument('-j', '--dump_json', action='store_true',
+                       help='OPTIONAL: Also write the parsed scenario JSON to data/json_scenarios for debugging (default: False)')
+    parser.add_argument('-k', '--candidates', type=int, required=False, default=1,
+                       help='OPTIONAL: Number of modifications requested concurrently per iteration, the feasible one with the lowest TTC is kept (default: 1)')
+    parser.add_argument('-r', '--ranker', type=str, required=False, default="llm", choices=RANKERS,
+                       help='OPTIONAL: How the critical obstacles are chosen: by the LLM, locally from TTC, distance and shared lanelets, or locally preselected and chosen by the LLM (default: llm)')
+    parser.add_argument('-d', '--interval_detector', type=str, required=False, default="llm", choices=INTERVAL_DETECTORS,
+                       help='OPTIONAL: How the critical interval is found: by the LLM, locally from the relative metrics, or locally with the LLM breaking ties (default: llm)')
+    parser.add_argument('-p', '--top_k', type=int, required=False, default=None,
+                       help='OPTIONAL: Only describe the K most relevant obstacles (by TTC, lanelet overlap and distance to the ego vehicle) when asking for the critical obstacles (default: all obstacles)')
+    parser.add_argument('-i', '--save_intermediates', action='store_true',
+                       help='OPTIONAL: Write the obstacle trajectories and relative metrics to data/obstacles, data/scenarios and data/outputs (default: False)')
+    parser.add_argument('-c', '--cache', type=str, required=False, default=None,
+                       help='OPTIONAL: SQLite file to cache LLM responses in, e.g. data/llm_cache.sqlite (default: LLM_CACHE_PATH or no cache)')
+    parser.add_argument('--cache_bypass', action='store_true',
+                       help='OPTIONAL: Do not answer from the LLM cache, only refresh it (default: False)')
+    parser.add_argument('-l', '--call_log', type=str, required=False, default=None,
+                       help='OPTIONAL: JSONL or SQLite (.sqlite) file to record the tokens and latency of every LLM call in, e.g. data/llm_calls.jsonl (default: LLM_CALL_LOG or none)')
+    parser.add_argument('-t', '--trace', type=str, required=False, default=None,
+                       help='OPTIONAL: JSONL file to append the duration, bytes and memory (process peak RSS and its growth) of every pipeline stage to, e.g. data/trace.jsonl (default: TRACE_FILE or no tracing)')
+    parser.add_argument('--profile', type=str, required=False, default=None, choices=PROFILERS,
+                       help='OPTIONAL: Also profile every traced stage into profiles/ next to the trace file (default: TRACE_PROFILE or no profiling)')
     
     args = parser.parse_args()
     scenario_name = args.scenario
-    num_iterations = args.num_iterations
     file = f'data/scenarios/{scenario_name}.xml'
-    ego_trajectory_file = f"data/ego_trajectories/ego_trajectory_{scenario_name}.csv"
-    modified_scenario = helper(file, scenario_name, ego_trajectory_file, num_iterations=num_iterations)
-    print(f"Modified scenario: {modified_scenario}")
+    cache = None
+    if args.cache:
+        cache = ResponseCache(args.cache, bypass=args.cache_bypass)
+        set_response_cache(cache)
+    if args.call_log:
+        set_call_log(CallLog(args.call_log))
+    if args.trace:
+        set_tracer(Tracer(args.trace, args.profile))
+    modified_scenario = run_scenario(scenario_name, num_iterations=args.num_iterations, dump_json=args.dump_json, save_intermediates=args.save_intermediates, num_candidates=args.candidates, top_k=args.top_k, ranker=args.ranker, interval_detector=args.interval_detector)
+    if cache is not None:
+        print(f"LLM cache: {cache.stats()}")
 
     if args.visualize:
         # Visualize the dynamic obstacles before and after modification
         visualize_dynamic_obstacles(file, scenario_name)
         visualize_dynamic_obstacles(modified_scenario, "updated_scenario")
 
-def helper(scenario_filepath: str, scenario_name: str, ego_trajectory_filepath: str, previous_failed_reason: str = None, num_iterations: int = 3, n: int = 1):
+def run_scenario(scenario_name: str, num_iterations: int = 3, dump_json: bool = False, scenario_filepath: str = None, ego_trajectory_filepath: str = None, save_intermediates: bool = False, num_candidates: int = 1, top_k: int = None, ranker: str = "llm", interval_detector: str = "llm") -> str:
+    """
+    Analyse and modify one scenario. updated_scenario.xml (and the intermediate files with save_intermediates) are written
+    relative to the current working directory. Returns the path of the resulting scenario.
+    """
+    scenario_filepath = scenario_filepath or f'data/scenarios/{scenario_name}.xml'
+    ego_trajectory_filepath = ego_trajectory_filepath or f"data/ego_trajectories/ego_trajectory_{scenario_name}.csv"
+    with span("scenario", profile=False, scenario=scenario_name), call_context(scenario=scenario_name):
+        modified_scenario = helper(scenario_filepath, scenario_name, ego_trajectory_filepath, num_iterations=num_iterations, dump_json=dump_json, save_intermediates=save_intermediates, num_candidates=num_candidates, top_k=top_k, ranker=ranker, interval_detector=interval_detector)
+    print(f"Modified scenario: {modified_scenario}")
+    return modified_scenario
+
+def helper(scenario_filepath: str, scenario_name: str, ego_trajectory_filepath: str, previous_failed_reason: str = None, num_iterations: int = 3, n: int = 1, dump_json: bool = False, analysis: ScenarioAnalysis = None, save_intermediates: bool = False, num_candidates: int = 1, top_k: int = None, ranker: str = "llm", interval_detector: str = "llm"):
     # Termination condition: maximum recursion depth = 3
     print(f"num_iterations: {num_iterations}")
     if n > num_iterations:
@@ -46,50 +92,76 @@ def helper(scenario_filepath: str, scenario_name: str, ego_trajectory_filepath:
         
     print(f"Running modification for the {n}th time")
     interrupt = False
+    # Span of this recursion depth, closed before recursing into the next one
+    iteration_span = start_span("iteration", profile=False, iteration=n)
+    iteration_error = None
     try:
-        convert_single_xml_to_json(scenario_filepath, 'data/json_scenarios')
-        information_dict = extract_important_information(f'data/json_scenarios/{scenario_name}.json')
-
-        layers = assign_layers(information_dict)
+        # The previous iteration's analysis is patched incrementally and reused for the same file
+        if analysis is None or analysis.scenario_filepath != scenario_filepath:
+            with span("analysis", profile=False):
+                analysis = ScenarioAnalysis(scenario_filepath, scenario_name, ego_trajectory_filepath, dump_json, save_intermediates)
 
         # Extract individual layers
-        L1 = layers["L1_RoadLevel"]
-        L4 = layers["L4_MovableObjects"]
+        L1 = analysis.L1
+        L4 = analysis.L4
         # ego layer
-        L7 = extract_ego_trajectory(ego_trajectory_filepath)
+        L7 = analysis.L7
+        # spatial index shared by all lanelet lookups
+        lanelet_index = analysis.lanelet_index
+        # cached lanelet occupancy of the obstacles
+        timelines = analysis.timelines
 
         # convert layers to mtl
-        L4_mtl = convert_l4_to_mtl_simplified(L4, L1)
-        L7_mtl = convert_l7_to_mtl_simplified(L7, L1)
-
-        #  ==== generate the relative metrics CSV file ====
-        # generate the dynamic obstacles csv file
-        obstacle_csv_path = f'data/obstacles/{scenario_name}_dynamic_obstacles_with_lanelets.csv'
-        polygons = lanelets_to_polygons(L1)
-        dynamic_obstacles_with_lanelets(L4, polygons, obstacle_csv_path)
-        obstacles_path = f'data/obstacles/{scenario_name}_dynamic_obstacles.csv'
-        extract_every_nth_timestep(obstacle_csv_path, obstacles_path, n=1)
-
-        relative_metrics_csv_file_path = f'data/scenarios/{scenario_name}_relative_metrics.csv'
-        process_single_scenario(ego_trajectory_filepath, obstacles_path, scenario_name)
+        criticality_ranker = get_ranker(ranker)
+        screenings = obstacle_ids = None
+        if top_k or criticality_ranker.uses_screenings:
+            with span("obstacle_screening"):
+                screenings = screen_obstacles(L4, L1, analysis.relative_metrics_df, analysis.ego_timeline, lanelet_index, timelines)
+        if top_k:
+            # Screen out obstacles that can never become critical to shorten the prompt
+            obstacle_ids = select_obstacles(screenings, top_k)
+            print(f"Screened obstacles: {len(obstacle_ids)} of {len(screenings)}")
+        with span("mtl_l4_simplified") as stage:
+            L4_mtl = convert_l4_to_mtl_simplified(L4, L1, lanelet_index, timelines, obstacle_ids)
+            stage.set_bytes(L4_mtl)
+        L7_mtl = analysis.L7_mtl_simplified
+        relative_metrics = analysis.relative_metrics
         
         # LLM Step 1: find the critical obstacles
         print(f"L4_mtl: {L4_mtl}")
         print(f"L7_mtl: {L7_mtl}")
-        critical_obstacles = find_critical_obstacles(L4_mtl, L7_mtl)
-        step_one_result = parse_critical_obstacles_output(critical_obstacles)
+        with span("critical_obstacles", ranker=ranker):
+            step_one_result = criticality_ranker.rank(
+                L4_mtl, L7_mtl, screenings,
+                lambda ids: convert_l4_to_mtl_simplified(L4, L1, lanelet_index, timelines, ids))
         print(f"Critical obstacles: {step_one_result.critical_obstacle_ids}")
         
         # LLM Step 2: find the critical interval
-        ego_positions = extract_ego_positions(L7)
-        L4_mtl, L4_lanelets_mentioned = convert_l4_to_mtl(L4, L1, step_one_result.critical_obstacle_ids, ego_positions, relative_metrics_csv_file_path)
-        L7_mtl, L7_lanelets_mentioned = convert_l7_to_mtl(L7, L1)
-        L1_mtl = convert_l1_to_mtl(L1, list(L4_lanelets_mentioned) + list(L7_lanelets_mentioned))
+        def ask_critical_interval():
+            ego_positions = extract_ego_positions(L7)
+            with span("mtl_l4") as stage:
+                L4_mtl, L4_lanelets_mentioned = convert_l4_to_mtl(L4, L1, step_one_result.critical_obstacle_ids, ego_positions, relative_metrics, lanelet_index, timelines)
+                stage.set_bytes(L4_mtl)
+            L7_mtl, L7_lanelets_mentioned = analysis.L7_mtl, analysis.L7_lanelets_mentioned
+            with span("mtl_l1") as stage:
+                L1_mtl = convert_l1_to_mtl(L1, list(L4_lanelets_mentioned) + list(L7_lanelets_mentioned))
+                stage.set_bytes(L1_mtl)
 
-        print(f"L4_mtl: {L4_mtl}")
-        critical_interval = find_critical_interval(L7_mtl, L4_mtl, L1_mtl)
-        # Additional llm-based termination condition when a scenario is already very critical
-        step_two_result = parse_critical_interval_output(critical_interval)
+            print(f"L4_mtl: {L4_mtl}")
+            with span("llm_critical_interval") as stage:
+                critical_interval = find_critical_interval(L7_mtl, L4_mtl, L1_mtl)
+                stage.set_bytes(critical_interval or "")
+            return parse_critical_interval_output(critical_interval)
+
+        if interval_detector == "llm":
+            step_two_result = ask_critical_interval()
+        else:
+            # Computed from the relative metrics, the LLM is only asked on equally critical windows
+            with span("critical_interval", detector=interval_detector):
+                step_two_result = find_critical_interval_local(
+                    step_one_result.critical_obstacle_ids, relative_metrics, L4, lanelet_index, timelines, analysis.ego_timeline,
+                    tie_breaker=ask_critical_interval if interval_detector == "local+llm" else None)
+        # Additional termination condition when a scenario is already very critical
         if step_two_result.has_collision:
             print("Interrupt signal received. Returning current scenario.")
             interrupt = True
@@ -101,23 +173,45 @@ def helper(scenario_filepath: str, scenario_name: str, ego_trajectory_filepath:
         # LLM Step 3: Modify the scenario
         start_time = step_two_result.critical_interval.start_time
         end_time = step_two_result.critical_interval.end_time
-        dynamic_obstacle_lanelets = get_lanelets_for_obstacle(L4, L1, step_two_result.critical_obstacle_id, start_time, end_time)
-        ego_lanelets = get_ego_lanelets_in_interval(L7, L1, start_time, end_time)
-        altered_obstacle_data = modify_scenario(step_two_result, L1,  L4, L7, ego_lanelets, dynamic_obstacle_lanelets, previous_failed_reason)
-        parsed_obstacle_data = parse_obstacle_data(altered_obstacle_data)
-        print(f"Parsed obstacle data: {parsed_obstacle_data}")
-        update_xml_scenario(scenario_filepath, step_two_result.critical_obstacle_id, parsed_obstacle_data, "updated_scenario.xml", L1)
+        dynamic_obstacle_lanelets = get_lanelets_for_obstacle(L4, L1, step_two_result.critical_obstacle_id, start_time, end_time, lanelet_index, timelines)
+        ego_lanelets = get_ego_lanelets_in_interval(L7, L1, start_time, end_time, lanelet_index, analysis.ego_timeline)
+        if num_candidates > 1:
+            # Several modifications at once, the feasible one with the lowest TTC is kept
+            with span("llm_modification", candidates=num_candidates) as stage:
+                candidates = modify_scenario_candidates(step_two_result, L1, L4, L7, ego_lanelets, dynamic_obstacle_lanelets, previous_failed_reason, num_candidates)
+                stage.set_bytes([candidate or "" for candidate in candidates])
+            with span("xml_update") as stage:
+                updated_obstacle = apply_best_candidate(candidates, scenario_filepath, step_two_result.critical_obstacle_id, "updated_scenario.xml", analysis.modified_min_ttc, L1, lanelet_index)
+                stage.bytes = os.path.getsize("updated_scenario.xml")
+        else:
+            with span("llm_modification") as stage:
+                altered_obstacle_data = modify_scenario(step_two_result, L1,  L4, L7, ego_lanelets, dynamic_obstacle_lanelets, previous_failed_reason)
+                stage.set_bytes(altered_obstacle_data or "")
+            with span("xml_update") as stage:
+                parsed_obstacle_data = parse_obstacle_data(altered_obstacle_data)
+                print(f"Parsed obstacle data: {parsed_obstacle_data}")
+                updated_obstacle = update_xml_scenario(scenario_filepath, step_two_result.critical_obstacle_id, parsed_obstacle_data, "updated_scenario.xml", L1, lanelet_index)
+                stage.bytes = os.path.getsize("updated_scenario.xml")
 
         scenario_name = "updated_scenario"
         output_file = f'updated_scenario.xml'
+        try:
+            with span("analysis_update"):
+                analysis.update_obstacle(updated_obstacle, output_file, scenario_name)
+        except Exception as e:
+            # the next iteration analyses the updated file from scratch
+            print(f"Incremental update failed - Reanalysing: {e}")
+            analysis = None
 
     except Exception as e:
         print(f"Error occurred - Retrying: {e}")
         output_file = scenario_filepath
         # flow prompting loop with meta knowledge
         previous_failed_reason = e
+        iteration_error = e
 
     finally:
+        iteration_span.finish(iteration_error)
         if interrupt:
             return scenario_filepath
         updated_n = n + 1 
@@ -127,11 +221,17 @@ def helper(scenario_filepath: str, scenario_name: str, ego_trajectory_filepath:
             ego_trajectory_filepath=ego_trajectory_filepath,
             n=updated_n,
             previous_failed_reason=previous_failed_reason,
-            num_iterations=num_iterations)
+            num_iterations=num_iterations,
+            dump_json=dump_json,
+            analysis=analysis,
+            save_intermediates=save_intermediates,
+            num_candidates=num_candidates,
+            top_k=top_k,
+            ranker=ranker,
+            interval_detector=interval_detector)
 
 def visualize_dynamic_obstacles(scenario_filepath: str, scenario_name: str):
-    convert_single_xml_to_json(scenario_filepath, 'data/json_scenarios')
-    information_dict = extract_important_information(f'data/json_scenarios/{scenario_name}.json')
+    information_dict = ScenarioModel.from_xml(scenario_filepath)
     layers = assign_layers(information_dict)
     L4 = layers["L4_MovableObjects"]
     visualize_dynamic_obstacles_with_time(L4, show_plot=True)
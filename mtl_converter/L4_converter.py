@@ -1,94 +1,57 @@
 # requires L1 for lanelet information
 import math
-from mtl_converter.L4_safety_metrics import TTC_Evaluation, time_to_collision
-from mtl_converter.utils import is_within_lanelet
+from mtl_converter.L4_safety_metrics import RelativeMetricsTable
+from mtl_converter.occupancy_timeline import obstacle_timeline
+from mtl_converter.utils import LaneletIndex
 
-def convert_l4_to_mtl(L4: dict, L1: dict, critical_obstacles: list[str], ego_positions: list[dict], relative_metrics_csv_file_path: str) -> tuple[list[str], set[str]]:
+def convert_l4_to_mtl(L4: dict, L1: dict, critical_obstacles: list[str], ego_positions: list[dict], relative_metrics: RelativeMetricsTable, lanelet_index: LaneletIndex = None, timelines: dict = None) -> tuple[list[str], set[str]]:
 
     """
     Convert Layer 4 (dynamic obstacles) scenario to MTL scenario
+    timelines optionally maps obstacle ids to their cached OccupancyTimeline
     Returns tuple containing:
     - List of MTL formulas
     - Set of all mentioned lanelet IDs
     """
     movable_objects_mtl = []
     lanelets_mentioned = set()
+    lanelet_index = lanelet_index or LaneletIndex(L1)
 
     for dynamic_obstacle in [x for x in L4['dynamicObstacle'] if x['id'] in critical_obstacles]:
-        current_lanelet = None
-        start_time = 0
-        
-        # Find first lanelet before starting the loop
-        first_position = dynamic_obstacle['trajectory'][0]['position']
-        for lanelet in L1['lanelet']:
-            if is_within_lanelet(first_position, lanelet):
-                current_lanelet = lanelet['id']
-                break
-        
-        for idx, timestamp in enumerate(dynamic_obstacle['trajectory']):
-            position = timestamp['position']
-            
-            time = timestamp['time']
-            found_lanelet = None
-            
-            # Find current lanelet
-            for lanelet in L1['lanelet']:
-                if is_within_lanelet(position, lanelet):
-                    found_lanelet = lanelet['id']
-                    break
-
-            if found_lanelet != current_lanelet:
-                if current_lanelet is not None:  # Only output if we had a valid lanelet
-                    movable_objects_mtl.append(f"G_[{start_time}, {time}]: occupy({dynamic_obstacle['id']}, {current_lanelet})")
-                    lanelets_mentioned.add(current_lanelet)
+        segments = obstacle_timeline(dynamic_obstacle, lanelet_index, timelines).segments
+        ttc_index = relative_metrics.ttc_index(float(dynamic_obstacle['id']))
+
+        for idx, segment in enumerate(segments):
+            current_lanelet = segment.lanelet
+            if current_lanelet is None:  # Only output if we had a valid lanelet
+                continue
+            # The first interval starts at 0, every later one when the obstacle enters the lanelet
+            start_time = 0 if idx == 0 else segment.start_time
+            time = segment.end_time
+            position = dynamic_obstacle['trajectory'][segment.end_state]['position']
 
-                    # Calculate minimum TTC for the entire duration in the lanelet
-                    min_ttc = math.inf, math.inf # long, lat
-                    min_ttc_timestamp = start_time
-                    min_distance = math.inf
-
-                    for t in range(int(start_time), int(time) + 1):
-                        ttc_evaluation: TTC_Evaluation = time_to_collision(timestamp=float(t),
-                                                      obstacle_id=float(dynamic_obstacle['id']), 
-                                                      csv_file_path=relative_metrics_csv_file_path)
-                        current_ttc_long, current_ttc_lat = ttc_evaluation.ttc_long, ttc_evaluation.ttc_lat
-                        current_distance = euclidean_distance(position, ego_positions[int(t)]) if not int(t) >= len(ego_positions) else math.inf
-
-                        if (current_ttc_long < 10 and current_ttc_lat < 10):
-                            min_ttc = current_ttc_long, current_ttc_lat
-                            min_ttc_timestamp = t
-                            min_distance = current_distance
-                    distance = euclidean_distance(position, ego_positions[int(min_ttc_timestamp)]) if not int(min_ttc_timestamp) >= len(ego_positions) else math.inf
-                    if min_ttc[0] != math.inf:
-                        movable_objects_mtl.append(f"F[{start_time}, {time}]: min_TTC_longitudinal = {min_ttc[0]}s AND min_TTC_lateral = {min_ttc[1]}s AND DTC = {distance}m")
-                
-                current_lanelet = found_lanelet
-                start_time = time
-
-        # Add the final lanelet occupation
-        if current_lanelet is not None:
             movable_objects_mtl.append(f"G_[{start_time}, {time}]: occupy({dynamic_obstacle['id']}, {current_lanelet})")
             lanelets_mentioned.add(current_lanelet)
-            
-            # Calculate minimum TTC for the final lanelet
+
+            # Calculate minimum TTC for the entire duration in the lanelet
             min_ttc = math.inf, math.inf # long, lat
             min_ttc_timestamp = start_time
-            min_distance = math.inf
 
-            for t in range(int(start_time), int(time) + 1):
-                ttc_evaluation: TTC_Evaluation = time_to_collision(timestamp=float(t),
-                                                obstacle_id=float(dynamic_obstacle['id']), 
-                                                csv_file_path=relative_metrics_csv_file_path)
-                direction_type = ttc_evaluation.direction_type
-                current_ttc_long, current_ttc_lat = ttc_evaluation.ttc_long, ttc_evaluation.ttc_lat
-                current_distance = euclidean_distance(position, ego_positions[int(t)]) if not int(t) >= len(ego_positions) else math.inf
+            if idx < len(segments) - 1:
+                # last timestep in the lanelet at which both TTCs are below 10s
+                hit = ttc_index.last_below(10, int(start_time), int(time))
+                if hit is not None:
+                    min_ttc_timestamp, *min_ttc = hit
+            else:
+                # Calculate minimum TTC for the final lanelet: the smallest sum of both TTCs below 1s,
+                # on ties the timestep closest to the ego vehicle
+                candidates = ttc_index.argmin_below(1, int(start_time), int(time))
+                if candidates:
+                    min_ttc_timestamp, *min_ttc = min(
+                        candidates,
+                        key=lambda candidate: euclidean_distance(position, ego_positions[candidate[0]]) if not candidate[0] >= len(ego_positions) else math.inf
+                    )
 
-                if (current_ttc_long < 1 and current_ttc_lat < 1) and (current_ttc_long + current_ttc_lat < min_ttc[0] + min_ttc[1] 
-                                                or (current_ttc_long + current_ttc_lat == min_ttc[0] + min_ttc[1] and current_distance < min_distance)):
-                    min_ttc = current_ttc_long, current_ttc_lat
-                    min_ttc_timestamp = t
-                    min_distance = current_distance
-                
             distance = euclidean_distance(position, ego_positions[int(min_ttc_timestamp)]) if not int(min_ttc_timestamp) >= len(ego_positions) else math.inf
             if min_ttc[0] != math.inf:
                 movable_objects_mtl.append(f"F[{start_time}, {time}]: min_TTC_longitudinal = {min_ttc[0]}s AND min_TTC_lateral = {min_ttc[1]}s AND DTC = {distance}m")
@@ -99,35 +62,23 @@ def euclidean_distance(pos1: dict, pos2: dict) -> float:
     """Calculate Euclidean distance between two positions"""
     return ((float(pos1['x']) - float(pos2['x']))**2 + (float(pos1['y']) - float(pos2['y']))**2)**0.5
 
-def convert_l4_to_mtl_simplified(L4: dict, L1: dict) -> list[str]:
+def convert_l4_to_mtl_simplified(L4: dict, L1: dict, lanelet_index: LaneletIndex = None, timelines: dict = None, obstacle_ids: list[str] = None) -> list[str]:
     """
     Convert Layer 4 (dynamic obstacles) scenario to simplified MTL summary
+    timelines optionally maps obstacle ids to their cached OccupancyTimeline
+    obstacle_ids optionally restricts the summary to these obstacles (e.g. from obstacle_screening.select_obstacles)
     """
     obstacle_summaries = []
-    
+    lanelet_index = lanelet_index or LaneletIndex(L1)
+    selected = set(obstacle_ids) if obstacle_ids is not None else None
+
     for obstacle in L4.get('dynamicObstacle', []):
-        current_lanelet = None
-        intervals = []
-        start_time = None
-        
-        for state in obstacle['trajectory']:
-            time = state['time']
-            position = state['position']
-            
-            # Find current lanelet
-            found_lanelet = next((l['id'] for l in L1['lanelet'] if is_within_lanelet(position, l)), None)
+        if selected is not None and obstacle['id'] not in selected:
+            continue
+        # One interval per lanelet occupied, off-road segments are left out
+        segments = [segment for segment in obstacle_timeline(obstacle, lanelet_index, timelines).segments if segment.lanelet is not None]
+        intervals = [f"G[{segment.start_time}, {segment.end_time}]: {segment.lanelet}" for segment in segments]
 
-            # Track lanelet changes
-            if found_lanelet != current_lanelet:
-                if current_lanelet is not None:  # Record previous interval
-                    intervals.append(f"G[{start_time}, {time}]: {current_lanelet}")
-                current_lanelet = found_lanelet
-                start_time = time
-        
-        # Add final interval if lanelet occupied at end
-        if current_lanelet is not None:
-            intervals.append(f"G[{start_time}, {time}]: {current_lanelet}")
-        
         # Format obstacle summary
         if intervals:
             obstacle_summaries.append(
@@ -141,7 +92,9 @@ def get_lanelets_for_obstacle(
     L1: dict,
     obstacle_id: str,
     start_time: float,
-    end_time: float
+    end_time: float,
+    lanelet_index: LaneletIndex = None,
+    timelines: dict = None
 ) -> list[int]:
     """
     Get all lanelets occupied by a specific obstacle during time interval.
@@ -152,12 +105,12 @@ def get_lanelets_for_obstacle(
         obstacle_id: Target obstacle ID to analyze
         start_time: Interval start (inclusive)
         end_time: Interval end (inclusive)
+        lanelet_index: Prebuilt index over L1 (built on demand if omitted)
+        timelines: Cached OccupancyTimeline of each obstacle by obstacle ID
     
     Returns:
         Sorted list of unique lanelet IDs occupied during interval
     """
-    occupied = set()
-    
     # Find target obstacle
     obstacle = next(
         (obs for obs in L4.get('dynamicObstacle', []) 
@@ -168,18 +121,8 @@ def get_lanelets_for_obstacle(
     if not obstacle:
         return []
     
-    # Check trajectory points in time window
-    for state in obstacle['trajectory']:
-        if start_time <= int(state['time']) <= end_time:
-            lanelet_id = next(
-                (l['id'] for l in L1['lanelet'] 
-                 if is_within_lanelet(state['position'], l)),
-                None
-            )
-            if lanelet_id:
-                occupied.add(lanelet_id)
-    
-    return occupied
+    lanelet_index = lanelet_index or LaneletIndex(L1)
+    return obstacle_timeline(obstacle, lanelet_index, timelines).lanelets_between(start_time, end_time)
 
 def calculate_ttb(obstacle_velocity: float, max_deceleration: float = 7.0) -> float:
     """
@@ -1,5 +1,6 @@
-import csv
 import math
+import numpy as np
+import pandas as pd
 
 LATERAL = "lateral"
 LONGITUDINAL = "longitudinal"
@@ -11,33 +12,229 @@ class TTC_Evaluation:
         self.ttc_lat = ttc_lat
         self.direction = direction
 
-def time_to_collision(timestamp: float, obstacle_id: float, csv_file_path: str) -> TTC_Evaluation:
-    # Allow slight floating point tolerance
-    EPSILON = 1e-3
-    
-    with open(csv_file_path, 'r') as f:
-        reader = csv.DictReader(f)
-        
-        for row in reader:
-            # Match row with floating point tolerance
-            if (abs(float(row['timestep']) - timestamp) < EPSILON and
-                abs(float(row['obstacle_id']) - obstacle_id) < EPSILON):
-                
-                direction = row['motion_description']
-                longitudinal_direction_type = direction.split('.')[0]
-                lateral_direction_type = direction.split('.')[1]
-                # Get TTC values from CSV columns
-                try:
-                    ttc_long = float(row['ttc_long']) if "toward" in longitudinal_direction_type or "alignment" in longitudinal_direction_type else math.inf
-                    ttc_lat = float(row['ttc_lat']) if "toward" in lateral_direction_type or "alignment" in lateral_direction_type else math.inf
-                except ValueError:
-                    return TTC_Evaluation(LATERAL, ttc_long, ttc_lat, direction)
-                
-                # Find minimum non-infinite TTC
-                if ttc_long < ttc_lat:
-                    return TTC_Evaluation(LONGITUDINAL, ttc_long, ttc_lat, direction)
-                else:
-                    return TTC_Evaluation(LATERAL, ttc_lat, ttc_long, direction)
-    
-    # No matching entry found
-    return TTC_Evaluation(LATERAL, math.inf, math.inf, "")
\ No newline at end of file
+class TTCRangeIndex:
+    """
+    Range queries over the TTC of one obstacle at integer timesteps.
+    Like in TTC_Evaluation, `first` is the smaller and `second` the larger of (ttc_long, ttc_lat).
+    - last_below: last timestep of a range where both are below a threshold, O(1) from a prefix scan
+    - argmin_below: timesteps of a range with the smallest first + second among those below a threshold,
+      O(1) range minimum from a sparse table
+    The prefix scans and sparse tables are built once per threshold.
+    """
+    def __init__(self, timesteps: np.ndarray, ttc_long: np.ndarray, ttc_lat: np.ndarray):
+        # TTC_Evaluation is only ever looked up at integer timesteps
+        integral = timesteps == np.floor(timesteps)
+        self.timesteps = timesteps[integral]
+        ttc_long, ttc_lat = ttc_long[integral], ttc_lat[integral]
+        longitudinal = ttc_long < ttc_lat
+        self.first = np.where(longitudinal, ttc_long, ttc_lat)
+        self.second = np.where(longitudinal, ttc_lat, ttc_long)
+        self._last_below = {}
+        self._sparse_tables = {}
+
+    def _range(self, start_time: int, end_time: int) -> tuple[int, int]:
+        lo = np.searchsorted(self.timesteps, start_time, side='left')
+        hi = np.searchsorted(self.timesteps, end_time, side='right')
+        return int(lo), int(hi)
+
+    def _below(self, threshold: float) -> np.ndarray:
+        return (self.first < threshold) & (self.second < threshold)
+
+    def _entry(self, position: int) -> tuple[int, float, float]:
+        return int(self.timesteps[position]), float(self.first[position]), float(self.second[position])
+
+    def last_below(self, threshold: float, start_time: int, end_time: int):
+        """
+        (timestep, first, second) of the last timestep in [start_time, end_time] where both TTCs are below threshold, or None
+        """
+        if threshold not in self._last_below:
+            positions = np.where(self._below(threshold), np.arange(len(self.timesteps)), -1)
+            self._last_below[threshold] = np.maximum.accumulate(positions) if len(positions) else positions
+        lo, hi = self._range(start_time, end_time)
+        if lo >= hi:
+            return None
+        position = self._last_below[threshold][hi - 1]
+        return self._entry(position) if position >= lo else None
+
+    def argmin_below(self, threshold: float, start_time: int, end_time: int) -> list[tuple[int, float, float]]:
+        """
+        (timestep, first, second) of all timesteps in [start_time, end_time] where both TTCs are below threshold
+        and first + second is minimal, in time order
+        """
+        if threshold not in self._sparse_tables:
+            # level k holds the minimum of the 2^k sums starting at each position
+            level = np.where(self._below(threshold), self.first + self.second, math.inf)
+            levels = [level]
+            while 2 ** len(levels) <= len(level):
+                half = 2 ** (len(levels) - 1)
+                levels.append(np.minimum(levels[-1][:-half], levels[-1][half:]))
+            self._sparse_tables[threshold] = levels
+        levels = self._sparse_tables[threshold]
+        lo, hi = self._range(start_time, end_time)
+        if lo >= hi:
+            return []
+        k = (hi - lo).bit_length() - 1
+        minimum = min(levels[k][lo], levels[k][hi - 2 ** k])
+        if minimum == math.inf:
+            return []
+        return [self._entry(lo + offset) for offset in np.flatnonzero(levels[0][lo:hi] == minimum)]
+
+class RelativeMetricsTable:
+    """
+    In-memory relative metrics of one scenario, indexed by (timestep, obstacle_id).
+
+    Built once from the DataFrame returned by process_single_scenario, so TTC lookups
+    are dictionary hits instead of a scan over the *_relative_metrics file.
+    """
+    # Allow slight floating point tolerance when matching timesteps and obstacle ids
+    KEY_DECIMALS = 3
+
+    def __init__(self, metrics_df: pd.DataFrame):
+        self._index = {}
+        self._obstacles = {}
+        self._distances = {}
+        self._ttc_indexes = {}
+        if metrics_df is None or metrics_df.empty:
+            return
+
+        # the CSV scan returned the first matching row, keep the same row on duplicates
+        timesteps = metrics_df['timestep'].astype(float).round(self.KEY_DECIMALS)
+        obstacle_ids = metrics_df['obstacle_id'].astype(float).round(self.KEY_DECIMALS)
+        df = metrics_df.assign(timestep=timesteps, obstacle_id=obstacle_ids)
+        df = df.drop_duplicates(subset=['timestep', 'obstacle_id'], keep='first')
+
+        df = self._effective_ttc(df)
+        for timestep, obstacle_id, long_value, lat_value, direction in zip(
+            df['timestep'].tolist(), df['obstacle_id'].tolist(), df['ttc_long'].tolist(), df['ttc_lat'].tolist(), df['motion_description'].tolist()
+        ):
+            self._index[(timestep, obstacle_id)] = (long_value, lat_value, direction)
+
+        # Per obstacle arrays sorted by timestep for range queries
+        df = df.sort_values(by=['obstacle_id', 'timestep'], kind='stable')
+        for obstacle_id, group in df.groupby('obstacle_id', sort=False):
+            self._obstacles[obstacle_id] = (
+                group['timestep'].to_numpy(dtype=float),
+                group['ttc_long'].to_numpy(dtype=float, copy=True),
+                group['ttc_lat'].to_numpy(dtype=float, copy=True),
+            )
+            self._distances[obstacle_id] = self._distance(group)
+
+    @staticmethod
+    def _effective_ttc(df: pd.DataFrame) -> pd.DataFrame:
+        # Only TTC values of approaching or aligned obstacles are relevant, the others are infinite
+        directions = df['motion_description'].fillna("").astype(str)
+        parts = directions.str.split('.')
+        longitudinal_type = parts.str[0].fillna("")
+        lateral_type = parts.str[1].fillna("")
+        relevant_long = longitudinal_type.str.contains("toward") | longitudinal_type.str.contains("alignment")
+        relevant_lat = lateral_type.str.contains("toward") | lateral_type.str.contains("alignment")
+        return df.assign(
+            ttc_long=np.where(relevant_long, df['ttc_long'].astype(float), math.inf),
+            ttc_lat=np.where(relevant_lat, df['ttc_lat'].astype(float), math.inf),
+            motion_description=directions
+        )
+
+    @staticmethod
+    def _distance(df: pd.DataFrame) -> np.ndarray:
+        # Distance between the bounding boxes of the ego vehicle and the obstacle
+        return np.hypot(df['adjusted_d_long'].to_numpy(dtype=float), df['adjusted_d_lat'].to_numpy(dtype=float))
+
+    @classmethod
+    def from_csv(cls, csv_file_path: str) -> "RelativeMetricsTable":
+        # any trajectory storage format, chosen by the file extension
+        from preprocessing.extract_trajectories import read_trajectory_table
+        return cls(read_trajectory_table(csv_file_path))
+
+    def update(self, metrics_df: pd.DataFrame):
+        """
+        Replace the entries of already indexed (timestep, obstacle_id) pairs with recomputed rows
+        """
+        if metrics_df is None or metrics_df.empty:
+            return
+        df = metrics_df.assign(
+            timestep=metrics_df['timestep'].astype(float).round(self.KEY_DECIMALS),
+            obstacle_id=metrics_df['obstacle_id'].astype(float).round(self.KEY_DECIMALS)
+        ).drop_duplicates(subset=['timestep', 'obstacle_id'], keep='first')
+        df = self._effective_ttc(df)
+        keys = list(zip(df['timestep'].tolist(), df['obstacle_id'].tolist()))
+        missing = [key for key in keys if key not in self._index]
+        if missing:
+            raise KeyError(f"No relative metrics for (timestep, obstacle_id) {missing[0]}")
+        for (timestep, obstacle_id), long_value, lat_value, direction, distance in zip(
+            keys, df['ttc_long'].tolist(), df['ttc_lat'].tolist(), df['motion_description'].tolist(), self._distance(df).tolist()
+        ):
+            self._index[(timestep, obstacle_id)] = (long_value, lat_value, direction)
+            timesteps, ttc_long, ttc_lat = self._obstacles[obstacle_id]
+            position = np.searchsorted(timesteps, timestep)
+            ttc_long[position] = long_value
+            ttc_lat[position] = lat_value
+            self._distances[obstacle_id][position] = distance
+            self._ttc_indexes.pop(obstacle_id, None)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _key(self, timestep: float, obstacle_id: float) -> tuple[float, float]:
+        return round(float(timestep), self.KEY_DECIMALS), round(float(obstacle_id), self.KEY_DECIMALS)
+
+    def lookup(self, timestep: float, obstacle_id: float) -> TTC_Evaluation:
+        """
+        TTC evaluation of one obstacle at one timestep
+        """
+        entry = self._index.get(self._key(timestep, obstacle_id))
+        if entry is None:
+            # No matching entry found
+            return TTC_Evaluation(LATERAL, math.inf, math.inf, "")
+
+        ttc_long, ttc_lat, direction = entry
+        # Find minimum non-infinite TTC
+        if ttc_long < ttc_lat:
+            return TTC_Evaluation(LONGITUDINAL, ttc_long, ttc_lat, direction)
+        else:
+            return TTC_Evaluation(LATERAL, ttc_lat, ttc_long, direction)
+
+    def ttc_range(self, obstacle_id: float, start_time: float, end_time: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Timesteps, longitudinal and lateral TTC of an obstacle in [start_time, end_time] (inclusive)
+        """
+        obstacle_key = round(float(obstacle_id), self.KEY_DECIMALS)
+        if obstacle_key not in self._obstacles:
+            empty = np.empty(0, dtype=float)
+            return empty, empty, empty
+
+        timesteps, ttc_long, ttc_lat = self._obstacles[obstacle_key]
+        lo = np.searchsorted(timesteps, round(float(start_time), self.KEY_DECIMALS), side='left')
+        hi = np.searchsorted(timesteps, round(float(end_time), self.KEY_DECIMALS), side='right')
+        return timesteps[lo:hi], ttc_long[lo:hi], ttc_lat[lo:hi]
+
+    def min_ttc(self, obstacle_id: float, start_time: float, end_time: float) -> float:
+        """
+        Minimum TTC (longitudinal or lateral) of an obstacle in [start_time, end_time] (inclusive)
+        """
+        _, ttc_long, ttc_lat = self.ttc_range(obstacle_id, start_time, end_time)
+        if ttc_long.size == 0:
+            return math.inf
+        return float(np.minimum(ttc_long, ttc_lat).min())
+
+    def obstacle_metrics(self, obstacle_id: float) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Timesteps, longitudinal and lateral TTC and distance to the ego vehicle of an obstacle, sorted by timestep
+        """
+        obstacle_key = round(float(obstacle_id), self.KEY_DECIMALS)
+        if obstacle_key not in self._obstacles:
+            empty = np.empty(0, dtype=float)
+            return empty, empty, empty, empty
+        return (*self._obstacles[obstacle_key], self._distances[obstacle_key])
+
+    def ttc_index(self, obstacle_id: float) -> TTCRangeIndex:
+        """
+        Range query structure over the TTC of an obstacle, built on first use
+        """
+        obstacle_key = round(float(obstacle_id), self.KEY_DECIMALS)
+        if obstacle_key not in self._ttc_indexes:
+            empty = np.empty(0, dtype=float)
+            self._ttc_indexes[obstacle_key] = TTCRangeIndex(*self._obstacles.get(obstacle_key, (empty, empty, empty)))
+        return self._ttc_indexes[obstacle_key]
+
+def time_to_collision(timestamp: float, obstacle_id: float, relative_metrics: RelativeMetricsTable) -> TTC_Evaluation:
+    return relative_metrics.lookup(timestamp, obstacle_id)
@@ -1,73 +1,39 @@
-from mtl_converter.utils import is_within_lanelet
+from mtl_converter.occupancy_timeline import OccupancyTimeline
+from mtl_converter.utils import LaneletIndex
 
-def convert_l7_to_mtl(L7: dict, L1: dict) -> tuple[list[str], set[str]]:
+def _ego_timeline(L7: dict, L1: dict, lanelet_index: LaneletIndex = None, timeline: OccupancyTimeline = None) -> OccupancyTimeline:
+    if timeline is not None:
+        return timeline
+    return OccupancyTimeline.for_ego(L7, lanelet_index or LaneletIndex(L1))
+
+def convert_l7_to_mtl(L7: dict, L1: dict, lanelet_index: LaneletIndex = None, timeline: OccupancyTimeline = None) -> tuple[list[str], set[str]]:
     """
     Convert Layer 7 (Ego Layer) scenario to MTL scenario
+    timeline optionally is the cached OccupancyTimeline of the ego vehicle
     Returns tuple containing:
     - List of MTL formulas
     - Set of all mentioned lanelet IDs
     """
     ego_mtl = []
     lanelets_mentioned = set()
-    current_lanelet = None
-    start_time = None
-
-    for timestamp in L7:
-        position = {'x': timestamp['x'], 'y': timestamp['y']}
-        time = timestamp['timestep']
-        found_lanelet = None
-
-        for lanelet in L1['lanelet']:
-            if is_within_lanelet(position, lanelet):
-                found_lanelet = lanelet['id']
-                break
-
-        if found_lanelet != current_lanelet:
-            if current_lanelet is not None:
-                ego_mtl.append(f"G_[{start_time}, {time}]: occupy(EGO, {current_lanelet})")
-                lanelets_mentioned.add(current_lanelet)
-                # ego_mtl.append(f"Position on lanelet entry: G_[{start_time}, {start_time}]: {position}")
-            current_lanelet = found_lanelet
-            start_time = time
 
-    if current_lanelet is not None:
-        ego_mtl.append(f"G_[{start_time}, {time}]: occupy(EGO, {current_lanelet})")
-        lanelets_mentioned.add(current_lanelet)
-        # ego_mtl.append(f"Position on lanelet exit: G_[{start_time}, {start_time}]: {position}")
+    for segment in _ego_timeline(L7, L1, lanelet_index, timeline).segments:
+        if segment.lanelet is not None:
+            ego_mtl.append(f"G_[{segment.start_time}, {segment.end_time}]: occupy(EGO, {segment.lanelet})")
+            lanelets_mentioned.add(segment.lanelet)
 
     return ego_mtl, lanelets_mentioned
 
-def convert_l7_to_mtl_simplified(L7: dict, L1: dict) -> list[str]:
+def convert_l7_to_mtl_simplified(L7: dict, L1: dict, lanelet_index: LaneletIndex = None, timeline: OccupancyTimeline = None) -> list[str]:
     """
     Convert Layer 7 (Ego Layer) scenario to MTL scenario
     """
-    ego_mtl = []
-    current_lanelet = None
-    start_time = None
-
-    for timestamp in L7:
-        position = {'x': timestamp['x'], 'y': timestamp['y']}
-        time = timestamp['timestep']
-        found_lanelet = None
-
-        for lanelet in L1['lanelet']:
-            if is_within_lanelet(position, lanelet):
-                found_lanelet = lanelet['id']
-                break
-
-        if found_lanelet != current_lanelet:
-            if current_lanelet is not None:
-                # Add the interval for the previous lanelet to the list
-                ego_mtl.append(f"G_[{start_time}, {time}]: occupy(EGO, {current_lanelet})")
-                # Add the position of the dynamic obstacle to the list
-            # Update the current lanelet, start time, and entry orientation
-            current_lanelet = found_lanelet
-            start_time = time
-
-    # Add the last interval if the obstacle was on a lanelet
-    if current_lanelet is not None:
-        ego_mtl.append(f"G_[{start_time}, {time}]: occupy(EGO, {current_lanelet})")
-    return ego_mtl
+    # One interval per lanelet the ego vehicle is on
+    return [
+        f"G_[{segment.start_time}, {segment.end_time}]: occupy(EGO, {segment.lanelet})"
+        for segment in _ego_timeline(L7, L1, lanelet_index, timeline).segments
+        if segment.lanelet is not None
+    ]
 
 def extract_ego_positions(L7: dict) -> list[dict]:
     """
@@ -83,7 +49,9 @@ def get_ego_lanelets_in_interval(
     L7: list[dict],
     L1: dict,
     start_time: float,
-    end_time: float
+    end_time: float,
+    lanelet_index: LaneletIndex = None,
+    timeline: OccupancyTimeline = None
 ) -> list[int]:
     """
     Get all lanelets occupied by ego vehicle during time interval.
@@ -93,26 +61,10 @@ def get_ego_lanelets_in_interval(
         L1: Layer 1 lanelet data
         start_time: Interval start (inclusive)
         end_time: Interval end (inclusive)
+        lanelet_index: Prebuilt index over L1 (built on demand if omitted)
+        timeline: Cached OccupancyTimeline of the ego vehicle
     
     Returns:
         Sorted list of unique lanelet IDs occupied during interval
     """
-    occupied = set()
-    
-    for state in L7:
-        # Use 'timestep' as time value (convert to float if needed)
-        time = float(state['timestep'])
-        
-        if float(start_time) <= time <= float(end_time):
-            # Use direct position coordinates
-            position = {'x': state['x'], 'y': state['y']}
-            
-            lanelet_id = next(
-                (l['id'] for l in L1['lanelet'] 
-                 if is_within_lanelet(position, l)),
-                None
-            )
-            if lanelet_id:
-                occupied.add(lanelet_id)
-    
-    return sorted(occupied)
\ No newline at end of file
+    return sorted(_ego_timeline(L7, L1, lanelet_index, timeline).lanelets_between(start_time, end_time))
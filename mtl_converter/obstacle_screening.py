@@ -0,0 +1,113 @@
+# Cheap screening of the dynamic obstacles before the scenario is sent to the LLM.
+# Obstacles that never come close to the ego vehicle, never approach it and never drive on or next to
+# its lanelets are dropped from the simplified L4 MTL, the remaining ones are ranked by TTC and distance.
+import math
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+from mtl_converter.L4_safety_metrics import RelativeMetricsTable
+from mtl_converter.occupancy_timeline import OccupancyTimeline, obstacle_timeline
+from mtl_converter.utils import LaneletIndex
+
+# An obstacle is relevant if any of these holds at some timestep
+MAX_DISTANCE = 30.0  # m, bounding box distance to the ego vehicle
+MAX_TTC = 10.0  # s, same horizon as the TTC intervals of convert_l4_to_mtl
+# find_critical_obstacles asks for five obstacles, fewer relevant ones are filled up by rank
+MIN_OBSTACLES = 5
+
+class ObstacleScreening(NamedTuple):
+    obstacle_id: str
+    min_distance: float
+    min_ttc: float  # smallest timestep-wise max(ttc_long, ttc_lat), i.e. both TTCs are below it at that timestep
+    shares_lanelet: bool  # on a lanelet the ego vehicle occupies at the same time
+    adjacent_lanelet: bool  # on a neighbour (left, right, successor, predecessor) of such a lanelet
+    shared_timesteps: int  # timesteps on the same lanelet as the ego vehicle
+
+    @property
+    def relevant(self) -> bool:
+        return self.min_distance <= MAX_DISTANCE or self.min_ttc <= MAX_TTC or self.shares_lanelet or self.adjacent_lanelet
+
+def lanelet_neighbours(L1: dict) -> dict:
+    """
+    Left, right, successor and predecessor lanelets of every lanelet
+    """
+    return {
+        lanelet['id']: {
+            neighbour
+            for relation in ('adjacentLeft', 'adjacentRight', 'successor', 'predecessor')
+            for neighbour in lanelet.get(relation) or []
+        }
+        for lanelet in L1.get('lanelet', [])
+    }
+
+def screen_obstacles(L4: dict,
+                     L1: dict,
+                     relative_metrics_df: pd.DataFrame,
+                     ego_timeline: OccupancyTimeline,
+                     lanelet_index: LaneletIndex = None,
+                     timelines: dict = None) -> list[ObstacleScreening]:
+    """
+    Minimum distance, minimum relevant TTC (as in RelativeMetricsTable, both directions below it) and lanelet overlap with the ego vehicle
+    of every dynamic obstacle, in L4 order. Distances and TTCs are aggregated over the relative metrics at once.
+    """
+    ego_order = np.argsort(ego_timeline.times, kind='stable')
+    ego_times = ego_timeline.times[ego_order]
+    ego_lanelets = np.array(ego_timeline.lanelets + [None], dtype=object)[np.append(ego_order, len(ego_order))]
+    lanelet_index = lanelet_index or LaneletIndex(L1)
+    neighbours = lanelet_neighbours(L1)
+
+    min_distance, min_ttc = {}, {}
+    if relative_metrics_df is not None and not relative_metrics_df.empty:
+        metrics = RelativeMetricsTable._effective_ttc(relative_metrics_df)
+        per_timestep = pd.DataFrame({
+            'obstacle_id': metrics['obstacle_id'].astype(float).round(RelativeMetricsTable.KEY_DECIMALS),
+            'distance': np.hypot(metrics['adjusted_d_long'].astype(float), metrics['adjusted_d_lat'].astype(float)),
+            # A single aligned axis has a TTC of 0, the obstacle only closes in if both axes do
+            'ttc': np.maximum(metrics['ttc_long'], metrics['ttc_lat']),
+        })
+        per_obstacle = per_timestep.groupby('obstacle_id').min()
+        min_distance = per_obstacle['distance'].to_dict()
+        min_ttc = per_obstacle['ttc'].to_dict()
+
+    screenings = []
+    for obstacle in L4.get('dynamicObstacle', []):
+        timeline = obstacle_timeline(obstacle, lanelet_index, timelines)
+        shares_lanelet = adjacent_lanelet = False
+        for segment in timeline.segments:
+            if segment.lanelet is None:
+                continue
+            occupied = ego_timeline.lanelets_between(segment.start_time, segment.end_time)
+            shares_lanelet |= segment.lanelet in occupied
+            adjacent_lanelet |= any(segment.lanelet in neighbours.get(lanelet, ()) for lanelet in occupied)
+
+        # Lanelet of the ego vehicle at each state's time, None (last entry) where the ego vehicle has no state
+        positions = np.searchsorted(ego_times, timeline.times)
+        matched = positions < len(ego_times)
+        matched[matched] = ego_times[positions[matched]] == timeline.times[matched]
+        ego_lanelet = ego_lanelets[np.where(matched, positions, len(ego_times))]
+        lanelets = np.array(timeline.lanelets, dtype=object)
+        shared_timesteps = int(np.sum((lanelets == ego_lanelet) & pd.notna(lanelets)))
+        key = round(float(obstacle['id']), RelativeMetricsTable.KEY_DECIMALS)
+        screenings.append(ObstacleScreening(
+            obstacle['id'],
+            float(min_distance.get(key, math.inf)),
+            float(min_ttc.get(key, math.inf)),
+            shares_lanelet,
+            adjacent_lanelet,
+            shared_timesteps
+        ))
+    return screenings
+
+def select_obstacles(screenings: list[ObstacleScreening], top_k: int) -> list[str]:
+    """
+    Ids of the top_k relevant obstacles, ranked by minimum TTC, then lanelet overlap and minimum distance.
+    At least MIN_OBSTACLES are returned (as many as step 1 asks for), filled up by the best ranked
+    irrelevant ones if fewer are relevant.
+    """
+    ranked = sorted(
+        screenings,
+        key=lambda screening: (not screening.relevant, screening.min_ttc, not screening.shares_lanelet, not screening.adjacent_lanelet, screening.min_distance)
+    )
+    relevant = [screening for screening in ranked if screening.relevant]
+    selected = relevant if len(relevant) >= MIN_OBSTACLES else ranked[:MIN_OBSTACLES]
+    return [screening.obstacle_id for screening in selected[:max(top_k, MIN_OBSTACLES)]]
@@ -0,0 +1,85 @@
+# Lanelet occupancy of one agent (a dynamic obstacle or the ego vehicle) over time.
+# The MTL converters and the interval queries of L4 and L7 all read from it, so the lanelets
+# of an agent's trajectory are only located once per scenario version.
+from typing import NamedTuple
+import numpy as np
+from mtl_converter.utils import LaneletIndex
+from preprocessing.scenario_model import DynamicObstacle, obstacle_trajectory
+
+class OccupancySegment(NamedTuple):
+    lanelet: int | None  # None while off the road
+    start_time: object
+    end_time: object
+    start_state: int
+    end_state: int  # index of the state at end_time
+
+class OccupancyTimeline:
+    """
+    Run-length encoded lanelet occupancy of one agent.
+    Consecutive trajectory states on the same lanelet form one segment (lanelet, start_time, end_time).
+    Like in the MTL formulas, a segment ends at the time of the state that enters the next lanelet,
+    the last segment at the final state.
+    - times: time of every state, used for interval queries
+    - lanelets: lanelet of every state (None if off the road)
+    - time_labels: times as they are written into the MTL formulas (default: times)
+    """
+    def __init__(self, times, lanelets: list, time_labels: list = None):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.lanelets = list(lanelets)
+        self.time_labels = list(time_labels) if time_labels is not None else self.times.tolist()
+        n = len(self.lanelets)
+
+        run_starts = [i for i in range(n) if i == 0 or self.lanelets[i] != self.lanelets[i - 1]]
+        self._run_starts = np.array(run_starts, dtype=np.int64)
+        self._run_lanelets = [self.lanelets[i] for i in run_starts]
+        self.segments = [
+            OccupancySegment(self.lanelets[start], self.time_labels[start], self.time_labels[end], start, end)
+            for start, end in zip(run_starts, run_starts[1:] + [n - 1])
+        ]
+        # Segments are ordered by time, so a time window maps to a contiguous range of them
+        # found by binary search. Unordered trajectories fall back to a scan over all states.
+        self._ordered = bool(np.all(np.diff(self.times) >= 0))
+
+    @classmethod
+    def for_obstacle(cls, obstacle, lanelet_index: LaneletIndex) -> "OccupancyTimeline":
+        trajectory = obstacle_trajectory(obstacle)
+        lanelets = lanelet_index.find_lanelets_xy(trajectory.x, trajectory.y)
+        if isinstance(obstacle, DynamicObstacle):
+            time_labels = [str(time) for time in trajectory.time.tolist()]
+        else:
+            time_labels = [state['time'] for state in obstacle.get('trajectory', [])]
+        return cls(trajectory.time, lanelets, time_labels)
+
+    @classmethod
+    def for_ego(cls, L7: list[dict], lanelet_index: LaneletIndex) -> "OccupancyTimeline":
+        time_labels = [state['timestep'] for state in L7]
+        lanelets = lanelet_index.find_lanelets_xy([float(state['x']) for state in L7], [float(state['y']) for state in L7])
+        return cls([float(time) for time in time_labels], lanelets, time_labels)
+
+    def lanelets_between(self, start_time: float, end_time: float) -> set:
+        """
+        Lanelets occupied by any state with start_time <= time <= end_time
+        """
+        start_time, end_time = float(start_time), float(end_time)
+        if not self._ordered:
+            window = ((start_time <= self.times) & (self.times <= end_time)).nonzero()[0]
+            return {self.lanelets[i] for i in window if self.lanelets[i]}
+
+        first_state = np.searchsorted(self.times, start_time, side='left')
+        last_state = np.searchsorted(self.times, end_time, side='right') - 1
+        if first_state > last_state:
+            return set()
+        first_run = np.searchsorted(self._run_starts, first_state, side='right') - 1
+        last_run = np.searchsorted(self._run_starts, last_state, side='right') - 1
+        return {lanelet for lanelet in self._run_lanelets[first_run:last_run + 1] if lanelet}
+
+def obstacle_timeline(obstacle, lanelet_index: LaneletIndex, timelines: dict = None) -> OccupancyTimeline:
+    """
+    Timeline of a dynamic obstacle from timelines (by obstacle id), which is filled on a miss
+    """
+    if timelines is None:
+        return OccupancyTimeline.for_obstacle(obstacle, lanelet_index)
+    timeline = timelines.get(obstacle['id'])
+    if timeline is None:
+        timeline = timelines[obstacle['id']] = OccupancyTimeline.for_obstacle(obstacle, lanelet_index)
+    return timeline
@@ -1,19 +1,24 @@
-import pandas as pd
 import math
-import csv
+import pandas as pd
+import numpy as np
 import json
 import os
+from preprocessing.extract_trajectories import EGO_DTYPES, OBSTACLE_DTYPES, as_trajectory_frame, trajectory_file, write_trajectory_table
+
+EGO_LENGTH = 4.508
+EGO_WIDTH = 1.610
 
+# The relative kinematics below work on scalars as well as on NumPy arrays
 def calculate_relative_distances(x_ego, y_ego, theta_ego, x_obs, y_obs, theta_obs):
     delta_x = x_obs - x_ego
     delta_y = y_obs - y_ego
-    d_long = delta_x * math.cos(-theta_ego) - delta_y * math.sin(-theta_ego)
-    d_lat = delta_x * math.sin(-theta_ego) + delta_y * math.cos(-theta_ego)
+    d_long = delta_x * np.cos(-theta_ego) - delta_y * np.sin(-theta_ego)
+    d_lat = delta_x * np.sin(-theta_ego) + delta_y * np.cos(-theta_ego)
     return d_long, d_lat
 
 def calculate_adjusted_relative_distances(d_long, d_lat):
-    vehicle_length = 4.508
-    vehicle_width = 1.610
+    vehicle_length = EGO_LENGTH
+    vehicle_width = EGO_WIDTH
 
     adjusted_d_long = d_long - vehicle_length if d_long > vehicle_length else (d_long + vehicle_length if d_long < -vehicle_length else 0)
     adjusted_d_lat = d_lat - vehicle_width if d_lat > vehicle_width else (d_lat + vehicle_width if d_lat < -vehicle_width else 0)
@@ -21,22 +26,22 @@ def calculate_adjusted_relative_distances(d_long, d_lat):
     return adjusted_d_long, adjusted_d_lat
 
 def calculate_relative_velocity(v_ego, theta_ego, v_obs, theta_obs):
-    v_obs_long = v_obs * math.cos(theta_obs - theta_ego)
-    v_obs_lat = v_obs * math.sin(theta_obs - theta_ego)
+    v_obs_long = v_obs * np.cos(theta_obs - theta_ego)
+    v_obs_lat = v_obs * np.sin(theta_obs - theta_ego)
     v_rel_long = v_obs_long - v_ego
     v_rel_lat = v_obs_lat
     return v_rel_long, v_rel_lat
 
 def calculate_relative_acceleration(a_ego, theta_ego, a_obs, theta_obs):
-    a_obs_long = a_obs * math.cos(theta_obs)
-    a_obs_lat = a_obs * math.sin(theta_obs)
-    a_rel_long = a_obs_long - a_ego * math.cos(theta_ego)
-    a_rel_lat = a_obs_lat - a_ego * math.sin(theta_ego)
+    a_obs_long = a_obs * np.cos(theta_obs)
+    a_obs_lat = a_obs * np.sin(theta_obs)
+    a_rel_long = a_obs_long - a_ego * np.cos(theta_ego)
+    a_rel_lat = a_obs_lat - a_ego * np.sin(theta_ego)
     return a_rel_long, a_rel_lat
 
 def identify_relative_direction(d_long, d_lat):
-    ego_length = 4.508
-    ego_width = 1.610
+    ego_length = EGO_LENGTH
+    ego_width = EGO_WIDTH
 
     if d_long > ego_length:
         if d_lat > ego_width:
@@ -132,81 +137,175 @@ def calculate_time_to_collision(adjusted_d_long, adjusted_d_lat, v_rel_long, v_r
 
     return ttc_long, ttc_lat, motion_description
 
-# Processing a single scenario
-def process_single_scenario(ego_path, obstacles_path, scenario_name):
+def _row_dtype(df):
+    """
+    Dtype a row of the frame gets in iterrows(), i.e. the common dtype of all columns
+    """
+    try:
+        return np.result_type(*df.dtypes)
+    except TypeError:
+        return None
+
+def _as_scalar_column(values, integer_mask):
+    # The scalar calculations return the integer 0 for aligned obstacles,
+    # so a column consisting only of those ends up as integers in the CSV
+    if len(values) and integer_mask.all():
+        return values.astype(np.int64)
+    return values
+
+def compute_relative_metrics(ego_df, obstacles_df):
+    """
+    Relative metrics of every obstacle to the ego vehicle at every shared timestep.
+
+    The ego and obstacle frames are joined on the timestep and all relative quantities
+    are computed as column operations. Rows, values and their rounding are the same as
+    computing every (ego state, obstacle state) pair with the scalar functions above.
+    """
+    ego = ego_df.assign(_ego_row=np.arange(len(ego_df)))
+    obstacles = obstacles_df.assign(_obstacle_row=np.arange(len(obstacles_df)))
+    pairs = ego.merge(obstacles, on='timestep', suffixes=('_ego', '_obs'))
+    # keep the order of a loop over the ego states and the obstacles at each timestep
+    pairs = pairs.sort_values(by=['_ego_row', '_obstacle_row'], kind='stable')
+    if pairs.empty:
+        return pd.DataFrame([])
+
+    def column(name):
+        return pairs[name].to_numpy(dtype=float)
+
+    theta_ego, theta_obs = column('orientation_ego'), column('orientation_obs')
+    d_long, d_lat = calculate_relative_distances(
+        column('x_position_ego'), column('y_position_ego'), theta_ego,
+        column('x_position_obs'), column('y_position_obs'), theta_obs
+    )
+    v_rel_long, v_rel_lat = calculate_relative_velocity(column('velocity_ego'), theta_ego, column('velocity_obs'), theta_obs)
+    a_rel_long, a_rel_lat = calculate_relative_acceleration(column('acceleration_ego'), theta_ego, column('acceleration_obs'), theta_obs)
+
+    front = d_long > EGO_LENGTH
+    behind = d_long < -EGO_LENGTH
+    left = d_lat > EGO_WIDTH
+    right = d_lat < -EGO_WIDTH
+    long_aligned = ~front & ~behind
+    lat_aligned = ~left & ~right
+
+    adjusted_d_long = np.select([front, behind], [d_long - EGO_LENGTH, d_long + EGO_LENGTH], default=0.0)
+    adjusted_d_lat = np.select([left, right], [d_lat - EGO_WIDTH, d_lat + EGO_WIDTH], default=0.0)
+
+    relative_direction = np.select(
+        [front & left, front & right, front, behind & left, behind & right, behind, left, right],
+        ["Front-left", "Front-right", "Front", "Rear-left", "Rear-right", "Behind", "Left", "Right"],
+        default="Collision"
+    )
+
+    # Longitudinal TTC calculation, see calculate_time_to_collision
+    with np.errstate(divide='ignore', invalid='ignore'):
+        long_conditions = [
+            front & (v_rel_long > 0), front & (v_rel_long < 0), front,
+            behind & (v_rel_long > 0), behind & (v_rel_long < 0), behind
+        ]
+        ttc_long = np.select(long_conditions, [
+            np.inf, adjusted_d_long / np.abs(v_rel_long), np.inf,
+            np.abs(adjusted_d_long) / v_rel_long, np.inf, np.inf
+        ], default=0.0)
+        long_description = np.select(long_conditions, [
+            "Obstacle is moving away longitudinally.",
+            "Obstacle is driving toward the ego car longitudinally.",
+            "No longitudinal relative motion.",
+            "Obstacle is driving toward the ego car from behind.",
+            "Obstacle is moving away longitudinally.",
+            "No longitudinal relative motion."
+        ], default="Exact longitudinal alignment or co.")
+
+        # Lateral TTC calculation
+        lat_conditions = [
+            left & (v_rel_lat > 0), left & (v_rel_lat < 0), left,
+            right & (v_rel_lat > 0), right & (v_rel_lat < 0), right
+        ]
+        ttc_lat = np.select(lat_conditions, [
+            np.inf, np.abs(adjusted_d_lat / v_rel_lat), np.inf,
+            np.abs(adjusted_d_lat / v_rel_lat), np.inf, np.inf
+        ], default=0.0)
+        lat_description = np.select(lat_conditions, [
+            " Obstacle is moving away laterally to the left.",
+            " Obstacle is driving toward the ego car laterally from the left.",
+            " No lateral relative motion.",
+            " Obstacle is driving toward the ego car laterally from the right.",
+            " Obstacle is moving away laterally to the right.",
+            " No lateral relative motion."
+        ], default=" Exact lateral alignment or unknown case.")
+
+    # iterrows() upcasts every value of a row to the common dtype of its frame
+    timestep = pairs['timestep']
+    ego_dtype = _row_dtype(ego_df)
+    if ego_dtype is not None:
+        timestep = timestep.astype(ego_dtype)
+    obstacle_id = pairs['obstacle_id']
+    obstacle_dtype = _row_dtype(obstacles_df)
+    if obstacle_dtype is not None:
+        obstacle_id = obstacle_id.astype(obstacle_dtype)
+
+    # Rounded results, infinite TTCs stay infinite
+    return pd.DataFrame({
+        "timestep": timestep.to_numpy(),
+        "obstacle_id": obstacle_id.to_numpy(),
+        "relative_direction": relative_direction,
+        "d_long": np.round(d_long, 2),
+        "d_lat": np.round(d_lat, 2),
+        "adjusted_d_long": _as_scalar_column(np.round(adjusted_d_long, 2), long_aligned),
+        "adjusted_d_lat": _as_scalar_column(np.round(adjusted_d_lat, 2), lat_aligned),
+        "v_rel_long": np.round(v_rel_long, 2),
+        "v_rel_lat": np.round(v_rel_lat, 2),
+        "a_rel_long": np.round(a_rel_long, 2),
+        "a_rel_lat": np.round(a_rel_lat, 2),
+        "ttc_long": _as_scalar_column(np.round(ttc_long, 2), long_aligned),
+        "ttc_lat": _as_scalar_column(np.round(ttc_lat, 2), lat_aligned),
+        "motion_description": np.char.add(long_description, lat_description).astype(object)
+    })
 
-    if not os.path.exists(ego_path) or not os.path.exists(obstacles_path):
+# Processing a single scenario
+def process_single_scenario(ego_path, obstacles_path, scenario_name, save=True):
+    """
+    Relative metrics of a scenario; ego and obstacles are trajectory frames or paths to them
+    """
+    paths = [path for path in (ego_path, obstacles_path) if not isinstance(path, pd.DataFrame)]
+    if not all(os.path.exists(path) for path in paths):
         print(f"Missing files for scenario: {scenario_name}")
-        return
-
-    ego_df = pd.read_csv(ego_path)
-    obstacles_df = pd.read_csv(obstacles_path)
-    results = []
-
-    for _, ego_row in ego_df.iterrows():
-        timestep = ego_row['timestep']
-        ego_data = ego_row
-        obs_at_timestep = obstacles_df[obstacles_df['timestep'] == timestep]
-
-        for _, obs_row in obs_at_timestep.iterrows():
-            d_long, d_lat = calculate_relative_distances(
-                ego_data['x_position'], ego_data['y_position'], ego_data['orientation'],
-                obs_row['x_position'], obs_row['y_position'], obs_row['orientation']
-            )
-            adjusted_d_long, adjusted_d_lat = calculate_adjusted_relative_distances(d_long, d_lat)
-            v_rel_long, v_rel_lat = calculate_relative_velocity(
-                ego_data['velocity'], ego_data['orientation'],
-                obs_row['velocity'], obs_row['orientation']
-            )
-            a_rel_long, a_rel_lat = calculate_relative_acceleration(
-                ego_data['acceleration'], ego_data['orientation'],
-                obs_row['acceleration'], obs_row['orientation']
-            )
-            relative_direction = identify_relative_direction(d_long, d_lat)
-            ttc_long, ttc_lat, motion_description = calculate_time_to_collision(adjusted_d_long, adjusted_d_lat, v_rel_long, v_rel_lat, relative_direction)
-
-            # Append rounded results
-            results.append({
-                "timestep": timestep,
-                "obstacle_id": obs_row['obstacle_id'],
-                "relative_direction": relative_direction,
-                "d_long": round(d_long, 2),
-                "d_lat": round(d_lat, 2),
-                "adjusted_d_long": round(adjusted_d_long, 2),
-                "adjusted_d_lat": round(adjusted_d_lat, 2),
-                "v_rel_long": round(v_rel_long, 2),
-                "v_rel_lat": round(v_rel_lat, 2),
-                "a_rel_long": round(a_rel_long, 2),
-                "a_rel_lat": round(a_rel_lat, 2),
-                "ttc_long": round(ttc_long, 2) if ttc_long != float('inf') else ttc_long,  # Handle infinity
-                "ttc_lat": round(ttc_lat, 2) if ttc_lat != float('inf') else ttc_lat,  # Handle infinity
-                "motion_description": motion_description  # Keep string as-is
-            })
-    # Convert to DataFrame
-    results_df = pd.DataFrame(results)
-    # Input and output file paths
-    csv_file = f"data/scenarios/{scenario_name}_relative_metrics.csv"
-    # Save DataFrame to CSV
-    results_df.to_csv(csv_file, index=False)
-    print(f"Results saved to: {csv_file}")
+        return None
 
+    ego_df = as_trajectory_frame(ego_path, EGO_DTYPES)
+    obstacles_df = as_trajectory_frame(obstacles_path, OBSTACLE_DTYPES)
+    return process_scenario_frames(ego_df, obstacles_df, scenario_name, save)
+
+def process_scenario_frames(ego_df, obstacles_df, scenario_name, save=True):
+    """
+    Relative metrics of already loaded ego and obstacle frames.
+    With save, they are also written to data/scenarios and data/outputs.
+    """
+    results_df = compute_relative_metrics(ego_df, obstacles_df)
+    if save:
+        save_relative_metrics(results_df, scenario_name)
+    return results_df
+
+def save_relative_metrics(results_df, scenario_name):
+    # Output file paths
+    metrics_file = trajectory_file(f"data/scenarios/{scenario_name}_relative_metrics")
+    write_trajectory_table(results_df, metrics_file)
+    print(f"Results saved to: {metrics_file}")
 
     txt_file = f"data/outputs/{scenario_name}_output.txt"
 
-    # Read the CSV and transform it into the required JSON structure
+    # Transform the results into the required JSON structure
     output_data = {}
-    with open(csv_file, 'r') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            timestep = float(row['timestep']) * 0.1  # Convert timestep to real time
-            obstacle_id = int(float(row['obstacle_id']))
-            relative_direction = row['relative_direction']
-            adjusted_d_long  = abs(float(row['adjusted_d_long']))
-            adjusted_d_lat = abs(float(row['adjusted_d_lat']))
-            ttc_long = float(row['ttc_long']) if row['ttc_long'] != 'inf' else 'Infinity'
-            ttc_lat = float(row['ttc_lat']) if row['ttc_lat'] != 'inf' else 'Infinity'
-            motion_description = row['motion_description']  
-
+    if not results_df.empty:
+        for timestep, obstacle_id, relative_direction, adjusted_d_long, adjusted_d_lat, ttc_long, ttc_lat, motion_description in zip(
+            (results_df['timestep'].astype(float) * 0.1).tolist(),  # Convert timestep to real time
+            results_df['obstacle_id'].astype(float).astype(int).tolist(),
+            results_df['relative_direction'].tolist(),
+            results_df['adjusted_d_long'].astype(float).abs().tolist(),
+            results_df['adjusted_d_lat'].astype(float).abs().tolist(),
+            results_df['ttc_long'].astype(float).tolist(),
+            results_df['ttc_lat'].astype(float).tolist(),
+            results_df['motion_description'].tolist()
+        ):
             if f"At {timestep:.1f} seconds" not in output_data:
                 output_data[f"At {timestep:.1f} seconds"] = {}
 
@@ -218,8 +317,8 @@ def process_single_scenario(ego_path, obstacles_path, scenario_name):
                 },
 
                 "Time to Collision": {
-                    "Longitudinal": ttc_long,
-                    "Lateral": ttc_lat
+                    "Longitudinal": ttc_long if ttc_long != math.inf else 'Infinity',
+                    "Lateral": ttc_lat if ttc_lat != math.inf else 'Infinity'
                 },
                 "Motion Description": motion_description
             }
@@ -228,4 +327,6 @@ def process_single_scenario(ego_path, obstacles_path, scenario_name):
     with open(txt_file, 'w') as file:
         json.dump(output_data, file, indent=4)
 
-    print(f"Data successfully written to {txt_file}.")
\ No newline at end of file
+    print(f"Data successfully written to {txt_file}.")
+
+    return results_df
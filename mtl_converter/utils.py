@@ -1,20 +1,148 @@
-def is_within_lanelet(position, lanelet):
-    # Assuming lanelet has 'leftBound' and 'rightBound' with 'x' and 'y' coordinates
+import numpy as np
+import shapely
+from shapely import STRtree
+from preprocessing.scenario_model import Lanelet
+
+try:
+    import numba
+except ImportError:  # optional, points_in_polygon falls back to NumPy
+    numba = None
+
+def point_in_polygon(x: float, y: float, xs: list[float], ys: list[float]) -> bool:
     # Use a ray-casting algorithm for point-in-polygon test
-    def point_in_polygon(x, y, polygon):
-        num = len(polygon)
-        j = num - 1
-        inside = False
-        for i in range(num):
-            xi, yi = float(polygon[i]['x']), float(polygon[i]['y'])
-            xj, yj = float(polygon[j]['x']), float(polygon[j]['y'])
-            if ((yi > y) != (yj > y)) and (x < (xj - xi) * (y - yi) / (yj - yi) + xi):
-                inside = not inside
-            j = i
+    num = len(xs)
+    j = num - 1
+    inside = False
+    for i in range(num):
+        xi, yi = xs[i], ys[i]
+        xj, yj = xs[j], ys[j]
+        if ((yi > y) != (yj > y)) and (x < (xj - xi) * (y - yi) / (yj - yi) + xi):
+            inside = not inside
+        j = i
+    return inside
+
+def polygon_edges(xs, ys) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Edges (xi, yi) -> (xj, yj) of a polygon in the order point_in_polygon visits them
+    """
+    xi = np.asarray(xs, dtype=np.float64)
+    yi = np.asarray(ys, dtype=np.float64)
+    return xi, yi, np.roll(xi, 1), np.roll(yi, 1)
+
+def _points_in_polygon_numpy(x, y, edges):
+    xi, yi, xj, yj = (edge[:, None] for edge in edges)
+    # Same crossing test and operation order as point_in_polygon; the quotient of
+    # horizontal edges is never used, as the first condition already fails for them
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = ((yi > y) != (yj > y)) & (x < (xj - xi) * (y - yi) / (yj - yi) + xi)
+    return np.count_nonzero(crossings, axis=0) % 2 == 1
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _points_in_polygon_numba(x, y, xi, yi, xj, yj):
+        inside = np.zeros(x.shape[0], dtype=np.bool_)
+        for p in range(x.shape[0]):
+            for e in range(xi.shape[0]):
+                if ((yi[e] > y[p]) != (yj[e] > y[p])) and (x[p] < (xj[e] - xi[e]) * (y[p] - yi[e]) / (yj[e] - yi[e]) + xi[e]):
+                    inside[p] = not inside[p]
         return inside
 
+def points_in_polygon(x, y, edges) -> np.ndarray:
+    """
+    point_in_polygon for arrays of points against one polygon given by polygon_edges.
+    Uses a compiled kernel if numba is installed, NumPy otherwise; both give the same results.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if numba is not None:
+        return _points_in_polygon_numba(x, y, *edges)
+    return _points_in_polygon_numpy(x, y, edges)
+
+def lanelet_polygon(lanelet: dict) -> tuple[list[float], list[float]]:
+    if isinstance(lanelet, Lanelet):
+        xs, ys = lanelet.polygon()
+        return xs.tolist(), ys.tolist()
     # Combine left and right bounds to form a polygon
     polygon = lanelet['leftBound'] + lanelet['rightBound'][::-1]
+    return [float(point['x']) for point in polygon], [float(point['y']) for point in polygon]
+
+def is_within_lanelet(position, lanelet):
+    # Assuming lanelet has 'leftBound' and 'rightBound' with 'x' and 'y' coordinates
+    xs, ys = lanelet_polygon(lanelet)
 
     # Check if position is within the polygon
-    return point_in_polygon(float(position['x']), float(position['y']), polygon)
\ No newline at end of file
+    return point_in_polygon(float(position['x']), float(position['y']), xs, ys)
+
+def points_within_lanelet(xs, ys, lanelet) -> np.ndarray:
+    """
+    is_within_lanelet for arrays of x and y coordinates
+    """
+    return points_in_polygon(xs, ys, polygon_edges(*lanelet_polygon(lanelet)))
+
+class LaneletIndex:
+    """
+    Point location over the lanelets of one L1 layer.
+
+    The lanelet polygons are parsed once and an STRtree over their bounding boxes
+    narrows each lookup down to a few candidates, which are then checked with the same
+    ray-casting test as is_within_lanelet. Like a linear scan over L1['lanelet'],
+    a lookup returns the first lanelet (in L1 order) that contains the point.
+    """
+
+    def __init__(self, L1: dict):
+        self.lanelet_ids = []
+        self._polygons = []
+        self._edges = []
+        boxes = []
+        box_positions = []
+
+        for position, lanelet in enumerate(L1.get('lanelet', [])):
+            xs, ys = lanelet_polygon(lanelet)
+            self.lanelet_ids.append(lanelet['id'])
+            self._polygons.append((xs, ys))
+            self._edges.append(polygon_edges(xs, ys))
+            if xs:
+                boxes.append(shapely.box(min(xs), min(ys), max(xs), max(ys)))
+                box_positions.append(position)
+
+        self._box_positions = box_positions
+        self._tree = STRtree(boxes)
+
+    def candidates(self, x: float, y: float) -> list[int]:
+        """
+        Positions (in L1 order) of the lanelets whose bounding box contains the point
+        """
+        hits = self._tree.query(shapely.Point(x, y))
+        return sorted(self._box_positions[hit] for hit in hits)
+
+    def find_lanelet_xy(self, x: float, y: float) -> str | None:
+        for position in self.candidates(x, y):
+            xs, ys = self._polygons[position]
+            if point_in_polygon(x, y, xs, ys):
+                return self.lanelet_ids[position]
+        return None
+
+    def find_lanelets_xy(self, xs, ys) -> list:
+        """
+        find_lanelet_xy for many points: the bounding boxes of all points are queried at once and
+        each candidate lanelet tests all of its points in one vectorized pass
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        # position in L1 order of the first lanelet containing each point, len(lanelet_ids) if none
+        found = np.full(len(xs), len(self.lanelet_ids), dtype=np.int64)
+        if len(xs) and len(self._box_positions):
+            point_hits, box_hits = self._tree.query(shapely.points(xs, ys))
+            positions = np.asarray(self._box_positions, dtype=np.int64)[box_hits]
+            for position in np.unique(positions):
+                points = point_hits[positions == position]
+                inside = points[points_in_polygon(xs[points], ys[points], self._edges[position])]
+                found[inside] = np.minimum(found[inside], position)
+        lanelet_ids = self.lanelet_ids + [None]
+        return [lanelet_ids[position] for position in found.tolist()]
+
+    def find_lanelet(self, position: dict) -> str | None:
+        """
+        Id of the first lanelet containing the position, None if it is off the road
+        """
+        return self.find_lanelet_xy(float(position['x']), float(position['y']))
@@ -1,6 +1,104 @@
-import csv
+import os
+import numpy as np
 import pandas as pd
-from preprocessing.plot import check_point_in_polygons
+from preprocessing.plot import assign_lanelets
+from preprocessing.scenario_model import obstacle_trajectory
+
+# ==== trajectory storage ====
+# Trajectory tables are read and written in the format given by their file extension.
+# Intermediate files of the pipeline use TRAJECTORY_FORMAT ("csv" unless set in the environment),
+# TRAJECTORY_FORMAT=npz writes compressed NumPy archives instead.
+TRAJECTORY_FORMAT = os.environ.get("TRAJECTORY_FORMAT", "csv")
+
+# Explicit dtypes of the columns every obstacle / ego trajectory table has
+OBSTACLE_DTYPES = {
+    "obstacle_id": np.int64,
+    "timestep": np.int64,
+    "x_position": np.float64,
+    "y_position": np.float64,
+    "orientation": np.float64,
+    "velocity": np.float64,
+    "acceleration": np.float64,
+    "lanelet_id": np.int64
+}
+EGO_DTYPES = {
+    "timestep": np.int64,
+    "x_position": np.float64,
+    "y_position": np.float64,
+    "orientation": np.float64,
+    "velocity": np.float64,
+    "acceleration": np.float64
+}
+
+def trajectory_file(path_without_extension, file_format=None):
+    return f"{path_without_extension}.{file_format or TRAJECTORY_FORMAT}"
+
+def _numeric_columns(df):
+    # Text columns that only hold numbers are stored as numbers, the same types pd.read_csv infers
+    df = df.copy()
+    for column in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[column]):
+            try:
+                df[column] = pd.to_numeric(df[column])
+            except (TypeError, ValueError):
+                pass
+    return df
+
+def _read_csv(path):
+    return pd.read_csv(path)
+
+def _write_csv(df, path):
+    df.to_csv(path, index=False)
+
+def _read_npz(path):
+    with np.load(path, allow_pickle=False) as data:
+        columns = data["__columns__"].tolist()
+        return pd.DataFrame({
+            column: data[column].astype(object) if data[column].dtype.kind == "U" else data[column]
+            for column in columns
+        })
+
+def _write_npz(df, path):
+    df = _numeric_columns(df)
+    arrays = {
+        column: df[column].to_numpy() if pd.api.types.is_numeric_dtype(df[column]) else df[column].to_numpy(dtype=str)
+        for column in df.columns
+    }
+    # the file object keeps np.savez from appending another .npz extension
+    with open(path, "wb") as file:
+        np.savez(file, __columns__=np.array(df.columns, dtype=str), **arrays)
+
+def _write_parquet(df, path):
+    _numeric_columns(df).to_parquet(path, index=False)
+
+def _write_feather(df, path):
+    _numeric_columns(df).reset_index(drop=True).to_feather(path)
+
+# extension -> (reader, writer); parquet and feather need pyarrow
+TRAJECTORY_STORAGES = {
+    "csv": (_read_csv, _write_csv),
+    "npz": (_read_npz, _write_npz),
+    "parquet": (pd.read_parquet, _write_parquet),
+    "feather": (pd.read_feather, _write_feather)
+}
+
+def _storage(path):
+    extension = os.path.splitext(str(path))[1].lstrip(".").lower()
+    if extension not in TRAJECTORY_STORAGES:
+        raise ValueError(f"Unsupported trajectory file format: {path}")
+    return TRAJECTORY_STORAGES[extension]
+
+def read_trajectory_table(path, dtypes=None):
+    """
+    Read a trajectory table, casting the columns in dtypes that are present
+    """
+    df = _storage(path)[0](path)
+    if dtypes:
+        df = df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns})
+    return df
+
+def write_trajectory_table(df, path):
+    _storage(path)[1](df, path)
 
 def extract_obstacle_trajectories(obstacle_data):
     """
@@ -27,92 +125,97 @@ def extract_obstacle_trajectories(obstacle_data):
 
     return trajectories
 
-# Updated dynamic obstacles visualization with lanelet checking
-def dynamic_obstacles_with_lanelets(obstacle_data, polygons, output_file_path):
-    """
-    Process dynamic obstacles' trajectories, check lanelet membership, and save results.
-    """
-    # Extract the recorded trajectories of dynamic obstacles
-    obstacle_trajectories = extract_obstacle_trajectories(obstacle_data)
-    trajectory_data = []
-
-    # Process each obstacle's trajectory
-    for obstacle in obstacle_trajectories:
-        obstacle_id = obstacle["id"]
-        positions = obstacle["positions"]
-        orientation = obstacle["orientation"]
-        times = obstacle["times"]
-        velocities = obstacle["velocities"]
-        accelerations = obstacle["accelerations"]
-        
-
-        for time, pos, vel, acc, theta in zip(times, positions, velocities, accelerations, orientation):
-            x, y = pos["x"], pos["y"]
-            lanelet_id = check_point_in_polygons(x, y, polygons)
-            trajectory_data.append({
-                "obstacle_id": obstacle_id,
-                "timestep": time,
-                "x_position": x,
-                "y_position": y,
-                "orientation": theta,
-                "velocity": vel,
-                "acceleration": acc,
-                "lanelet_id": lanelet_id
-            })
-
-    # Save trajectory data to a new CSV file
-    trajectory_df = pd.DataFrame(trajectory_data)
-    trajectory_df.to_csv(output_file_path, index=False)
-    print(f"Trajectory data saved to {output_file_path}")
-
+def as_trajectory_frame(table, dtypes=None):
+    """
+    The DataFrame itself, or the trajectory table read from the path
+    """
+    if isinstance(table, pd.DataFrame):
+        return table
+    return read_trajectory_table(table, dtypes)
+
+def _save(df, output_file_path, message):
+    # Disk sink at the end of a stage, skipped when no path is given
+    if output_file_path is not None:
+        write_trajectory_table(df, output_file_path)
+        print(f"{message} {output_file_path}")
+    return df
+
+def obstacle_trajectory_frame(obstacle_data, polygons):
+    """
+    Trajectories of all dynamic obstacles with the lanelet of every point (-1 if off the road)
+    """
+    # Concatenate the recorded trajectories of all dynamic obstacles column by column
+    obstacles = obstacle_data.get("dynamicObstacle", [])
+    trajectories = [obstacle_trajectory(obstacle) for obstacle in obstacles]
+
+    def column(name, dtype):
+        return np.concatenate([getattr(trajectory, name) for trajectory in trajectories] or [np.empty(0, dtype=dtype)])
+
+    trajectory_df = pd.DataFrame({
+        "obstacle_id": np.repeat(
+            np.array([obstacle.get("id", "Unknown") for obstacle in obstacles], dtype=object),
+            [len(trajectory.time) for trajectory in trajectories]
+        ),
+        "timestep": column("time", np.int64),
+        "x_position": column("x", np.float64),
+        "y_position": column("y", np.float64),
+        "orientation": column("orientation", np.float64),
+        "velocity": column("velocity", np.float64),
+        "acceleration": column("acceleration", np.float64)
+    })
+    # Check lanelet membership of all trajectory points at once
+    trajectory_df["lanelet_id"] = assign_lanelets(trajectory_df["x_position"], trajectory_df["y_position"], polygons)
     return trajectory_df
 
-def extract_every_nth_timestep(input_csv_path, output_csv_path, n):
+# Updated dynamic obstacles visualization with lanelet checking
+def dynamic_obstacles_with_lanelets(obstacle_data, polygons, output_file_path=None):
     """
-    Extract every nth timestep (n, 2n, 3n, ...) for each obstacle_id and consolidate 
-    the data for all obstacles into a single DataFrame for the same timesteps.
-    Save the resulting DataFrame to a new CSV file.
+    Process dynamic obstacles' trajectories, check lanelet membership, and save results
+    if output_file_path is given.
+    """
+    trajectory_df = obstacle_trajectory_frame(obstacle_data, polygons)
+    return _save(trajectory_df, output_file_path, "Trajectory data saved to")
 
-    Parameters:
-    - input_csv_path: str, path to the input CSV file containing obstacle data
-    - output_csv_path: str, path to save the output CSV file
-    - n: int, the step interval to filter timesteps
+def every_nth_timestep(df, n):
+    """
+    Every nth timestep (n, 2n, 3n, ...) of an obstacle trajectory frame, sorted by timestep and obstacle_id
     """
-    # Load the CSV data
-    df = pd.read_csv(input_csv_path)
     # Replace NaN in lanelet_id with -1
-    df['lanelet_id'] = df['lanelet_id'].fillna(-1).astype(int)
-
-    # Ensure the timestep column is numeric
-    df['timestep'] = pd.to_numeric(df['timestep'])
+    df = df.assign(lanelet_id=df['lanelet_id'].fillna(-1))
+    df = df.astype({column: dtype for column, dtype in OBSTACLE_DTYPES.items() if column in df.columns})
 
     # Filter every nth timestep
     filtered_df = df[df['timestep'] % n == 0]
 
     # Sort the data by timestep and obstacle_id
-    filtered_df = filtered_df.sort_values(by=['timestep', 'obstacle_id'])
+    return filtered_df.sort_values(by=['timestep', 'obstacle_id'])
 
-    # Save the filtered data to a new CSV file
-    filtered_df.to_csv(output_csv_path, index=False)
-    print(f"Filtered data saved to {output_csv_path}")
+def extract_every_nth_timestep(input_csv_path, output_csv_path=None, n=1):
+    """
+    Extract every nth timestep (n, 2n, 3n, ...) for each obstacle_id and consolidate 
+    the data for all obstacles into a single DataFrame for the same timesteps.
+    Save the resulting DataFrame to a new file if output_csv_path is given.
 
-    return filtered_df
+    Parameters:
+    - input_csv_path: DataFrame or str, obstacle trajectory frame or path to the file containing it
+    - output_csv_path: str, path to save the output trajectory file (optional)
+    - n: int, the step interval to filter timesteps
+    """
+    filtered_df = every_nth_timestep(as_trajectory_frame(input_csv_path), n)
+    return _save(filtered_df, output_csv_path, "Filtered data saved to")
 
-def extract_ego_every_nth_timestep(input_csv_path, output_csv_path, n):
+def extract_ego_every_nth_timestep(input_csv_path, output_csv_path=None, n=1):
     """
     Extract every nth timestep (n, 2n, 3n, ...) from the ego car trajectory data.
-    Save the resulting data to a new CSV file.
+    Save the resulting data to a new file if output_csv_path is given.
 
     Parameters:
-    - input_csv_path: str, path to the input CSV file containing ego trajectory data
-    - output_csv_path: str, path to save the output CSV file
+    - input_csv_path: DataFrame or str, ego trajectory frame or path to the file containing it
+    - output_csv_path: str, path to save the output trajectory file (optional)
     - n: int, the step interval to filter timesteps
     """
-    # Load the CSV data
-    df = pd.read_csv(input_csv_path)
-
-    # Ensure the timestep column is numeric
-    df['timestep'] = pd.to_numeric(df['timestep'])
+    # Load the trajectory data
+    df = as_trajectory_frame(input_csv_path, EGO_DTYPES)
 
     # Filter every nth timestep
     filtered_df = df[df['timestep'] % n == 0]
@@ -120,30 +223,31 @@ def extract_ego_every_nth_timestep(input_csv_path, output_csv_path, n):
     # Sort by timestep
     filtered_df = filtered_df.sort_values(by='timestep')
 
-    # Save the filtered data to a new CSV file
-    filtered_df.to_csv(output_csv_path, index=False)
-    print(f"Ego car data for every {n}th timestep saved to {output_csv_path}")
-
-    return filtered_df
+    return _save(filtered_df, output_csv_path, f"Ego car data for every {n}th timestep saved to")
 
 def extract_ego_trajectory(file_path):
-    trajectory = []
-    
-    with open(file_path, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            # Convert numeric fields to appropriate types
-            timestep_data = {
-                'timestep': int(row['timestep']),
-                'x': float(row['x_position']),
-                'y': float(row['y_position']),
-                'orientation': float(row['orientation']),
-                'velocity': float(row['velocity']),
-                'acceleration': float(row['acceleration']),
-                'lanelet_id': int(row['lanelet_id']) if row['lanelet_id'] else 1,
-                'goal_lanelet_id': int(row['goal_lanelet_id']) if row['goal_lanelet_id'] else 1,
-                'time_horizon': float(row['time_horizon'])
-            }
-            trajectory.append(timestep_data)
-    
-    return trajectory
\ No newline at end of file
+    df = read_trajectory_table(file_path, EGO_DTYPES)
+
+    def lanelet_ids(column):
+        # Missing lanelets default to 1
+        return [1 if pd.isna(value) else int(value) for value in df[column].tolist()]
+
+    # Convert numeric fields to appropriate types
+    return [
+        {
+            'timestep': timestep,
+            'x': x,
+            'y': y,
+            'orientation': orientation,
+            'velocity': velocity,
+            'acceleration': acceleration,
+            'lanelet_id': lanelet_id,
+            'goal_lanelet_id': goal_lanelet_id,
+            'time_horizon': time_horizon
+        }
+        for timestep, x, y, orientation, velocity, acceleration, lanelet_id, goal_lanelet_id, time_horizon in zip(
+            df['timestep'].tolist(), df['x_position'].tolist(), df['y_position'].tolist(), df['orientation'].tolist(),
+            df['velocity'].tolist(), df['acceleration'].tolist(), lanelet_ids('lanelet_id'), lanelet_ids('goal_lanelet_id'),
+            df['time_horizon'].astype(float).tolist()
+        )
+    ]
\ No newline at end of file
@@ -2,6 +2,9 @@
 # https://github.com/yuangao-tum/Riskaware-Scenario-analyse
 
 import json
+import os
+import xml.etree.ElementTree as ET
+from preprocessing.xml2json import tree_to_json, xml_to_dict
 
 def extract_important_information(json_file_path):
     # Read the JSON file
@@ -208,6 +211,202 @@ def extract_important_information(json_file_path):
 
     return important_info
 
+# In-memory path: build the same information directly from the parsed XML,
+# without writing and re-reading the JSON produced by xml2json
+def element_text(element, path, default=None):
+    # Stripped text of the sub element at path, as xml2json stores it under "text"
+    child = element.find(path) if element is not None else None
+    if child is None or not (child.text and child.text.strip()):
+        return default
+    return child.text.strip()
+
+def element_refs(element, tag):
+    return [ref.get("ref", "None") for ref in element.findall(tag)]
+
+def extract_lanelet_from_element(lanelet):
+    traffic_sign_refs = element_refs(lanelet, "trafficSignRef")
+    return {
+        "id": lanelet.get("id"),
+        "leftBound": [
+            {"x": element_text(point, "x", 0.0), "y": element_text(point, "y", 0.0)}
+            for point in lanelet.findall("leftBound/point")
+        ],
+        "rightBound": [
+            {"x": element_text(point, "x", 0.0), "y": element_text(point, "y", 0.0)}
+            for point in lanelet.findall("rightBound/point")
+        ],
+        "trafficSignRef": traffic_sign_refs if traffic_sign_refs else ["None"],
+        "adjacentLeft": element_refs(lanelet, "adjacentLeft"),
+        "adjacentRight": element_refs(lanelet, "adjacentRight"),
+        "successor": element_refs(lanelet, "successor"),
+        "predecessor": element_refs(lanelet, "predecessor")
+    }
+
+def extract_traffic_sign_from_element(traffic_sign):
+    # "virtual" is kept as xml2json represents it (a dict for a sub element)
+    virtual = traffic_sign.find("virtual")
+    return {
+        "id": traffic_sign.get("id"),
+        "trafficSignElement": {
+            "trafficSignID": element_text(traffic_sign, "trafficSignElement/trafficSignID", "Unknown"),
+            "additionalValue": element_text(traffic_sign, "trafficSignElement/additionalValue", "Unknown")
+        },
+        "position": {
+            "x": element_text(traffic_sign, "position/point/x", 0.0),
+            "y": element_text(traffic_sign, "position/point/y", 0.0)
+        },
+        "virtual": xml_to_dict(virtual) if virtual is not None else traffic_sign.get("virtual", "false")
+    }
+
+def extract_dynamic_obstacle_from_element(obstacle):
+    return {
+        "id": obstacle.get("id"),
+        "type": element_text(obstacle, "type"),
+        "shape": {
+            "length": element_text(obstacle, "shape/rectangle/length"),
+            "width": element_text(obstacle, "shape/rectangle/width")
+        },
+        "initialState": {
+            "position": {
+                "x": element_text(obstacle, "initialState/position/point/x"),
+                "y": element_text(obstacle, "initialState/position/point/y")
+            },
+            "orientation": element_text(obstacle, "initialState/orientation/exact"),
+            "time": element_text(obstacle, "initialState/time/exact"),
+            "velocity": element_text(obstacle, "initialState/velocity/exact"),
+            "acceleration": element_text(obstacle, "initialState/acceleration/exact")
+        },
+        "trajectory": [
+            {
+                "position": {
+                    "x": element_text(state, "position/point/x"),
+                    "y": element_text(state, "position/point/y")
+                },
+                "orientation": element_text(state, "orientation/exact"),
+                "time": element_text(state, "time/exact"),
+                "velocity": element_text(state, "velocity/exact"),
+                "acceleration": element_text(state, "acceleration/exact")
+            }
+            for state in obstacle.findall("trajectory/state")
+        ]
+    }
+
+def extract_planning_problem_from_element(planning_problem):
+    goal_lanelet = planning_problem.find("goalState/position/lanelet") if planning_problem is not None else None
+    return {
+        "id": planning_problem.get("id") if planning_problem is not None else None,
+        "initialState": {
+            "position": {
+                "x": element_text(planning_problem, "initialState/position/point/x"),
+                "y": element_text(planning_problem, "initialState/position/point/y")
+            },
+            "orientation": element_text(planning_problem, "initialState/orientation/exact"),
+            "time": element_text(planning_problem, "initialState/time/exact"),
+            "velocity": element_text(planning_problem, "initialState/velocity/exact"),
+            "acceleration": element_text(planning_problem, "initialState/acceleration/exact"),
+            "yawRate": element_text(planning_problem, "initialState/yawRate/exact"),
+            "slipAngle": element_text(planning_problem, "initialState/slipAngle/exact")
+        },
+        "goalState": {
+            "position": {
+                "lanelet": goal_lanelet.get("ref") if goal_lanelet is not None else None
+            },
+            "time": {
+                "intervalStart": element_text(planning_problem, "goalState/time/intervalStart"),
+                "intervalEnd": element_text(planning_problem, "goalState/time/intervalEnd")
+            },
+            "velocity": {
+                "intervalStart": element_text(planning_problem, "goalState/velocity/intervalStart"),
+                "intervalEnd": element_text(planning_problem, "goalState/velocity/intervalEnd")
+            }
+        }
+    }
+
+def element_keys(element):
+    # Keys xml2json creates for an element: attributes, child tags and "text"
+    keys = list(element.attrib) + [child.tag for child in element]
+    if element.text and element.text.strip():
+        keys.append("text")
+    return list(dict.fromkeys(keys))
+
+def extract_location_from_element(location):
+    return {
+        "geoNameId": element_text(location, "geoNameId", "Unknown"),
+        "gpsLatitude": element_text(location, "gpsLatitude", "Unknown"),
+        "gpsLongitude": element_text(location, "gpsLongitude", "Unknown")
+    }
+
+# Converters for the top-level scenario elements that are kept
+SECTION_EXTRACTORS = {
+    "location": extract_location_from_element,
+    "scenarioTags": element_keys,
+    "lanelet": extract_lanelet_from_element,
+    "trafficSign": extract_traffic_sign_from_element,
+    "dynamicObstacle": extract_dynamic_obstacle_from_element,
+    "planningProblem": extract_planning_problem_from_element
+}
+
+def tree_sections(root, extractors):
+    """
+    Root attributes and, per tag in extractors, the converted top-level elements of a parsed XML
+    """
+    return dict(root.attrib), {tag: [extract(element) for element in root.findall(tag)] for tag, extract in extractors.items()}
+
+def stream_sections(xml_file_path, extractors):
+    """
+    Same result as tree_sections, streamed with ET.iterparse.
+    Every top-level element is converted as soon as it is closed and then dropped from the tree,
+    so peak memory is bounded by the largest single element instead of the whole document.
+    """
+    attributes = {}
+    sections = {tag: [] for tag in extractors}
+    root = None
+    depth = 0
+    for event, element in ET.iterparse(xml_file_path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+                attributes = dict(element.attrib)
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if element.tag in extractors:
+                sections[element.tag].append(extractors[element.tag](element))
+            root.remove(element)
+    return attributes, sections
+
+def important_information_from_sections(attributes, sections):
+    return {
+        "timeStepSize": attributes.get("timeStepSize"),
+        "location": sections["location"][0] if sections["location"] else extract_location_from_element(None),
+        "scenarioTags": sections["scenarioTags"][0] if sections["scenarioTags"] else [],
+        "lanelet": sections["lanelet"],
+        "trafficSign": sections["trafficSign"],
+        "dynamicObstacle": sections["dynamicObstacle"],
+        "planningProblem": sections["planningProblem"][0] if sections["planningProblem"] else extract_planning_problem_from_element(None)
+    }
+
+def extract_important_information_from_tree(root):
+    """
+    Same result as extract_important_information, built directly from the XML root element
+    """
+    return important_information_from_sections(*tree_sections(root, SECTION_EXTRACTORS))
+
+def extract_important_information_from_xml(xml_file_path, json_dump_dir=None):
+    """
+    Parse a scenario XML into the important information dict without the JSON round-trip.
+    If json_dump_dir is given, the intermediate JSON is still written there for debugging,
+    which needs the whole tree; otherwise the file is streamed.
+    """
+    if not json_dump_dir:
+        return important_information_from_sections(*stream_sections(xml_file_path, SECTION_EXTRACTORS))
+    root = ET.parse(xml_file_path).getroot()
+    os.makedirs(json_dump_dir, exist_ok=True)
+    json_file_name = os.path.splitext(os.path.basename(xml_file_path))[0] + '.json'
+    tree_to_json(root, os.path.join(json_dump_dir, json_file_name))
+    return extract_important_information_from_tree(root)
+
 def assign_layers(important_info):
     # Layer 1: Road-Level
     L1 = {
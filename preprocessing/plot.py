@@ -1,4 +1,7 @@
+import shapely
+from shapely import STRtree
 from shapely.geometry import Polygon, Point
+from preprocessing.scenario_model import lanelet_bounds
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -13,9 +16,10 @@ def lanelets_to_polygons(lanelet_data):
         # Extract the lanelet ID
         lanelet_id = lanelet['id']
 
-        # Extract left and right bounds and parse points as tuples of floats
-        left_bound_points = [(float(point['x']), float(point['y'])) for point in lanelet.get('leftBound', [])]
-        right_bound_points = [(float(point['x']), float(point['y'])) for point in lanelet.get('rightBound', [])]
+        # Extract left and right bounds as tuples of floats
+        left_bound, right_bound = lanelet_bounds(lanelet)
+        left_bound_points = [tuple(point) for point in left_bound.tolist()]
+        right_bound_points = [tuple(point) for point in right_bound.tolist()]
         
         # Check for missing boundary points
         if not left_bound_points or not right_bound_points:
@@ -127,6 +131,30 @@ def check_point_in_polygons(x, y, polygons):
             return polygon_id
     return None
 
+# Function to check lanelets for many points at once
+def assign_lanelets(xs, ys, polygons):
+    """
+    Assign a lanelet to every point (xs[i], ys[i]) with a single STRtree query.
+    Like check_point_in_polygons, a point gets the first polygon (in dict order) that contains it.
+    Returns an integer array of lanelet ids, -1 for points that are off the road.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    lanelet_ids = np.full(len(xs), -1, dtype=np.int64)
+    if not polygons or len(xs) == 0:
+        return lanelet_ids
+
+    polygon_ids = np.array([int(polygon_id) for polygon_id in polygons.keys()], dtype=np.int64)
+    tree = STRtree(list(polygons.values()))
+    point_idx, polygon_idx = tree.query(shapely.points(xs, ys), predicate="within")
+
+    # Keep the first containing polygon for points on overlapping lanelets
+    first_polygon = np.full(len(xs), len(polygon_ids), dtype=np.int64)
+    np.minimum.at(first_polygon, point_idx, polygon_idx)
+    on_road = first_polygon < len(polygon_ids)
+    lanelet_ids[on_road] = polygon_ids[first_polygon[on_road]]
+    return lanelet_ids
+
 # Function to check lanelet for a single point
 def extract_ego_and_goal_data(data):
     planning_problem = data.get("planningProblem", {})
@@ -201,9 +229,9 @@ def visualize_and_save_ego_trajectory_with_lanelets(
         # Fill the first orientation value (optional: replicate the second orientation)
         trajectory_data.loc[0, "orientation"] = trajectory_data.loc[1, "orientation"]
 
-        # Check lanelet membership for each position
-        trajectory_data["lanelet_id"] = trajectory_data.apply(
-            lambda row: check_point_in_polygons(row["x_position"], row["y_position"], polygons), axis=1
+        # Check lanelet membership for all positions at once
+        trajectory_data["lanelet_id"] = assign_lanelets(
+            trajectory_data["x_position"].to_numpy(), trajectory_data["y_position"].to_numpy(), polygons
         )
 
         # Extract ego and goal data
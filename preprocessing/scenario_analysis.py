@@ -0,0 +1,167 @@
+# Analysis state of one scenario that is carried through the modification iterations of main.helper.
+# After update_xml_scenario rewrites one obstacle, only that obstacle is re-parsed, and only its
+# lanelets and the relative metrics of its changed states are recomputed.
+import math
+import os
+import numpy as np
+import pandas as pd
+
+from mtl_converter.L4_safety_metrics import RelativeMetricsTable
+from mtl_converter.L7_converter import convert_l7_to_mtl, convert_l7_to_mtl_simplified
+from mtl_converter.occupancy_timeline import OccupancyTimeline
+from mtl_converter.safety_metrics import compute_relative_metrics, process_scenario_frames
+from mtl_converter.utils import LaneletIndex
+from preprocessing.extract_trajectories import EGO_DTYPES, dynamic_obstacles_with_lanelets, extract_ego_trajectory, extract_every_nth_timestep, read_trajectory_table, trajectory_file
+from preprocessing.layermodel import assign_layers
+from preprocessing.plot import assign_lanelets, lanelets_to_polygons
+from preprocessing.scenario_model import DynamicObstacle, ScenarioModel
+from tracing import span
+
+# obstacle frame columns and the DynamicObstacle arrays they are built from
+OBSTACLE_COLUMNS = {
+    "x_position": "x",
+    "y_position": "y",
+    "orientation": "orientation",
+    "velocity": "velocity",
+    "acceleration": "acceleration",
+}
+
+class ScenarioAnalysis:
+    """
+    Layers, lanelet lookups and relative metrics of the current version of a scenario.
+    """
+    def __init__(self, scenario_filepath: str, scenario_name: str, ego_trajectory_filepath: str, dump_json: bool = False, save_intermediates: bool = False):
+        self.scenario_filepath = scenario_filepath
+        self.scenario_name = scenario_name
+        # The obstacle and metrics frames are only passed on in memory unless they should be kept on disk
+        self.save_intermediates = save_intermediates
+        with span("xml_to_json") as stage:
+            self.model = ScenarioModel.from_xml(scenario_filepath, 'data/json_scenarios' if dump_json else None)
+            stage.bytes = os.path.getsize(scenario_filepath)
+        with span("layer_extraction"):
+            layers = assign_layers(self.model)
+
+            # Extract individual layers
+            self.L1 = layers["L1_RoadLevel"]
+            self.L4 = layers["L4_MovableObjects"]
+            # ego layer
+            self.L7 = extract_ego_trajectory(ego_trajectory_filepath)
+            self.ego_df = read_trajectory_table(ego_trajectory_filepath, EGO_DTYPES)
+
+        with span("lanelet_assignment"):
+            # spatial index shared by all lanelet lookups
+            self.lanelet_index = LaneletIndex(self.L1)
+            self.polygons = lanelets_to_polygons(self.L1)
+            # lanelet occupancy of every agent, read by all MTL converters and interval queries
+            self.timelines = {
+                obstacle['id']: OccupancyTimeline.for_obstacle(obstacle, self.lanelet_index)
+                for obstacle in self.L4['dynamicObstacle']
+            }
+            self.ego_timeline = OccupancyTimeline.for_ego(self.L7, self.lanelet_index)
+
+        # The ego trajectory is never modified, its MTL only has to be converted once
+        with span("mtl_l7_simplified") as stage:
+            self.L7_mtl_simplified = convert_l7_to_mtl_simplified(self.L7, self.L1, self.lanelet_index, self.ego_timeline)
+            stage.set_bytes(self.L7_mtl_simplified)
+        with span("mtl_l7") as stage:
+            self.L7_mtl, self.L7_lanelets_mentioned = convert_l7_to_mtl(self.L7, self.L1, self.lanelet_index, self.ego_timeline)
+            stage.set_bytes(self.L7_mtl)
+
+        self._compute_relative_metrics()
+
+    def _compute_relative_metrics(self):
+        #  ==== generate the relative metrics ====
+        # dynamic obstacles with their lanelets, then every timestep sorted like the ego trajectory
+        with span("obstacle_lanelets"):
+            obstacle_lanelets_df = dynamic_obstacles_with_lanelets(
+                self.L4, self.polygons, self._intermediate_file('dynamic_obstacles_with_lanelets'))
+        with span("metrics") as stage:
+            self.obstacles_df = extract_every_nth_timestep(
+                obstacle_lanelets_df, self._intermediate_file('dynamic_obstacles'), n=1).reset_index(drop=True)
+
+            self.relative_metrics_df = process_scenario_frames(self.ego_df, self.obstacles_df, self.scenario_name, self.save_intermediates)
+            self.relative_metrics = RelativeMetricsTable(self.relative_metrics_df)
+            stage.bytes = int(self.relative_metrics_df.memory_usage(deep=True).sum())
+
+    def _intermediate_file(self, table: str):
+        if not self.save_intermediates:
+            return None
+        return trajectory_file(f'data/obstacles/{self.scenario_name}_{table}')
+
+    def modified_min_ttc(self, obstacle_element, times: list[int]) -> float:
+        """
+        Smallest relevant TTC (as in RelativeMetricsTable) between the ego vehicle and an updated
+        obstacle element at the given timesteps, inf if there is none. Lower is more critical.
+        At each timestep the larger of both TTCs counts, as an obstacle only closes in if both do
+        (an aligned axis has a TTC of 0).
+        """
+        obstacle = DynamicObstacle.from_element(obstacle_element)
+        obstacle_df = pd.DataFrame({
+            "obstacle_id": obstacle.id,
+            "timestep": obstacle.time,
+            **{column: getattr(obstacle, name) for column, name in OBSTACLE_COLUMNS.items()}
+        })
+        metrics = compute_relative_metrics(self.ego_df, obstacle_df[obstacle_df['timestep'].isin(times)])
+        if metrics.empty:
+            return math.inf
+        metrics = RelativeMetricsTable._effective_ttc(metrics)
+        return float(np.maximum(metrics['ttc_long'], metrics['ttc_lat']).min())
+
+    def update_obstacle(self, obstacle_element, scenario_filepath: str, scenario_name: str):
+        """
+        Replace a dynamic obstacle by its updated XML element, as returned by update_xml_scenario.
+        Falls back to recomputing all relative metrics if the obstacle gained or lost states.
+        """
+        updated = DynamicObstacle.from_element(obstacle_element)
+        obstacles = self.model.dynamic_obstacles
+        position = next(i for i, obstacle in enumerate(obstacles) if obstacle.id == updated.id)
+        previous = obstacles[position]
+        obstacles[position] = updated
+
+        self.scenario_filepath = scenario_filepath
+        self.scenario_name = scenario_name
+        self.timelines[updated['id']] = OccupancyTimeline.for_obstacle(updated, self.lanelet_index)
+        if not self._patch_relative_metrics(previous, updated):
+            self._compute_relative_metrics()
+
+    def _patch_relative_metrics(self, previous: DynamicObstacle, updated: DynamicObstacle) -> bool:
+        # New or removed states change the rows of the obstacle frame and of the metrics
+        times = updated.time
+        if not np.array_equal(previous.time, times) or len(np.unique(times)) != len(times):
+            return False
+
+        changed = np.zeros(len(times), dtype=bool)
+        for name in OBSTACLE_COLUMNS.values():
+            old, new = getattr(previous, name), getattr(updated, name)
+            changed |= ~((old == new) | (np.isnan(old) & np.isnan(new)))
+        if not changed.any():
+            return True
+
+        # Rows of the changed states in the obstacle frame
+        obstacle_rows = (
+            (self.obstacles_df['obstacle_id'] == updated.id) & self.obstacles_df['timestep'].isin(times[changed])
+        ).to_numpy().nonzero()[0]
+        if len(obstacle_rows) != changed.sum():
+            return False
+        states = np.searchsorted(times, self.obstacles_df['timestep'].to_numpy()[obstacle_rows])
+        for column, name in OBSTACLE_COLUMNS.items():
+            self.obstacles_df.iloc[obstacle_rows, self.obstacles_df.columns.get_loc(column)] = getattr(updated, name)[states]
+        self.obstacles_df.iloc[obstacle_rows, self.obstacles_df.columns.get_loc('lanelet_id')] = assign_lanelets(
+            updated.x[states], updated.y[states], self.polygons
+        )
+
+        # Rows of the changed states in the relative metrics, in the same order as computed
+        metrics = compute_relative_metrics(self.ego_df, self.obstacles_df.iloc[obstacle_rows])
+        metric_rows = (
+            (self.relative_metrics_df['obstacle_id'].astype(float) == updated.id)
+            & self.relative_metrics_df['timestep'].astype(float).isin(times[changed].astype(float))
+        ).to_numpy().nonzero()[0]
+        if len(metric_rows) != len(metrics):
+            return False
+        for column in metrics.columns:
+            target = self.relative_metrics_df[column]
+            if target.dtype != metrics[column].dtype:
+                self.relative_metrics_df[column] = target.astype(np.result_type(target.dtype, metrics[column].dtype))
+            self.relative_metrics_df.iloc[metric_rows, self.relative_metrics_df.columns.get_loc(column)] = metrics[column].to_numpy()
+        self.relative_metrics.update(metrics)
+        return True
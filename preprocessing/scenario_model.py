@@ -0,0 +1,327 @@
+# Typed, array-backed scenario model.
+# Coordinates, times and kinematics are parsed once into NumPy arrays instead of being kept
+# as XML text inside nested dicts. The model classes also implement the Mapping protocol
+# with the keys of extract_important_information, so assign_layers, the MTL converters and
+# the LLM prompt builders can keep using them like the dicts they replace.
+import math
+import os
+import xml.etree.ElementTree as ET
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+import numpy as np
+
+from preprocessing.layermodel import (
+    SECTION_EXTRACTORS,
+    element_refs,
+    element_text,
+    extract_location_from_element,
+    extract_planning_problem_from_element,
+    stream_sections,
+    tree_sections,
+)
+from preprocessing.xml2json import tree_to_json
+
+def _parse_float(text) -> float:
+    return float(text) if text is not None else math.nan
+
+def _decimals(text) -> int:
+    # Number of decimals of a plain decimal number, -1 if the text can not be reproduced from its value
+    if text is None or 'e' in text or 'E' in text:
+        return -1
+    decimals = len(text) - text.index('.') - 1 if '.' in text else 0
+    return decimals if decimals <= 15 and f"{float(text):.{decimals}f}" == text else -1
+
+def _format_number(value, decimals: int = -1):
+    # Text representation used by the dict view, None for missing values
+    value = float(value)
+    if math.isnan(value):
+        return None
+    return f"{value:.{decimals}f}" if decimals >= 0 else str(value)
+
+def _points_to_array(points) -> np.ndarray:
+    return np.array(
+        [(_parse_float(element_text(point, "x", 0.0)), _parse_float(element_text(point, "y", 0.0))) for point in points],
+        dtype=np.float64
+    ).reshape(-1, 2)
+
+class Trajectory(NamedTuple):
+    time: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    orientation: np.ndarray
+    velocity: np.ndarray
+    acceleration: np.ndarray
+
+@dataclass(slots=True, eq=False)
+class Lanelet(Mapping):
+    id: int
+    left_bound: np.ndarray  # (n, 2) float64
+    right_bound: np.ndarray  # (m, 2) float64
+    traffic_sign_refs: list[str] = field(default_factory=list)
+    adjacent_left: list[str] = field(default_factory=list)
+    adjacent_right: list[str] = field(default_factory=list)
+    successor: list[str] = field(default_factory=list)
+    predecessor: list[str] = field(default_factory=list)
+
+    _KEYS = ("id", "leftBound", "rightBound", "trafficSignRef", "adjacentLeft", "adjacentRight", "successor", "predecessor")
+
+    @classmethod
+    def from_element(cls, lanelet) -> "Lanelet":
+        traffic_sign_refs = element_refs(lanelet, "trafficSignRef")
+        return cls(
+            id=int(lanelet.get("id")),
+            left_bound=_points_to_array(lanelet.findall("leftBound/point")),
+            right_bound=_points_to_array(lanelet.findall("rightBound/point")),
+            traffic_sign_refs=traffic_sign_refs if traffic_sign_refs else ["None"],
+            adjacent_left=element_refs(lanelet, "adjacentLeft"),
+            adjacent_right=element_refs(lanelet, "adjacentRight"),
+            successor=element_refs(lanelet, "successor"),
+            predecessor=element_refs(lanelet, "predecessor"),
+        )
+
+    def polygon(self) -> tuple[np.ndarray, np.ndarray]:
+        # Combine left and right bounds to form a polygon
+        vertices = np.concatenate([self.left_bound, self.right_bound[::-1]])
+        return vertices[:, 0], vertices[:, 1]
+
+    def __getitem__(self, key):
+        if key == "id":
+            return str(self.id)
+        if key in ("leftBound", "rightBound"):
+            bound = self.left_bound if key == "leftBound" else self.right_bound
+            return [{"x": _format_number(x), "y": _format_number(y)} for x, y in bound]
+        if key == "trafficSignRef":
+            return self.traffic_sign_refs
+        if key == "adjacentLeft":
+            return self.adjacent_left
+        if key == "adjacentRight":
+            return self.adjacent_right
+        if key == "successor":
+            return self.successor
+        if key == "predecessor":
+            return self.predecessor
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+# Trajectory columns that keep the number of decimals of their XML text
+TEXT_COLUMNS = ("x", "y", "orientation", "velocity", "acceleration")
+
+class TrajectoryView(Sequence):
+    """
+    Trajectory states of a DynamicObstacle as the dicts extract_important_information creates
+    """
+    __slots__ = ("_obstacle",)
+
+    def __init__(self, obstacle: "DynamicObstacle"):
+        self._obstacle = obstacle
+
+    def __len__(self):
+        return len(self._obstacle.time)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        obstacle = self._obstacle
+        x, y, orientation, velocity, acceleration = obstacle.text_decimals[index].tolist()
+        return {
+            "position": {
+                "x": _format_number(obstacle.x[index], x),
+                "y": _format_number(obstacle.y[index], y)
+            },
+            "orientation": _format_number(obstacle.orientation[index], orientation),
+            "time": str(int(obstacle.time[index])),
+            "velocity": _format_number(obstacle.velocity[index], velocity),
+            "acceleration": _format_number(obstacle.acceleration[index], acceleration)
+        }
+
+@dataclass(slots=True, eq=False)
+class DynamicObstacle(Mapping):
+    id: int
+    type: str | None
+    length: float
+    width: float
+    initial_state: dict
+    # columnar trajectory, one entry per state
+    time: np.ndarray  # int64 time steps
+    x: np.ndarray
+    y: np.ndarray
+    orientation: np.ndarray
+    velocity: np.ndarray
+    acceleration: np.ndarray
+    # (n, 5) int8 decimals of the TEXT_COLUMNS in the XML, so the dict view reproduces their text
+    text_decimals: np.ndarray
+
+    _KEYS = ("id", "type", "shape", "initialState", "trajectory")
+
+    @classmethod
+    def from_element(cls, obstacle) -> "DynamicObstacle":
+        states = obstacle.findall("trajectory/state")
+        texts = {
+            column: [element_text(state, path) for state in states]
+            for column, path in zip(TEXT_COLUMNS, (
+                "position/point/x", "position/point/y", "orientation/exact", "velocity/exact", "acceleration/exact"
+            ))
+        }
+
+        def column(name):
+            return np.array([_parse_float(text) for text in texts[name]], dtype=np.float64)
+
+        return cls(
+            id=int(obstacle.get("id")),
+            type=element_text(obstacle, "type"),
+            length=_parse_float(element_text(obstacle, "shape/rectangle/length")),
+            width=_parse_float(element_text(obstacle, "shape/rectangle/width")),
+            initial_state={
+                "position": {
+                    "x": element_text(obstacle, "initialState/position/point/x"),
+                    "y": element_text(obstacle, "initialState/position/point/y")
+                },
+                "orientation": element_text(obstacle, "initialState/orientation/exact"),
+                "time": element_text(obstacle, "initialState/time/exact"),
+                "velocity": element_text(obstacle, "initialState/velocity/exact"),
+                "acceleration": element_text(obstacle, "initialState/acceleration/exact")
+            },
+            time=np.array([int(float(element_text(state, "time/exact"))) for state in states], dtype=np.int64),
+            x=column("x"),
+            y=column("y"),
+            orientation=column("orientation"),
+            velocity=column("velocity"),
+            acceleration=column("acceleration"),
+            text_decimals=np.array(
+                [[_decimals(text) for text in values] for values in texts.values()], dtype=np.int8
+            ).reshape(len(TEXT_COLUMNS), len(states)).T.copy(),
+        )
+
+    @property
+    def trajectory(self) -> Trajectory:
+        return Trajectory(self.time, self.x, self.y, self.orientation, self.velocity, self.acceleration)
+
+    def __getitem__(self, key):
+        if key == "id":
+            return str(self.id)
+        if key == "type":
+            return self.type
+        if key == "shape":
+            return {"length": _format_number(self.length), "width": _format_number(self.width)}
+        if key == "initialState":
+            return self.initial_state
+        if key == "trajectory":
+            return TrajectoryView(self)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+@dataclass(slots=True, eq=False)
+class ScenarioModel(Mapping):
+    time_step_size: str | None
+    location: dict
+    scenario_tags: list[str]
+    lanelets: list[Lanelet]
+    traffic_signs: list[dict]
+    dynamic_obstacles: list[DynamicObstacle]
+    planning_problem: dict
+
+    _KEYS = ("timeStepSize", "location", "scenarioTags", "lanelet", "trafficSign", "dynamicObstacle", "planningProblem")
+
+    # Converters of the top-level elements, the typed classes replace the lanelet and obstacle dicts
+    SECTION_EXTRACTORS = {
+        **SECTION_EXTRACTORS,
+        "lanelet": Lanelet.from_element,
+        "dynamicObstacle": DynamicObstacle.from_element,
+    }
+
+    @classmethod
+    def from_sections(cls, attributes: dict, sections: dict) -> "ScenarioModel":
+        return cls(
+            time_step_size=attributes.get("timeStepSize"),
+            location=sections["location"][0] if sections["location"] else extract_location_from_element(None),
+            scenario_tags=sections["scenarioTags"][0] if sections["scenarioTags"] else [],
+            lanelets=sections["lanelet"],
+            traffic_signs=sections["trafficSign"],
+            dynamic_obstacles=sections["dynamicObstacle"],
+            planning_problem=sections["planningProblem"][0] if sections["planningProblem"] else extract_planning_problem_from_element(None),
+        )
+
+    @classmethod
+    def from_tree(cls, root) -> "ScenarioModel":
+        return cls.from_sections(*tree_sections(root, cls.SECTION_EXTRACTORS))
+
+    @classmethod
+    def from_xml(cls, xml_file_path: str, json_dump_dir: str = None) -> "ScenarioModel":
+        """
+        Parse a scenario XML into the typed model, streaming it element by element.
+        If json_dump_dir is given, the xml2json output is still written there for debugging,
+        which needs the whole tree.
+        """
+        if not json_dump_dir:
+            return cls.from_sections(*stream_sections(xml_file_path, cls.SECTION_EXTRACTORS))
+        root = ET.parse(xml_file_path).getroot()
+        os.makedirs(json_dump_dir, exist_ok=True)
+        json_file_name = os.path.splitext(os.path.basename(xml_file_path))[0] + '.json'
+        tree_to_json(root, os.path.join(json_dump_dir, json_file_name))
+        return cls.from_tree(root)
+
+    def __getitem__(self, key):
+        if key == "timeStepSize":
+            return self.time_step_size
+        if key == "location":
+            return self.location
+        if key == "scenarioTags":
+            return self.scenario_tags
+        if key == "lanelet":
+            return self.lanelets
+        if key == "trafficSign":
+            return self.traffic_signs
+        if key == "dynamicObstacle":
+            return self.dynamic_obstacles
+        if key == "planningProblem":
+            return self.planning_problem
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+# Accessors that accept the typed model as well as the plain dicts of extract_important_information
+def lanelet_bounds(lanelet) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Left and right bound of a lanelet as (n, 2) float64 arrays
+    """
+    if isinstance(lanelet, Lanelet):
+        return lanelet.left_bound, lanelet.right_bound
+    left = np.array([(float(p['x']), float(p['y'])) for p in lanelet.get('leftBound', [])], dtype=np.float64).reshape(-1, 2)
+    right = np.array([(float(p['x']), float(p['y'])) for p in lanelet.get('rightBound', [])], dtype=np.float64).reshape(-1, 2)
+    return left, right
+
+def obstacle_trajectory(obstacle) -> Trajectory:
+    """
+    Columnar trajectory of a dynamic obstacle
+    """
+    if isinstance(obstacle, DynamicObstacle):
+        return obstacle.trajectory
+    states = obstacle.get('trajectory', [])
+
+    def column(key):
+        return np.array([_parse_float(state[key]) for state in states], dtype=np.float64)
+
+    return Trajectory(
+        time=np.array([int(float(state['time'])) for state in states], dtype=np.int64),
+        x=np.array([_parse_float(state['position']['x']) for state in states], dtype=np.float64),
+        y=np.array([_parse_float(state['position']['y']) for state in states], dtype=np.float64),
+        orientation=column('orientation'),
+        velocity=column('velocity'),
+        acceleration=column('acceleration'),
+    )
@@ -1,7 +1,22 @@
 import os
 import glob
+import hashlib
 import json
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for output_format="msgpack"
+    msgpack = None
+
+# Output formats: file extension and writer of the converted dict
+OUTPUT_FORMATS = {
+    "json": ".json",      # indented, as before
+    "compact": ".json",   # JSON without indentation and whitespace
+    "msgpack": ".msgpack"
+}
+MANIFEST_FILE_NAME = ".xml2json_manifest.json"
 
 def xml_to_dict(element):
     # Convert an XML element and its children to a dictionary
@@ -20,16 +35,28 @@ def xml_to_dict(element):
         node['text'] = element.text.strip()
     return node
 
-def xml_file_to_json(xml_file_path, json_file_path):
+def xml_file_to_json(xml_file_path, json_file_path, output_format="json"):
     # Parse the XML file
     tree = ET.parse(xml_file_path)
     root = tree.getroot()
+    tree_to_json(root, json_file_path, output_format)
 
+def tree_to_json(root, json_file_path, output_format="json"):
     # Convert the XML tree to a dictionary
     xml_dict = xml_to_dict(root)
 
+    if output_format == "msgpack":
+        if msgpack is None:
+            raise ImportError("output_format='msgpack' requires the msgpack package")
+        with open(json_file_path, 'wb') as msgpack_file:
+            msgpack_file.write(msgpack.packb(xml_dict))
+        return
+
     # Convert the dictionary to a JSON string
-    json_data = json.dumps(xml_dict, indent=4)
+    if output_format == "compact":
+        json_data = json.dumps(xml_dict, separators=(',', ':'))
+    else:
+        json_data = json.dumps(xml_dict, indent=4)
 
     # Write the JSON string to a file
     with open(json_file_path, 'w') as json_file:
@@ -47,19 +74,85 @@ def convert_single_xml_to_json(xml_file_path, destination_dir):
     xml_file_to_json(xml_file_path, json_file_path)
     print(f"Converted {xml_file_path} to {json_file_path}")
 
-def convert_all_xml_to_json(source_dir, destination_dir):
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _convert_if_changed(job):
+    """
+    Convert one XML unless the manifest entry shows that its output is up to date.
+    Returns (file name, manifest entry, whether it was converted).
+    """
+    xml_file_path, output_path, output_format, previous = job
+    stat = os.stat(xml_file_path)
+    entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "format": output_format}
+    if previous and os.path.exists(output_path) and previous.get("format") == output_format and previous.get("size") == stat.st_size:
+        # Unchanged modification time, or touched / copied but same content
+        if previous.get("mtime_ns") == stat.st_mtime_ns:
+            return os.path.basename(xml_file_path), previous, False
+        entry["sha256"] = file_sha256(xml_file_path)
+        if previous.get("sha256") == entry["sha256"]:
+            return os.path.basename(xml_file_path), entry, False
+    entry["sha256"] = entry.get("sha256") or file_sha256(xml_file_path)
+    xml_file_to_json(xml_file_path, output_path, output_format)
+    return os.path.basename(xml_file_path), entry, True
+
+def _try_convert_if_changed(job):
+    """
+    _convert_if_changed that returns the error of a failed conversion instead of raising it,
+    so one broken XML does not stop the others. Returns (file name, manifest entry, whether it was converted, error).
+    """
+    try:
+        return (*_convert_if_changed(job), None)
+    except Exception as e:
+        return os.path.basename(job[0]), None, False, f"{type(e).__name__}: {e}"
+
+def convert_all_xml_to_json(source_dir, destination_dir, workers=None, output_format="json", force=False, chunksize=8):
+    """
+    Convert every XML in source_dir in a process pool with `workers` processes (default: number of CPUs).
+    Outputs whose XML did not change since the last conversion (by size and mtime, else by SHA-256)
+    are skipped unless force is set. The state is kept in a manifest file in destination_dir.
+    Failed files are left out of the manifest and reported in a RuntimeError after all others are converted.
+    output_format is "json" (indented), "compact" (JSON without whitespace) or "msgpack".
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
     # Create the destination directory if it does not exist
     os.makedirs(destination_dir, exist_ok=True)
 
-    # Get all XML files in the source directory
-    xml_files = glob.glob(os.path.join(source_dir, "*.xml"))
+    manifest_path = os.path.join(destination_dir, MANIFEST_FILE_NAME)
+    manifest = {}
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
 
-    # Convert each XML file to JSON
+    # Get all XML files in the source directory
+    xml_files = sorted(glob.glob(os.path.join(source_dir, "*.xml")))
+    jobs = []
     for xml_file_path in xml_files:
-        # Generate the corresponding JSON file path
-        json_file_name = os.path.splitext(os.path.basename(xml_file_path))[0] + '.json'
-        json_file_path = os.path.join(destination_dir, json_file_name)
+        # Generate the corresponding output file path
+        output_name = os.path.splitext(os.path.basename(xml_file_path))[0] + OUTPUT_FORMATS[output_format]
+        jobs.append((xml_file_path, os.path.join(destination_dir, output_name), output_format, manifest.get(os.path.basename(xml_file_path))))
+
+    converted = 0
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for name, entry, was_converted, error in executor.map(_try_convert_if_changed, jobs, chunksize=chunksize):
+            if error is not None:
+                # No entry, so the file is converted again on the next run
+                manifest.pop(name, None)
+                failures[name] = error
+                continue
+            manifest[name] = entry
+            converted += was_converted
 
-        # Convert XML to JSON
-        xml_file_to_json(xml_file_path, json_file_path)
-        print(f"Converted {xml_file_path} to {json_file_path}")
+    # The files that did convert are recorded even if others failed
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    print(f"Converted {converted} of {len(xml_files)} XML files to {destination_dir}, {len(xml_files) - converted - len(failures)} were up to date")
+    if failures:
+        raise RuntimeError(f"Failed to convert {len(failures)} XML files: " + "; ".join(f"{name}: {error}" for name, error in failures.items()))
+    return converted
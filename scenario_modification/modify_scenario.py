@@ -1,9 +1,43 @@
+import asyncio
 import json
-from llm_templates.llm_utils import send_openai_request, get_consistency_params
+from llm_templates.call_log import call_context
+from llm_templates.llm_utils import get_candidate_params, get_llm_client, send_openai_request, get_consistency_params
 from mtl_converter.L1_converter import get_adjacent_lanelets
 from generation_types.generation import StepTwoGenerationResult, TimeInterval
  
 def modify_scenario(step_two_result: StepTwoGenerationResult, L1: dict, L4: dict, L7: dict, ego_lanelets: list[int], dynamic_obstacle_lanelets: list[int], previous_failed_reason: str = None):
+    system_prompt, user_prompt = modification_prompts(step_two_result, L1, L4, L7, ego_lanelets, dynamic_obstacle_lanelets, previous_failed_reason)
+    with call_context(step="modification"):
+        response = send_openai_request(system_prompt, user_prompt, **get_consistency_params())
+    print("Step 3: ", response)
+    return response
+
+def modify_scenario_candidates(step_two_result: StepTwoGenerationResult, L1: dict, L4: dict, L7: dict, ego_lanelets: list[int], dynamic_obstacle_lanelets: list[int], previous_failed_reason: str = None, num_candidates: int = 3) -> list[str]:
+    """
+    Request num_candidates modifications concurrently, each sampled with its own seed
+    """
+    system_prompt, user_prompt = modification_prompts(step_two_result, L1, L4, L7, ego_lanelets, dynamic_obstacle_lanelets, previous_failed_reason)
+    client = get_llm_client("openai")
+
+    async def request_candidate(index: int):
+        # Each task runs in its own copy of the call context
+        with call_context(candidate=index):
+            return await client.acomplete(system_prompt, user_prompt, **get_candidate_params(index))
+
+    async def request_candidates():
+        try:
+            return await asyncio.gather(*(request_candidate(index) for index in range(num_candidates)))
+        finally:
+            # The client's connections are bound to this event loop, which asyncio.run closes afterwards
+            await client.aclose()
+
+    with call_context(step="modification"):
+        responses = asyncio.run(request_candidates())
+    for index, response in enumerate(responses, 1):
+        print(f"Step 3 (candidate {index}/{num_candidates}): ", response)
+    return responses
+
+def modification_prompts(step_two_result: StepTwoGenerationResult, L1: dict, L4: dict, L7: dict, ego_lanelets: list[int], dynamic_obstacle_lanelets: list[int], previous_failed_reason: str = None) -> tuple[str, str]:
     obstacle_id = step_two_result.critical_obstacle_id
     critical_interval = step_two_result.critical_interval
     obstacle_timestamps = find_obstacle_timestamps(obstacle_id, critical_interval, L4)
@@ -60,10 +94,7 @@ Dynamic obstacle trajectory (to be adjusted by you):
 This is very important: Start answering with ```json [...
 """
     print(user_prompt)
-    
-    response = send_openai_request(system_prompt, user_prompt, **get_consistency_params())
-    print("Step 3: ", response)
-    return response
+    return system_prompt, user_prompt
 
 def find_obstacle_timestamps(obstacle_id: str, time_interval: TimeInterval, L4: dict):
         obstacle_timestamps = []
@@ -0,0 +1,60 @@
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+from mtl_converter.utils import LaneletIndex
+from scenario_modification.update_xml import parse_obstacle_data, update_xml_scenario
+
+def apply_best_candidate(responses: list[str],
+                         original_path: str,
+                         obstacle_id: str,
+                         output_path: str,
+                         score: Callable[[ET.Element, list[int]], float],
+                         L1: dict = None,
+                         lanelet_index: LaneletIndex = None) -> ET.Element:
+    """
+    Validate the candidate modifications (LLM responses) concurrently through update_xml_scenario
+    and keep the feasible one with the lowest score(updated obstacle element, modified timesteps),
+    e.g. its minimum TTC. On equal scores the earlier candidate wins.
+    Writes the chosen scenario to output_path and returns its updated dynamicObstacle element.
+    A candidate is rejected if update_xml_scenario rejects it or if its response is empty or unparsable,
+    which would otherwise leave the scenario unmodified.
+    Raises a RuntimeError with the reasons of all candidates if none of them is feasible.
+    """
+    lanelet_index = lanelet_index or LaneletIndex(L1)
+    output_path = Path(output_path)
+
+    def evaluate(index: int, response: str):
+        candidate_path = output_path.with_name(f"{output_path.stem}_candidate_{index}{output_path.suffix}")
+        updated_data = parse_obstacle_data(response)
+        if not updated_data:
+            raise ValueError("Empty or unparsable modification")
+        obstacle = update_xml_scenario(original_path, obstacle_id, updated_data, candidate_path, L1, lanelet_index)
+        times = [int(float(point_data['time'])) for point_data in updated_data]
+        return score(obstacle, times), candidate_path, obstacle
+
+    with ThreadPoolExecutor(max_workers=max(1, len(responses))) as executor:
+        futures = [executor.submit(evaluate, index, response) for index, response in enumerate(responses)]
+
+    feasible = []
+    reasons = []
+    for index, future in enumerate(futures, 1):
+        try:
+            feasible.append(future.result())
+        except Exception as e:
+            reasons.append(f"Candidate {index}: {e}")
+    for reason in reasons:
+        print(f"Rejected {reason}")
+    if not feasible:
+        raise RuntimeError(" | ".join(reasons))
+
+    # min() keeps the first of several candidates with the same score
+    best_score, best_path, best_obstacle = min(feasible, key=lambda candidate: candidate[0])
+    print(f"Selected candidate {best_path.name} with score {best_score}")
+    os.replace(best_path, output_path)
+    for _, candidate_path, _ in feasible:
+        if candidate_path != best_path:
+            os.remove(candidate_path)
+    return best_obstacle
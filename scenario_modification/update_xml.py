@@ -1,9 +1,11 @@
+import heapq
 import json
 import xml.etree.ElementTree as ET
 from typing import List, Dict
 from pathlib import Path
 
-from mtl_converter.utils import is_within_lanelet
+from mtl_converter.utils import LaneletIndex
+from scenario_modification.validate_trajectory import InfeasibleTrajectoryError, validate_trajectory
 
 
 def parse_obstacle_data(json_str: str) -> list[dict]:
@@ -36,103 +38,114 @@ def parse_obstacle_data(json_str: str) -> list[dict]:
         print(f"Unexpected error: {e}")
         return []
 
+def _format_value(value) -> str:
+    # Floats are written with 4 decimals, everything else as is
+    return f"{value:.4f}" if isinstance(value, float) else str(value)
+
+def _state_time(state: ET.Element) -> float:
+    return float(state.findtext('time/exact', '0'))
+
+def _state_element(point: dict) -> ET.Element:
+    state = ET.Element('state')
+
+    # Time
+    time_elem = ET.SubElement(state, 'time')
+    ET.SubElement(time_elem, 'exact').text = point['time']
+    
+    # Position
+    pos_elem = ET.SubElement(state, 'position')
+    pos_point = ET.SubElement(pos_elem, 'point')
+    ET.SubElement(pos_point, 'x').text = point['x']
+    ET.SubElement(pos_point, 'y').text = point['y']
+    
+    # Orientation
+    orient_elem = ET.SubElement(state, 'orientation')
+    ET.SubElement(orient_elem, 'exact').text = point['orientation']
+    
+    # Velocity
+    velocity_elem = ET.SubElement(state, 'velocity')
+    ET.SubElement(velocity_elem, 'exact').text = point['velocity']
+    
+    # Acceleration
+    accel_elem = ET.SubElement(state, 'acceleration')
+    ET.SubElement(accel_elem, 'exact').text = point['acceleration']
+    return state
+
+def splice_states(trajectory: ET.Element, kept_states: list[ET.Element], new_states: list[ET.Element]):
+    """
+    Replace the states of trajectory by kept_states and new_states, sorted by time.
+    kept_states are usually already sorted, then the new states are merged into them in one pass;
+    on equal times kept states come first, like in a stable sort of kept + new states.
+    """
+    new_states = sorted(new_states, key=_state_time)
+    kept_times = [_state_time(state) for state in kept_states]
+    if all(a <= b for a, b in zip(kept_times, kept_times[1:])):
+        states = list(heapq.merge(kept_states, new_states, key=_state_time))
+    else:
+        states = sorted(kept_states + new_states, key=_state_time)
+    # Other children of the trajectory stay in front of the states
+    trajectory[:] = [child for child in trajectory if child.tag != 'state'] + states
+
 def update_xml_scenario(original_path: str,
                        obstacle_id: str,
                        updated_data: List[Dict],
                        output_path: str = None,
-                       L1: dict = None) -> None:
+                       L1: dict = None,
+                       lanelet_index: LaneletIndex = None) -> ET.Element:
     """
     Updates XML scenario with proper type handling for numeric values
+    Raises InfeasibleTrajectoryError with all violations if the modified trajectory is infeasible
+    Returns the updated dynamicObstacle element
     """
+    lanelet_index = lanelet_index or LaneletIndex(L1)
     tree = ET.parse(original_path)
     root = tree.getroot()
 
     updated_times = [str(point_data.get('time', '')) for point_data in updated_data]
     print(f"Updated times: {updated_times}")
 
+    # Convert all values to the strings written into the XML
+    points = [
+        {
+            "time": str(point_data.get('time', '')),
+            "x": _format_value(point_data['position']['x']),
+            "y": _format_value(point_data['position']['y']),
+            "orientation": _format_value(point_data['orientation']),
+            "velocity": _format_value(point_data['velocity']),
+            "acceleration": _format_value(point_data['acceleration'])
+        }
+        for point_data in updated_data
+    ]
+
     # Find obstacle
     for obstacle in root.findall('.//dynamicObstacle'):
         if obstacle.get('id') == obstacle_id:
             trajectory = obstacle.find('trajectory')
             if trajectory is None:
                 trajectory = ET.SubElement(obstacle, 'trajectory')
-            else:
-                # Remove existing states with matching timestamps
-                for state in trajectory.findall('state'):
-                    time_elem = state.find('time/exact')
-                    if time_elem is not None and time_elem.text in updated_times:
-                        trajectory.remove(state)
-            
-            # Add new state elements with string conversion
-            for point_data in updated_data:
-                state = ET.SubElement(trajectory, 'state')
-                
-                # Convert all values to strings
-                time_str = str(point_data.get('time', ''))
-                x_str = f"{point_data['position']['x']:.4f}" if isinstance(point_data['position']['x'], float) else str(point_data['position']['x'])
-                x_float = float(x_str)
-                y_str = f"{point_data['position']['y']:.4f}" if isinstance(point_data['position']['y'], float) else str(point_data['position']['y'])
-                y_float = float(y_str)
-                orient_str = f"{point_data['orientation']:.4f}" if isinstance(point_data['orientation'], float) else str(point_data['orientation'])
-                velocity_str = f"{point_data['velocity']:.4f}" if isinstance(point_data['velocity'], float) else str(point_data['velocity'])
-                accel_str = f"{point_data['acceleration']:.4f}" if isinstance(point_data['acceleration'], float) else str(point_data['acceleration'])
+            # States with matching timestamps are replaced, all others are kept
+            replaced_times = set(updated_times)
+            kept_states = [state for state in trajectory.findall('state') if state.findtext('time/exact') not in replaced_times]
+            kept = [
+                {
+                    "time": state.findtext('time/exact'),
+                    "x": state.findtext('position/point/x'),
+                    "y": state.findtext('position/point/y'),
+                    "orientation": state.findtext('orientation/exact')
+                }
+                for state in kept_states
+            ]
 
-                # ====== possibilities for unfeasible trajectories ======
-                # - returning to a previously visited lanelet
-                # - driving off the road
-                # - driving in the wrong direction @TODO
-                point_is_within_lanelet = False
-                lanelets_visited = []  # Change to list to maintain order
+            # ====== possibilities for unfeasible trajectories ======
+            # - returning to a previously visited lanelet
+            # - driving off the road
+            # - infeasible speed, acceleration, yaw rate or jumps from the unmodified trajectory
+            # - driving in the wrong direction @TODO
+            violations = validate_trajectory(obstacle_id, points, lanelet_index, kept, float(root.get('timeStepSize') or 0.1))
+            if violations:
+                raise InfeasibleTrajectoryError(obstacle_id, violations)
 
-                for lanelet in L1['lanelet']:
-                    position = {"x": x_float,
-                               "y": y_float}
-                    if is_within_lanelet(position, lanelet):
-                        point_is_within_lanelet = True
-                        current_lanelet = lanelet['id']
-                        
-                        # Check if we're trying to return to a previously visited lanelet
-                        if current_lanelet in lanelets_visited[:-1]:  # Allow last lanelet in sequence
-                            raise RuntimeError(f"Dynamic obstacle {obstacle_id} returned to a previously visited lanelet: {current_lanelet}")
-                            
-                        # Only add if it's different from the last visited lanelet
-                        if not lanelets_visited or lanelets_visited[-1] != current_lanelet:
-                            lanelets_visited.append(current_lanelet)
-                        break
-                
-                if not point_is_within_lanelet:
-                    raise RuntimeError(f"Modified position not inside lanelet: {position}")
-                # Time
-                time_elem = ET.SubElement(state, 'time')
-                ET.SubElement(time_elem, 'exact').text = time_str
-                
-                # Position
-                pos_elem = ET.SubElement(state, 'position')
-                pos_point = ET.SubElement(pos_elem, 'point')
-                ET.SubElement(pos_point, 'x').text = x_str
-                ET.SubElement(pos_point, 'y').text = y_str
-                
-                # Orientation
-                orient_elem = ET.SubElement(state, 'orientation')
-                ET.SubElement(orient_elem, 'exact').text = orient_str
-                
-                # Velocity
-                velocity_elem = ET.SubElement(state, 'velocity')
-                ET.SubElement(velocity_elem, 'exact').text = velocity_str
-                
-                # Acceleration
-                accel_elem = ET.SubElement(state, 'acceleration')
-                ET.SubElement(accel_elem, 'exact').text = accel_str
-            
-            # Sort all states by time
-            states = trajectory.findall('state')
-            states.sort(key=lambda s: float(s.findtext('time/exact', '0')))
-            
-            # Clear and re-add sorted states
-            for state in list(trajectory.findall('state')):
-                trajectory.remove(state)
-            for state in states:
-                trajectory.append(state)
+            splice_states(trajectory, kept_states, [_state_element(point) for point in points])
 
             # Handle output path
             if not output_path:
@@ -145,6 +158,6 @@ def update_xml_scenario(original_path: str,
                       xml_declaration=True,
                       method='xml')
             print(f"Scenario successfully updated: {output_path}")
-            return
+            return obstacle
     
     raise ValueError(f"Obstacle {obstacle_id} not found in scenario")
\ No newline at end of file
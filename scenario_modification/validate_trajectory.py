@@ -0,0 +1,136 @@
+# Feasibility checks of an LLM-modified obstacle trajectory, run before it is written into the scenario.
+# All points are checked in one pass, so a rejected modification reports every problem at once
+# and the next LLM attempt can fix all of them.
+from typing import NamedTuple
+import math
+import numpy as np
+from mtl_converter.utils import LaneletIndex
+
+# Limits of a feasible trajectory
+MAX_SPEED = 60.0  # m/s, reported velocity and distance travelled between two states
+MAX_ACCELERATION = 15.0  # m/s^2
+MAX_YAW_RATE = 5.0  # rad/s between two states, recorded trajectories reach about 4 rad/s at low speed
+
+class TrajectoryViolation(NamedTuple):
+    kind: str  # "invalid_value", "duplicate_time", "off_road", "lanelet_revisit", "speed", "acceleration", "position_jump", "yaw_rate"
+    time: str
+    message: str
+
+class InfeasibleTrajectoryError(RuntimeError):
+    """
+    Raised by update_xml_scenario with all violations of a modified trajectory
+    """
+    def __init__(self, obstacle_id: str, violations: list[TrajectoryViolation]):
+        self.obstacle_id = obstacle_id
+        self.violations = violations
+        super().__init__(f"Modified trajectory of dynamic obstacle {obstacle_id} is infeasible: " + "; ".join(violation.message for violation in violations))
+
+def _parse_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+def validate_trajectory(obstacle_id: str,
+                        points: list[dict],
+                        lanelet_index: LaneletIndex,
+                        unmodified_states: list[dict] = None,
+                        time_step_size: float = 0.1) -> list[TrajectoryViolation]:
+    """
+    Check modified trajectory points for
+    - invalid values and duplicate times
+    - positions off the road
+    - returning to a previously visited lanelet, along the modified and the kept states
+    - speed and acceleration beyond MAX_SPEED / MAX_ACCELERATION
+    - position jumps and yaw rates between consecutive states, including the unmodified states
+      right before and after the modified ones
+    points and unmodified_states (the original states that are kept) are dicts with time, x, y, orientation
+    (and velocity, acceleration for points) as they are written into the XML.
+    Returns every violation in time order, an empty list if feasible.
+    """
+    violations = []
+    unmodified_states = unmodified_states or []
+
+    # ==== values ====
+    columns = {key: np.array([_parse_float(point.get(key)) for point in points], dtype=np.float64)
+               for key in ("time", "x", "y", "orientation", "velocity", "acceleration")}
+    labels = [str(point.get('time', '')) for point in points]
+    invalid = np.zeros(len(points), dtype=bool)
+    for key, values in columns.items():
+        for i in np.flatnonzero(~np.isfinite(values)):
+            violations.append(TrajectoryViolation("invalid_value", labels[i], f"Invalid {key} at time {labels[i]}: {points[i].get(key)!r}"))
+        invalid |= ~np.isfinite(values)
+
+    order = np.argsort(columns["time"], kind="stable")
+    order = order[~invalid[order]]
+    if not len(order):
+        # Nothing valid is modified (e.g. an unparsable response), only the invalid values are reported
+        return violations
+    times = columns["time"][order]
+    duplicates = order[1:][times[1:] == times[:-1]]
+    for i in duplicates:
+        violations.append(TrajectoryViolation("duplicate_time", labels[i], f"Time {labels[i]} is modified more than once"))
+    order = order[np.concatenate(([True], times[1:] != times[:-1]))]
+    times = columns["time"][order]
+    kept = [state for state in unmodified_states if np.isfinite(_parse_float(state['time']))]
+
+    # ==== lanelets ====
+    # Lanelets are walked along the resulting trajectory, so a modified state that returns to a lanelet
+    # the obstacle left before (also in the kept states) is found. Only modified states are reported.
+    modified_times = set(times.tolist())
+    kept_walk = [state for state in kept if _parse_float(state['time']) not in modified_times]
+    walk_time = np.concatenate((times, [_parse_float(state['time']) for state in kept_walk]))
+    walk_x = np.concatenate((columns["x"][order], [_parse_float(state['x']) for state in kept_walk]))
+    walk_y = np.concatenate((columns["y"][order], [_parse_float(state['y']) for state in kept_walk]))
+    walk_lanelets = lanelet_index.find_lanelets_xy(walk_x, walk_y)
+    visited, current = set(), None
+    for position in np.argsort(walk_time, kind="stable").tolist():
+        lanelet = walk_lanelets[position]
+        i = order[position] if position < len(order) else None
+        if lanelet is None:
+            if i is not None:
+                point = {"x": float(columns["x"][i]), "y": float(columns["y"][i])}
+                violations.append(TrajectoryViolation("off_road", labels[i], f"Modified position not inside lanelet at time {labels[i]}: {point}"))
+            continue
+        if lanelet == current:  # Staying on the current lanelet
+            continue
+        if lanelet in visited and i is not None:
+            violations.append(TrajectoryViolation("lanelet_revisit", labels[i], f"Dynamic obstacle {obstacle_id} returned to a previously visited lanelet at time {labels[i]}: {lanelet}"))
+        if current is not None:
+            visited.add(current)
+        current = lanelet
+
+    # ==== kinematics ====
+    for i in order[np.abs(columns["velocity"][order]) > MAX_SPEED]:
+        violations.append(TrajectoryViolation("speed", labels[i], f"Velocity {points[i]['velocity']} m/s at time {labels[i]} exceeds {MAX_SPEED} m/s"))
+    for i in order[np.abs(columns["acceleration"][order]) > MAX_ACCELERATION]:
+        violations.append(TrajectoryViolation("acceleration", labels[i], f"Acceleration {points[i]['acceleration']} m/s^2 at time {labels[i]} exceeds {MAX_ACCELERATION} m/s^2"))
+
+    # Consecutive states of the resulting trajectory where at least one state is modified
+    for state in kept:
+        if _parse_float(state['time']) in modified_times:
+            violations.append(TrajectoryViolation("duplicate_time", str(state['time']), f"Time {state['time']} is both modified and kept from the original trajectory"))
+    merged_time = np.concatenate((times, [_parse_float(state['time']) for state in kept]))
+    merged = {
+        key: np.concatenate((columns[key][order], [_parse_float(state[key]) for state in kept]))
+        for key in ("x", "y", "orientation")
+    }
+    merged_labels = [labels[i] for i in order.tolist()] + [str(state['time']) for state in kept]
+    modified = np.arange(len(merged_time)) < len(order)
+    sequence = np.argsort(merged_time, kind="stable")
+    first, second = sequence[:-1], sequence[1:]
+    pairs = (modified[first] | modified[second]) & (merged_time[second] > merged_time[first])
+    first, second = first[pairs], second[pairs]
+    dt = (merged_time[second] - merged_time[first]) * time_step_size
+
+    speed = np.hypot(merged["x"][second] - merged["x"][first], merged["y"][second] - merged["y"][first]) / dt
+    turn = (merged["orientation"][second] - merged["orientation"][first] + math.pi) % (2 * math.pi) - math.pi
+    yaw_rate = np.abs(turn) / dt
+    for a, b, value in zip(first[speed > MAX_SPEED], second[speed > MAX_SPEED], speed[speed > MAX_SPEED]):
+        violations.append(TrajectoryViolation("position_jump", merged_labels[b], f"Position jump between time {merged_labels[a]} and {merged_labels[b]} implies {value:.1f} m/s (max {MAX_SPEED} m/s)"))
+    for a, b, value in zip(first[yaw_rate > MAX_YAW_RATE], second[yaw_rate > MAX_YAW_RATE], yaw_rate[yaw_rate > MAX_YAW_RATE]):
+        violations.append(TrajectoryViolation("yaw_rate", merged_labels[b], f"Orientation change between time {merged_labels[a]} and {merged_labels[b]} implies a yaw rate of {value:.2f} rad/s (max {MAX_YAW_RATE} rad/s)"))
+
+    # Violations without a valid time come last
+    violations.sort(key=lambda violation: np.nan_to_num(_parse_float(violation.time), nan=math.inf))
+    return violations
@@ -1,81 +1,193 @@
-from pathlib import Path
+import argparse
+import os
 import shutil
-import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+# Get the script directory and navigate to project root
+BASE_DIR = Path(__file__).resolve().parent.parent.parent  # Go up two levels to reach project root
+sys.path.insert(0, str(BASE_DIR))
+
+from generate_ego_trajectory import generate_ego_trajectory
+from llm_templates.call_log import CallLog
+from llm_templates.critical_interval import INTERVAL_DETECTORS
+from llm_templates.critical_obstacles import RANKERS
+from llm_templates.llm_utils import set_call_log
+from main import run_scenario
+from tracing import PROFILERS, Tracer, set_tracer
+
+# Directories main.py writes its intermediate files to, relative to the working directory
+JOB_SUBDIRS = ['data/obstacles', 'data/scenarios', 'data/outputs']
+
+def init_worker(trace_file=None, profiler=None, call_log_file=None):
+    os.chdir(BASE_DIR)
+    if call_log_file:
+        set_call_log(CallLog(call_log_file))
+    if trace_file:
+        set_tracer(Tracer(trace_file, profiler))
+
+def prepare_ego_trajectory(scenario_name):
+    """
+    Generate the ego trajectory of a scenario once, unless it is newer than its inputs
+    or there are no Frenetix logs to regenerate it from.
+    """
+    ego_path = BASE_DIR / f'data/ego_trajectories/ego_trajectory_{scenario_name}.csv'
+    logs_path = BASE_DIR / f'data/logs/{scenario_name}/logs.csv'
+    inputs = [BASE_DIR / f'data/scenarios/{scenario_name}.xml', logs_path]
+    if ego_path.exists() and (not logs_path.exists() or all(ego_path.stat().st_mtime >= p.stat().st_mtime for p in inputs)):
+        return scenario_name, None
+    try:
+        generate_ego_trajectory(scenario_name)
+        return scenario_name, None
+    except Exception as e:
+        return scenario_name, e
+
+def run_job(scenario_name, iteration, dest_dir, work_dir, num_modifications, num_candidates=1, top_k=None, ranker="llm", interval_detector="llm"):
+    """
+    Run main.py's modification for one (scenario, iteration) pair inside its own working directory,
+    so parallel jobs never share updated_scenario.xml or intermediate files.
+    """
+    job_dir = work_dir / f"{scenario_name}_iter_{iteration}"
+    if job_dir.exists():
+        shutil.rmtree(job_dir)
+    for subdir in JOB_SUBDIRS:
+        (job_dir / subdir).mkdir(parents=True, exist_ok=True)
+
+    start_time = time.time()
+    try:
+        os.chdir(job_dir)
+        result = run_scenario(
+            scenario_name,
+            num_iterations=num_modifications,
+            num_candidates=num_candidates,
+            top_k=top_k,
+            ranker=ranker,
+            interval_detector=interval_detector,
+            scenario_filepath=str(BASE_DIR / f'data/scenarios/{scenario_name}.xml'),
+            ego_trajectory_filepath=str(BASE_DIR / f'data/ego_trajectories/ego_trajectory_{scenario_name}.csv'))
+    except Exception as e:
+        return scenario_name, iteration, f"Error in iteration {iteration} for scenario {scenario_name}: {e}"
+    finally:
+        os.chdir(BASE_DIR)
+    execution_time = time.time() - start_time
+
+    # Without updated_scenario.xml the loop terminated before the first modification (e.g. the scenario
+    # already collides) and the returned scenario, the unmodified one, is the result
+    updated_src = job_dir / 'updated_scenario.xml'
+    if not updated_src.exists():
+        updated_src = job_dir / result if result else updated_src
+    if not updated_src.exists():
+        return scenario_name, iteration, f"Error: no resulting scenario after simulation for {scenario_name} iteration {iteration}"
 
-def run_simulations(output_dir, n_iterations=5):
+    # Collect runtime and token counts for scripts/time_eval.py and scripts/token_eval.py
+    with open(dest_dir / 'times', 'a') as f:
+        f.write(f"{execution_time}\n")
+    tokens_file = job_dir / 'tokens'
+    if tokens_file.exists():
+        with open(dest_dir / 'tokens', 'a') as f:
+            f.write(tokens_file.read_text())
+
+    # Copy to a temporary name first, so an interrupted run never leaves a half-written result behind
+    updated_dest = dest_dir / f"updated_{scenario_name}_iter_{iteration}.xml"
+    partial_dest = updated_dest.with_suffix('.xml.partial')
+    shutil.copy(updated_src, partial_dest)
+    os.replace(partial_dest, updated_dest)
+    shutil.rmtree(job_dir)
+    return scenario_name, iteration, None
+
+def run_simulations(output_dir, n_iterations=5, workers=None, num_modifications=3, resume=True, num_candidates=1, trace=False, profiler=None, call_log=False, top_k=None, ranker="llm", interval_detector="llm"):
     """
     Run generate_ego_trajectory and main.py for each scenario in data/scenarios
     Run each scenario n_iterations times and save separately
+    Jobs run in a process pool with `workers` processes (default: number of CPUs).
+    With resume, (scenario, iteration) pairs that already have a result in output_dir are skipped.
+    With trace, all workers append the spans of their pipeline stages to output_dir/trace.jsonl
+    (and profile them with profiler, see tracing.Tracer).
+    With top_k, only the top_k most relevant obstacles are described to the LLM (see main.py --top_k).
+    ranker chooses the critical obstacles (see main.py --ranker), interval_detector the critical interval (see main.py --interval_detector).
+    With call_log, the tokens and latency of every LLM call are appended to output_dir/llm_calls.jsonl.
     """
-    # Get the script directory and navigate to project root
-    script_dir = Path(__file__).parent
-    base_dir = script_dir.parent.parent  # Go up two levels to reach project root
-    scenarios_dir = base_dir / 'data/scenarios'
-    
+    scenarios_dir = BASE_DIR / 'data/scenarios'
+
     # Get all XML files in scenarios directory
     scenario_files = sorted(list(scenarios_dir.glob('*.xml')))
     total_scenarios = len(scenario_files)
 
     print(f"Found {total_scenarios} scenarios to process")
     print(f"Each scenario will be run {n_iterations} times")
-    print(f"Working from base directory: {base_dir}")
-    
+    print(f"Working from base directory: {BASE_DIR}")
+
     # Create output directory for multiple iterations
-    dest_dir = base_dir / f'{output_dir}'
+    dest_dir = BASE_DIR / f'{output_dir}'
     dest_dir.mkdir(parents=True, exist_ok=True)
+    work_dir = dest_dir / 'work'
     print(f"Results will be saved to: {dest_dir}")
-    
-    # Process each scenario
-    for i, scenario_file in enumerate(scenario_files, 1):
-        scenario_name = scenario_file.stem  # Get filename without extension
-        print(f"\nProcessing scenario {i}/{total_scenarios}: {scenario_name}")
-        
-        # Run each scenario n_iterations times
-        for iteration in range(1, n_iterations + 1):
-            print(f"  Iteration {iteration}/{n_iterations}")
-            
-            try:
-                # Change to base directory to run scripts
-                original_cwd = Path.cwd()
-                subprocess.run(['python', str(base_dir / 'generate_ego_trajectory.py'), '-s', scenario_name], 
-                             check=True, cwd=base_dir)
-                
-                # Then run main simulation
-                print(f"    Running main simulation for {scenario_name} (iteration {iteration})")
-                subprocess.run(['python', str(base_dir / 'main.py'), '-s', scenario_name], 
-                             check=True, cwd=base_dir)
-
-                # Check if updated_scenario.xml exists before copying
-                updated_src = base_dir / 'updated_scenario.xml'
-                if not updated_src.exists():
-                    print(f"    Error: {updated_src} does not exist after simulation for {scenario_name} iteration {iteration}")
-                else:
-                    # Create filename with iteration number
-                    updated_dest = dest_dir / f"updated_{scenario_name}_iter_{iteration}.xml"
-                    
-                    # Overwrite the existing file if it exists
-                    if updated_dest.exists():
-                        updated_dest.unlink()
-                    
-                    shutil.copy(updated_src, updated_dest)
-                    print(f"    Saved iteration {iteration} to {updated_dest.name}")
-
-                print(f"    Successfully completed iteration {iteration} for {scenario_name}")
-                
-            except subprocess.CalledProcessError as e:
-                print(f"    Error in iteration {iteration} for scenario {scenario_name}: {e}")
-                continue
-            
-        print(f"Completed all {n_iterations} iterations for {scenario_name}")
+
+    jobs = [
+        (scenario_file.stem, iteration)
+        for scenario_file in scenario_files
+        for iteration in range(1, n_iterations + 1)
+        if not (resume and (dest_dir / f"updated_{scenario_file.stem}_iter_{iteration}.xml").exists())
+    ]
+    print(f"{len(jobs)} of {total_scenarios * n_iterations} runs left to do")
+
+    trace_file = str(dest_dir / 'trace.jsonl') if trace else None
+    call_log_file = str(dest_dir / 'llm_calls.jsonl') if call_log else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(trace_file, profiler, call_log_file)) as executor:
+        # The ego trajectory only depends on the scenario, so it is generated once for all iterations
+        scenario_names = sorted({scenario_name for scenario_name, _ in jobs})
+        failed_scenarios = set()
+        for future in as_completed([executor.submit(prepare_ego_trajectory, name) for name in scenario_names]):
+            scenario_name, error = future.result()
+            if error is not None:
+                print(f"Error generating the ego trajectory for {scenario_name}: {error}")
+                failed_scenarios.add(scenario_name)
+
+        futures = [
+            executor.submit(run_job, scenario_name, iteration, dest_dir, work_dir, num_modifications, num_candidates, top_k, ranker, interval_detector)
+            for scenario_name, iteration in jobs if scenario_name not in failed_scenarios
+        ]
+        for i, future in enumerate(as_completed(futures), 1):
+            scenario_name, iteration, error = future.result()
+            if error is not None:
+                print(f"[{i}/{len(futures)}] {error}")
+            else:
+                print(f"[{i}/{len(futures)}] Saved iteration {iteration} of {scenario_name}")
 
     print(f"\nAll scenarios processed! Results saved in {dest_dir}")
-    
+
     # Print summary statistics
     total_files = len(list(dest_dir.glob('*.xml')))
     expected_files = total_scenarios * n_iterations
     print(f"Generated {total_files}/{expected_files} files")
 
 if __name__ == "__main__":
-    output_dir = "updated_files_multiple_iterations_5x"
-    n_iterations = 5
-    run_simulations(output_dir, n_iterations)
+    parser = argparse.ArgumentParser(description='Run the scenario modification for all scenarios in data/scenarios')
+    parser.add_argument('-o', '--output_dir', type=str, default="updated_files_multiple_iterations_5x",
+                        help='OPTIONAL: Output directory relative to the project root')
+    parser.add_argument('-n', '--n_iterations', type=int, default=5,
+                        help='OPTIONAL: Number of runs per scenario (default: 5)')
+    parser.add_argument('-m', '--num_modifications', type=int, default=3,
+                        help='OPTIONAL: Maximum number of modification iterations per run (default: 3)')
+    parser.add_argument('-k', '--candidates', type=int, default=1,
+                        help='OPTIONAL: Number of modifications requested concurrently per modification iteration (default: 1)')
+    parser.add_argument('-r', '--ranker', type=str, default="llm", choices=RANKERS,
+                        help='OPTIONAL: How the critical obstacles are chosen (default: llm)')
+    parser.add_argument('-d', '--interval_detector', type=str, default="llm", choices=INTERVAL_DETECTORS,
+                        help='OPTIONAL: How the critical interval is found (default: llm)')
+    parser.add_argument('-p', '--top_k', type=int, default=None,
+                        help='OPTIONAL: Only describe the K most relevant obstacles when asking for the critical obstacles (default: all obstacles)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='OPTIONAL: Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-t', '--trace', action='store_true',
+                        help='OPTIONAL: Append the duration, bytes and memory (process peak RSS and its growth) of every pipeline stage to trace.jsonl in the output directory')
+    parser.add_argument('--profile', type=str, default=None, choices=PROFILERS,
+                        help='OPTIONAL: With --trace, also profile every stage into profiles/ in the output directory')
+    parser.add_argument('-l', '--call_log', action='store_true',
+                        help='OPTIONAL: Append the tokens and latency of every LLM call to llm_calls.jsonl in the output directory')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='OPTIONAL: Rerun scenarios that already have a result in the output directory')
+    args = parser.parse_args()
+    run_simulations(args.output_dir, args.n_iterations, args.workers, args.num_modifications, args.resume, args.candidates, args.trace, args.profile, args.call_log, args.top_k, args.ranker, args.interval_detector)
@@ -0,0 +1,29 @@
+import json
+import sys
+import numpy as np
+
+# Read the spans written with main.py -t / run_simulation.py --trace
+trace_file = sys.argv[1] if len(sys.argv) > 1 else 'trace.jsonl'
+with open(trace_file, 'r') as f:
+    spans = [json.loads(line) for line in f if line.strip()]
+
+# Group the durations by stage
+stages = {}
+for span in spans:
+    stages.setdefault(span['stage'], []).append(span)
+
+# Stages that contain other stages would be counted twice in the share of the total
+containers = {'scenario', 'iteration', 'analysis'}
+total = sum(span['duration'] for span in spans if span['stage'] not in containers)
+
+print(f"{'stage':<24}{'count':>7}{'median s':>11}{'p90 s':>9}{'total s':>10}{'share':>8}{'errors':>8}{'median bytes':>14}{'peak RSS MiB':>14}{'RSS growth MiB':>16}")
+for stage, stage_spans in sorted(stages.items(), key=lambda item: -sum(span['duration'] for span in item[1])):
+    durations = np.array([span['duration'] for span in stage_spans])
+    sizes = [span['bytes'] for span in stage_spans if span.get('bytes') is not None]
+    # Peak RSS of the process when the stage ended, and by how much the stage raised it
+    peaks = [span['process_peak_rss_kb'] for span in stage_spans if span.get('process_peak_rss_kb') is not None]
+    growths = [span['peak_rss_growth_kb'] for span in stage_spans if span.get('peak_rss_growth_kb') is not None]
+    errors = sum(span.get('status') == 'error' for span in stage_spans)
+    share = f"{durations.sum() / total:.1%}" if total and stage not in containers else "-"
+    print(f"{stage:<24}{len(durations):>7}{np.median(durations):>11.4f}{np.percentile(durations, 90):>9.4f}{durations.sum():>10.2f}{share:>8}{errors:>8}"
+          f"{(f'{np.median(sizes):.0f}' if sizes else '-'):>14}{(f'{max(peaks) / 1024:.1f}' if peaks else '-'):>14}{(f'{max(growths) / 1024:.1f}' if growths else '-'):>16}")
@@ -0,0 +1,249 @@
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+PROFILERS = ("cprofile", "pyinstrument")
+
+def peak_rss_kb():
+    """
+    Peak resident set size of this process since it started in KiB, None where the platform does not report it
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def payload_bytes(value) -> int:
+    """
+    Size of data in bytes: UTF-8 length of a text or of all texts in a list, JSON length of anything else
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (list, tuple)) and all(isinstance(item, str) for item in value):
+        return sum(len(item.encode("utf-8")) for item in value)
+    return len(json.dumps(value, default=str).encode("utf-8"))
+
+class Span:
+    """
+    One timed pipeline stage. Fields (e.g. scenario, iteration) are inherited by nested spans.
+    The code inside the span can set the bytes of data the stage produced (span.bytes = ... or
+    span.set_bytes(data)) or further fields (span.fields[...] = ...).
+    Memory is recorded as the peak RSS of the process so far (process_peak_rss_kb) and by how much
+    the stage raised it (peak_rss_growth_kb), which is 0 for stages that stay below an earlier peak.
+    """
+    def __init__(self, tracer: "Tracer", stage: str, parent: "Span" = None, profile: bool = True, **fields):
+        self.tracer = tracer
+        self.stage = stage
+        self.parent = parent
+        self.profile = profile
+        self.fields = {**(parent.fields if parent else {}), **fields}
+        self.bytes = None
+        self.start = None
+        self._peak_rss_start = None
+        self._profiler = None
+
+    @property
+    def path(self) -> str:
+        return f"{self.parent.path}/{self.stage}" if self.parent else self.stage
+
+    def set_bytes(self, data):
+        """
+        Record the size of the data the stage produced, see payload_bytes
+        """
+        self.bytes = payload_bytes(data)
+
+    def __enter__(self) -> "Span":
+        self._peak_rss_start = peak_rss_kb()
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        if self.profile:
+            self._profiler = self.tracer._start_profiler()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.finish(exc)
+        return False
+
+    def finish(self, error: BaseException = None):
+        duration = time.perf_counter() - self.start
+        if self._profiler is not None:
+            self.tracer._stop_profiler(self._profiler, self)
+        self.tracer._pop(self)
+        peak_rss = peak_rss_kb()
+        self.tracer.write({
+            **self.fields,
+            "stage": self.stage,
+            "path": self.path,
+            "start": self.wall_start,
+            "duration": duration,
+            "bytes": self.bytes,
+            "process_peak_rss_kb": peak_rss,
+            "peak_rss_growth_kb": peak_rss - self._peak_rss_start if peak_rss is not None else None,
+            "pid": os.getpid(),
+            "status": "ok" if error is None else "error",
+            **({"error": repr(error)} if error is not None else {}),
+        })
+
+class _NullSpan:
+    """
+    Span of a disabled tracer, setting fields on it has no effect
+    """
+    bytes = None
+
+    def __init__(self):
+        self.fields = {}
+
+    def set_bytes(self, data):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def finish(self, error: BaseException = None):
+        pass
+
+class Tracer:
+    """
+    Writes one JSON line per finished span to `path` (appending, so parallel processes can share the file).
+    Spans nest per thread. With `profiler` ("cprofile" or "pyinstrument"), the stages are profiled
+    into `profile_dir` (default: profiles/ next to the trace file). Only one stage is profiled at a time,
+    so stages that contain other stages (profile=False) and stages started while another is profiled
+    are only timed.
+    Without a path, spans are not recorded at all.
+    """
+    def __init__(self, path: str = None, profiler: str = None, profile_dir: str = None):
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {profiler}")
+        self.path = path
+        self.profiler = profiler if path else None
+        self.profile_dir = Path(profile_dir) if profile_dir else (Path(path).parent / "profiles" if path else None)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._profiler_lock = threading.Lock()
+        self._profiling = False
+        self._profile_count = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Tracer configured by TRACE_FILE, TRACE_PROFILE and TRACE_PROFILE_DIR (disabled without TRACE_FILE)
+        """
+        return cls(os.environ.get("TRACE_FILE") or None,
+                   os.environ.get("TRACE_PROFILE") or None,
+                   os.environ.get("TRACE_PROFILE_DIR") or None)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, stage: str, profile: bool = True, **fields):
+        """
+        Context manager timing one stage: with tracer.span("metrics", scenario=...) as span: ...
+        """
+        if not self.enabled:
+            return _NullSpan()
+        stack = self._stack()
+        span = Span(self, stage, stack[-1] if stack else None, profile, **fields)
+        stack.append(span)
+        return span
+
+    def start(self, stage: str, profile: bool = True, **fields):
+        """
+        Enter a span that is closed later by span.finish(), for stages that do not fit a with block
+        """
+        return self.span(stage, profile, **fields).__enter__()
+
+    def _pop(self, span: Span):
+        stack = self._stack()
+        if span in stack:
+            del stack[stack.index(span):]
+
+    def write(self, record: dict):
+        line = json.dumps(record, default=str) + "\n"
+        with self._write_lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    # ==== profiling ====
+    def _start_profiler(self):
+        if self.profiler is None:
+            return None
+        with self._profiler_lock:
+            if self._profiling:
+                return None
+            self._profiling = True
+            self._profile_count += 1
+        try:
+            if self.profiler == "cprofile":
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+            else:
+                from pyinstrument import Profiler
+                profiler = Profiler()
+                profiler.start()
+        except Exception as e:
+            print(f"Profiling disabled: {e}")
+            self.profiler = None
+            self._profiling = False
+            return None
+        return profiler
+
+    def _stop_profiler(self, profiler, span: Span):
+        try:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            name = "_".join(str(part) for part in (
+                span.fields.get("scenario", "run"), span.fields.get("iteration", 0), span.stage, os.getpid(), self._profile_count))
+            if self.profiler == "cprofile":
+                profiler.disable()
+                profiler.dump_stats(self.profile_dir / f"{name}.prof")
+            else:
+                profiler.stop()
+                (self.profile_dir / f"{name}.html").write_text(profiler.output_html())
+        finally:
+            with self._profiler_lock:
+                self._profiling = False
+
+_tracer = Tracer.from_env()
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+def set_tracer(tracer: Tracer):
+    """
+    Record the spans of all pipeline stages with tracer (or not at all if None)
+    """
+    global _tracer
+    _tracer = tracer or Tracer()
+
+def span(stage: str, profile: bool = True, **fields):
+    """
+    Span of the current tracer, see Tracer.span
+    """
+    return _tracer.span(stage, profile, **fields)
+
+def start_span(stage: str, profile: bool = True, **fields):
+    """
+    Started span of the current tracer, see Tracer.start
+    """
+    return _tracer.start(stage, profile, **fields)